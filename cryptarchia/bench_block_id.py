@@ -0,0 +1,100 @@
+"""
+Micro-benchmark of the hashing done per `Follower.on_block`.
+
+Feeds the same chain to a follower twice: once with headers that recompute their
+ID (and leader proof nonce contribution) on every call, as headers did before IDs
+were cached, and once with regular, caching headers.
+
+Run with:
+
+    python -m cryptarchia.bench_block_id
+"""
+
+import time
+
+import cryptarchia.cryptarchia as cryptarchia
+from cryptarchia.cryptarchia import BlockHeader, Follower, MockLeaderProof, Note, Slot
+from cryptarchia.test_common import mk_config, mk_genesis_state
+
+
+class UncachedMockLeaderProof(MockLeaderProof):
+    def epoch_nonce_contribution(self) -> cryptarchia.Hash:
+        return MockLeaderProof._epoch_nonce_contribution.func(self)
+
+
+class UncachedBlockHeader(BlockHeader):
+    def id(self) -> cryptarchia.Hash:
+        return BlockHeader._id.func(self)
+
+    def __hash__(self):
+        return hash(self.id())
+
+
+def mk_chain(header_cls, proof_cls, genesis: BlockHeader, note: Note, length: int):
+    chain = []
+    parent = genesis.id()
+    for slot in range(1, length + 1):
+        block = header_cls(
+            slot=Slot(slot),
+            parent=parent,
+            content_size=0,
+            content_id=bytes(32),
+            leader_proof=proof_cls(note, Slot(slot), parent=parent),
+        )
+        chain.append(block)
+        parent = block.id()
+    return chain
+
+
+class CountingSha256:
+    def __init__(self, sha256):
+        self.sha256 = sha256
+        self.calls = 0
+
+    def __call__(self, *args):
+        self.calls += 1
+        return self.sha256(*args)
+
+
+def run(header_cls, proof_cls, length: int) -> tuple[float, float]:
+    note = Note(sk=0, value=10)
+    config = mk_config([note])
+    genesis = mk_genesis_state([note])
+    genesis.block = header_cls(
+        slot=genesis.block.slot,
+        parent=genesis.block.parent,
+        content_size=genesis.block.content_size,
+        content_id=genesis.block.content_id,
+        leader_proof=proof_cls(
+            genesis.block.leader_proof.note,
+            genesis.block.leader_proof.slot,
+            genesis.block.leader_proof.parent,
+        ),
+    )
+    chain = mk_chain(header_cls, proof_cls, genesis.block, note, length)
+    follower = Follower(genesis, config)
+
+    counter = CountingSha256(cryptarchia.sha256)
+    cryptarchia.sha256 = counter
+    try:
+        start = time.perf_counter()
+        for block in chain:
+            follower.on_block(block)
+        elapsed = time.perf_counter() - start
+    finally:
+        cryptarchia.sha256 = counter.sha256
+
+    assert follower.tip_id() == chain[-1].id()
+    return counter.calls / length, elapsed / length
+
+
+if __name__ == "__main__":
+    length = 1000
+    for name, header_cls, proof_cls in [
+        ("uncached ids", UncachedBlockHeader, UncachedMockLeaderProof),
+        ("cached ids", BlockHeader, MockLeaderProof),
+    ]:
+        hashes, seconds = run(header_cls, proof_cls, length)
+        print(
+            f"{name:>12}: {hashes:6.1f} sha256/on_block, {seconds * 1e6:8.1f} us/on_block"
+        )
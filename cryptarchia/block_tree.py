@@ -0,0 +1,499 @@
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections.abc import Iterator, Mapping, MutableMapping
+from typing import TYPE_CHECKING
+
+from cryptarchia.store import BlockStore, LRUCache
+
+if TYPE_CHECKING:
+    from cryptarchia.cryptarchia import BlockHeader, Hash, LedgerState
+
+# marks the absence of a block in the parent, child and sibling columns
+_NONE = -1
+
+
+class BlockTree(MutableMapping):
+    """
+    The ledger states of a block tree, keyed by block ID.
+
+    Block IDs are interned as dense integers, which index columns holding the parent,
+    height, slot, leader count and skip pointer of every block, and its first child and
+    next sibling. Walking the tree only reads those columns, at a fixed cost of about
+    forty bytes per block next to the block ID itself. Height queries are O(1) and,
+    thanks to the skip pointers, ancestry queries are O(log n). All blocks are also
+    kept sorted by slot, for range queries.
+
+    The height of a block doubles as the number of blocks on its chain, so, since slots
+    never decrease along a chain, counting the blocks of a chain within a range of slots
+    is a search for the last block before a slot, which skip pointers make O(log n).
+
+    A block must be inserted after its parent. A block whose parent is not in the tree
+    becomes the root of a new tree, at height 0.
+
+    With a `store`, the headers and states of immutable blocks can be moved out of memory
+    with `persist`, after which they are loaded back through LRU caches of
+    `cache_size` entries. Only the columns of those blocks stay in memory.
+    """
+
+    @staticmethod
+    def of(states: Mapping["Hash", "LedgerState"]) -> "BlockTree":
+        """
+        Returns `states` if it is already a block tree, or a block tree indexing it.
+        """
+        return states if isinstance(states, BlockTree) else BlockTree(states)
+
+    def __init__(
+        self,
+        states: Mapping["Hash", "LedgerState"] | None = None,
+        store: BlockStore | None = None,
+        cache_size: int = 256,
+    ):
+        self._index: dict["Hash", int] = {}
+        self._ids: list["Hash | None"] = []
+        # None once the state has been moved to the block store
+        self._states: list["LedgerState | None"] = []
+        self._parent = array("i")
+        self._skip = array("i")
+        self._height = array("i")
+        self._slot = array("q")
+        self._leader_count = array("q")
+        self._first_child = array("i")
+        self._next_sibling = array("i")
+        # integers of removed blocks, reused by the next insertions
+        self._free: list[int] = []
+
+        self._store = store
+        self._state_cache = LRUCache(cache_size)
+        self._block_cache = LRUCache(cache_size)
+        # blocks by slot: the sorted slots holding blocks, and for each of them a bucket
+        # of (insertion sequence number, block) in insertion order. Blocks mostly arrive
+        # in order of slot, so slots are mostly appended. Emptied buckets are kept, so
+        # that slots are never removed from the middle of the array.
+        self._slot_keys = array("q")
+        self._slot_buckets: dict[int, list[tuple[int, int]]] = {}
+        self._next_seq = 0
+        # bumped on every change to the slot index, to detect changes during iteration
+        self._slot_version = 0
+        if states:
+            # insert parents before their children, whatever the order of `states`
+            for block_id in states:
+                pending = []
+                while block_id in states and block_id not in self._index:
+                    pending.append(block_id)
+                    block_id = states[block_id].block.parent
+                for block_id in reversed(pending):
+                    self[block_id] = states[block_id]
+
+    def __getitem__(self, block_id: "Hash") -> "LedgerState":
+        return self._state(self._index[block_id])
+
+    def _state(self, i: int) -> "LedgerState":
+        state = self._states[i]
+        if state is not None:
+            return state
+        block_id = self._ids[i]
+        state = self._state_cache.get(block_id)
+        if state is None:
+            state = self._store.get_state(block_id)
+            self._state_cache.put(block_id, state)
+        return state
+
+    def _block(self, i: int) -> "BlockHeader":
+        state = self._states[i]
+        if state is not None:
+            return state.block
+        block_id = self._ids[i]
+        if (state := self._state_cache.get(block_id)) is not None:
+            return state.block
+        block = self._block_cache.get(block_id)
+        if block is None:
+            block = self._store.get_block(block_id)
+            self._block_cache.put(block_id, block)
+        return block
+
+    def __setitem__(self, block_id: "Hash", state: "LedgerState"):
+        i = self._index.get(block_id)
+        if i is not None:
+            # The ID fixes the header, so of the columns only the leader count, which
+            # comes from the state, may change.
+            self._states[i] = state
+            self._leader_count[i] = state.leader_count
+            self._state_cache.discard(block_id)
+            return
+
+        parent = self._index.get(state.block.parent, _NONE)
+        if parent == _NONE:
+            height = 0
+            skip = _NONE  # set to the block itself below
+        else:
+            height = self._height[parent] + 1
+            # Skew-binary skip pointers (Myers, 1983): with a single extra pointer per
+            # block, any ancestor can be reached in O(log n) hops.
+            skip = self._skip[parent]
+            if self._height[parent] - self._height[skip] == (
+                self._height[skip] - self._height[self._skip[skip]]
+            ):
+                skip = self._skip[skip]
+            else:
+                skip = parent
+        row = (
+            parent,
+            skip,
+            height,
+            state.block.slot.absolute_slot,
+            state.leader_count,
+            _NONE,
+            _NONE,
+        )
+
+        if self._free:
+            i = self._free.pop()
+            self._ids[i] = block_id
+            self._states[i] = state
+            for column, value in zip(self._columns(), row):
+                column[i] = value
+        else:
+            i = len(self._ids)
+            self._ids.append(block_id)
+            self._states.append(state)
+            for column, value in zip(self._columns(), row):
+                column.append(value)
+        if skip == _NONE:
+            self._skip[i] = i
+        self._index[block_id] = i
+
+        if parent != _NONE:
+            # append to the children of the parent, which are kept in insertion order
+            child = self._first_child[parent]
+            if child == _NONE:
+                self._first_child[parent] = i
+            else:
+                while self._next_sibling[child] != _NONE:
+                    child = self._next_sibling[child]
+                self._next_sibling[child] = i
+
+        slot = self._slot[i]
+        bucket = self._slot_buckets.get(slot)
+        if bucket is None:
+            bucket = self._slot_buckets[slot] = []
+            if not self._slot_keys or slot > self._slot_keys[-1]:
+                self._slot_keys.append(slot)
+            else:
+                insort(self._slot_keys, slot)
+        bucket.append((self._next_seq, i))
+        self._next_seq += 1
+        self._slot_version += 1
+
+    def _columns(self) -> tuple[array, ...]:
+        return (
+            self._parent,
+            self._skip,
+            self._height,
+            self._slot,
+            self._leader_count,
+            self._first_child,
+            self._next_sibling,
+        )
+
+    def __delitem__(self, block_id: "Hash"):
+        i = self._index[block_id]
+        if self._first_child[i] != _NONE:
+            raise ValueError("Cannot remove a block before its descendants")
+        parent = self._parent[i]
+        if parent != _NONE:
+            # unlink from the children of the parent
+            if self._first_child[parent] == i:
+                self._first_child[parent] = self._next_sibling[i]
+            else:
+                child = self._first_child[parent]
+                while self._next_sibling[child] != i:
+                    child = self._next_sibling[child]
+                self._next_sibling[child] = self._next_sibling[i]
+        self._release(i)
+
+    def _release(self, i: int):
+        self._unindex_slot(i)
+        del self._index[self._ids[i]]
+        self._state_cache.discard(self._ids[i])
+        self._ids[i] = None
+        self._states[i] = None
+        self._free.append(i)
+
+    def __contains__(self, block_id) -> bool:
+        return block_id in self._index
+
+    def __iter__(self) -> Iterator["Hash"]:
+        return iter(self._index)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def _children(self, i: int) -> list[int]:
+        children = []
+        child = self._first_child[i]
+        while child != _NONE:
+            children.append(child)
+            child = self._next_sibling[child]
+        return children
+
+    def _ancestor_at(self, i: int, height: int) -> int:
+        heights, skips, parents = self._height, self._skip, self._parent
+        while heights[i] > height:
+            skip = skips[i]
+            i = skip if heights[skip] >= height else parents[i]
+        return i
+
+    def _last_before_slot(self, i: int, slot: int) -> int:
+        # Slots never decrease along a chain, so every block skipped over by a skip
+        # pointer to a block at or after `slot` is also at or after `slot`.
+        slots, skips, parents = self._slot, self._skip, self._parent
+        while slots[i] >= slot:
+            if parents[i] == _NONE:
+                return _NONE
+            skip = skips[i]
+            i = skip if slots[skip] >= slot else parents[i]
+        return i
+
+    def _lca(self, a: int, b: int) -> int:
+        height_a, height_b = self._height[a], self._height[b]
+        a = self._ancestor_at(a, height_b)
+        b = self._ancestor_at(b, height_a)
+        # Skip pointers only depend on the height of a block, so from equal heights
+        # both blocks jump in lockstep.
+        skips, parents = self._skip, self._parent
+        while a != b:
+            if parents[a] == _NONE:
+                return _NONE
+            if skips[a] != skips[b]:
+                a, b = skips[a], skips[b]
+            else:
+                a, b = parents[a], parents[b]
+        return a
+
+    def height(self, block_id: "Hash") -> int:
+        """
+        Returns the number of blocks between the block and the root of its tree.
+        """
+        return self._height[self._index[block_id]]
+
+    def leader_count(self, block_id: "Hash") -> int:
+        """
+        Returns the leader count of the block's ledger state, without loading the state.
+        """
+        return self._leader_count[self._index[block_id]]
+
+    def ancestor(self, block_id: "Hash", depth: int) -> "Hash":
+        """
+        Returns the ID of the ancestor `depth` blocks behind the given block,
+        or the root of the tree if the chain is shorter than that.
+        """
+        i = self._index[block_id]
+        return self._ids[self._ancestor_at(i, max(self._height[i] - depth, 0))]
+
+    def is_ancestor(self, a: "Hash", b: "Hash") -> bool:
+        """
+        Returns True if `a` is an ancestor of `b`, or `b` itself.
+        """
+        i = self._index.get(a)
+        j = self._index.get(b)
+        if i is None or j is None or self._height[i] > self._height[j]:
+            return False
+        return self._ancestor_at(j, self._height[i]) == i
+
+    def lca(self, a: "Hash", b: "Hash") -> "Hash":
+        """
+        Returns the ID of the lowest common ancestor of two blocks, in O(log n).
+        """
+        lca = self._lca(self._index[a], self._index[b])
+        if lca == _NONE:
+            raise ValueError("Blocks do not share an ancestor")
+        return self._ids[lca]
+
+    def divergence(self, a: "Hash", b: "Hash") -> tuple["Hash", int, int]:
+        """
+        Returns the lowest common ancestor of two blocks, along with the number of blocks
+        from that ancestor to `a` and to `b`.
+        """
+        lca = self.lca(a, b)
+        height = self.height(lca)
+        return lca, self.height(a) - height, self.height(b) - height
+
+    def last_before_slot(self, tip: "Hash", slot: int) -> "Hash | None":
+        """
+        Returns the ID of the last block strictly before `slot` on the chain ending at `tip`,
+        or None if the whole chain is at or after `slot`.
+        """
+        i = self._last_before_slot(self._index[tip], slot)
+        return None if i == _NONE else self._ids[i]
+
+    def density(self, tip: "Hash", ancestor: "Hash", slot: int) -> int:
+        """
+        Returns the number of blocks strictly before `slot` from `ancestor` (an ancestor
+        of `tip`) to `tip`, both included.
+        """
+        start = self._height[self._index[ancestor]]
+        end = self._last_before_slot(self._index[tip], slot)
+        if end == _NONE or self._height[end] < start:
+            return 0
+        return self._height[end] - start + 1
+
+    def iter_chain(self, tip: "Hash") -> Iterator["LedgerState"]:
+        """
+        Iterates over the states of the chain ending at `tip`, from the tip to the root.
+        """
+        i = self._index.get(tip, _NONE)
+        while i != _NONE:
+            yield self._state(i)
+            i = self._parent[i]
+
+    def iter_chain_blocks(self, tip: "Hash") -> Iterator["BlockHeader"]:
+        """
+        Iterates over the blocks of the chain ending at `tip`, from the tip to the root.
+        """
+        i = self._index.get(tip, _NONE)
+        while i != _NONE:
+            yield self._block(i)
+            i = self._parent[i]
+
+    def chain(self, tip: "Hash", ancestor: "Hash") -> list["BlockHeader"]:
+        """
+        Returns the blocks from `ancestor` to `tip`, both included, in chain order.
+        """
+        blocks = []
+        i = self._index[tip]
+        stop = self._index[ancestor]
+        while i != stop:
+            blocks.append(self._block(i))
+            i = self._parent[i]
+        blocks.append(self._block(stop))
+        blocks.reverse()
+        return blocks
+
+    def subtree(self, block_id: "Hash") -> Iterator["Hash"]:
+        """
+        Iterates over the IDs of a block and its descendants, parents before children.
+        """
+        stack = [self._index[block_id]]
+        while stack:
+            i = stack.pop()
+            yield self._ids[i]
+            stack.extend(reversed(self._children(i)))
+
+    def persist(self, block_id: "Hash"):
+        """
+        Moves the states of `block_id` and its ancestors to the block store, if any.
+
+        Only the state of `block_id` itself is kept in the cache, since new blocks may
+        still build on it. `block_id` must be immutable: the states of persisted blocks
+        are expected to never change.
+        """
+        if self._store is None:
+            return
+        pending = []
+        i = self._index[block_id]
+        while i != _NONE and self._states[i] is not None:
+            pending.append(i)
+            i = self._parent[i]
+        for i in reversed(pending):
+            self._store.put(self._ids[i], self._states[i])
+            if self._ids[i] == block_id:
+                self._state_cache.put(block_id, self._states[i])
+            self._states[i] = None
+
+    def in_memory(self, block_id: "Hash") -> bool:
+        """
+        Returns True if the state of the block is held by the tree rather than by the store.
+        """
+        return self._states[self._index[block_id]] is not None
+
+    def prune_forks(self, block_id: "Hash", ancestor_id: "Hash") -> list["Hash"]:
+        """
+        Removes every block branching off the chain from `ancestor_id` (an ancestor of
+        `block_id`) to `block_id`, and returns the IDs of the removed blocks.
+
+        The cost is proportional to the length of that chain and the number of blocks removed.
+        """
+        removed = []
+        i = self._index[block_id]
+        ancestor = self._index[ancestor_id]
+        while i != ancestor:
+            parent = self._parent[i]
+            for sibling in self._children(parent):
+                if sibling != i:
+                    removed.extend(self._remove_subtree(sibling))
+            self._first_child[parent] = i
+            self._next_sibling[i] = _NONE
+            i = parent
+        return removed
+
+    def _remove_subtree(self, root: int) -> list["Hash"]:
+        removed = []
+        stack = [root]
+        while stack:
+            i = stack.pop()
+            stack.extend(self._children(i))
+            removed.append(self._ids[i])
+            self._release(i)
+        return removed
+
+    def _unindex_slot(self, i: int):
+        slot = self._slot[i]
+        bucket = self._slot_buckets[slot]
+        del bucket[self._bucket_position(bucket, i)]
+        self._slot_version += 1
+
+    @staticmethod
+    def _bucket_position(bucket: list[tuple[int, int]], i: int) -> int:
+        return next(pos for pos, (_, block) in enumerate(bucket) if block == i)
+
+    def blocks_by_slot(
+        self,
+        from_slot: int,
+        to_slot: int | None = None,
+        limit: int | None = None,
+        after: "Hash | None" = None,
+    ) -> Iterator["BlockHeader"]:
+        """
+        Streams the blocks with `from_slot <= slot < to_slot` in order of slot, and
+        blocks of the same slot in insertion order.
+
+        At most `limit` blocks are returned. To fetch the next page, pass the slot and
+        the ID of the last block returned as `from_slot` and `after`.
+
+        Changes to the tree between two blocks are picked up by the stream.
+        """
+        keys, buckets = self._slot_keys, self._slot_buckets
+        k, pos = self._seek(from_slot, after)
+        version = self._slot_version
+        count = 0
+        while (
+            k < len(keys)
+            and (to_slot is None or keys[k] < to_slot)
+            and (limit is None or count < limit)
+        ):
+            slot = keys[k]
+            bucket = buckets[slot]
+            if pos >= len(bucket):
+                k, pos = k + 1, 0
+                continue
+            seq, i = bucket[pos]
+            yield self._block(i)
+            count += 1
+            if version == self._slot_version:
+                pos += 1
+                continue
+            # The index changed while the stream was suspended: resume right after the
+            # position of the block last returned, even if it has since been removed.
+            # Slots are never removed from the index, so `slot` is still found.
+            version = self._slot_version
+            k = bisect_left(keys, slot)
+            pos = bisect_right(buckets[slot], seq, key=lambda entry: entry[0])
+
+    def _seek(self, slot: int, after: "Hash | None") -> tuple[int, int]:
+        # Returns the position of the first block of `slot`, or the position right
+        # after the block `after` if it is still indexed at that slot, as the position
+        # of the slot in the index and the position in its bucket.
+        k = bisect_left(self._slot_keys, slot)
+        if (i := self._index.get(after)) is not None and self._slot[i] == slot:
+            return k, self._bucket_position(self._slot_buckets[slot], i) + 1
+        return k, 0
@@ -0,0 +1,247 @@
+"""
+Parsing of block headers encoded with the 'HEADER' rule of 'messages.abnf',
+as produced by `BlockHeader.encode`.
+
+Parsed headers are views over the encoded buffer: fields are read from it on access
+and the header ID is hashed straight from it, so a stream of headers can be split,
+identified and forwarded or stored without copying it.
+"""
+
+import struct
+from collections.abc import Iterable, Iterator, Mapping
+
+from cryptarchia.cryptarchia import BlockHeader, Hash, MockLeaderProof, Note, Slot
+
+VERSION = 1
+
+# Offsets of the fields of a header, after the version byte
+_CONTENT_SIZE = 1
+_CONTENT_ID = _CONTENT_SIZE + 4
+_SLOT = _CONTENT_ID + 32
+_PARENT = _SLOT + 8
+_COMMITMENT = _PARENT + 32
+_NULLIFIER = _COMMITMENT + 32
+_EVOLVE_COMMITMENT = _NULLIFIER + 32
+_ORPHAN_PROOF_CNT = _EVOLVE_COMMITMENT + 32
+_ORPHAN_PROOFS = _ORPHAN_PROOF_CNT + 4
+
+# Size of a header without orphan proofs, which is the case of every header encoded here
+HEADER_SIZE = _ORPHAN_PROOFS
+
+# value, sk, nonce, unit, state, zone ID
+_NOTE = struct.Struct(">32s32s32s32s32s32s")
+NOTE_SIZE = _NOTE.size
+
+
+class DecodeError(Exception):
+    pass
+
+
+class HeaderView:
+    """
+    A block header encoded with the 'HEADER' rule, read in place from a buffer.
+    """
+
+    __slots__ = ("buf", "_id")
+
+    def __init__(self, buf: memoryview):
+        self.buf = buf
+        self._id: Hash | None = None
+
+    def _u32(self, offset: int) -> int:
+        return int.from_bytes(self.buf[offset : offset + 4], "big")
+
+    def _hash(self, offset: int) -> Hash:
+        return Hash.from_digest(self.buf[offset : offset + 32].tobytes())
+
+    @property
+    def content_size(self) -> int:
+        return self._u32(_CONTENT_SIZE)
+
+    @property
+    def content_id(self) -> Hash:
+        return self._hash(_CONTENT_ID)
+
+    @property
+    def slot(self) -> Slot:
+        return Slot(int.from_bytes(self.buf[_SLOT:_PARENT], "big"))
+
+    @property
+    def parent(self) -> Hash:
+        return self._hash(_PARENT)
+
+    @property
+    def commitment(self) -> Hash:
+        return self._hash(_COMMITMENT)
+
+    @property
+    def nullifier(self) -> Hash:
+        return self._hash(_NULLIFIER)
+
+    @property
+    def evolve_commitment(self) -> Hash:
+        return self._hash(_EVOLVE_COMMITMENT)
+
+    def orphan_proofs(self) -> list["HeaderView"]:
+        views, _ = _split_orphan_proofs(self.buf, 0)
+        return views
+
+    def id(self) -> Hash:
+        if self._id is None:
+            self._id = Hash(b"BLOCK_ID", self.buf)
+        return self._id
+
+    def header(self, notes: Mapping[Hash, Note]) -> BlockHeader:
+        """
+        Builds the `BlockHeader`, given the notes that may have led the block, by commitment.
+
+        The mock leader proof only carries the commitment and nullifier of its note,
+        while `MockLeaderProof` needs the note itself.
+
+        Raises: DecodeError if the note is unknown or does not match the proof
+        """
+        note = notes.get(self.commitment)
+        if note is None or note.nullifier() != self.nullifier:
+            raise DecodeError("Unknown leader note")
+        if self.evolve_commitment != self.commitment or self.buf[
+            _ORPHAN_PROOF_CNT:_ORPHAN_PROOFS
+        ] != bytes(4):
+            raise DecodeError("Header cannot be represented as a BlockHeader")
+        slot = self.slot
+        parent = self.parent
+        header = BlockHeader(
+            slot=slot,
+            parent=parent,
+            content_size=self.content_size,
+            content_id=self.content_id,
+            leader_proof=MockLeaderProof(note, slot, parent),
+        )
+        # The header encodes back to the same bytes, so its encoding and ID are known.
+        header.__dict__["_encoded"] = bytes(self)
+        header.__dict__["_id"] = self.id()
+        return header
+
+    def __bytes__(self) -> bytes:
+        return self.buf.tobytes()
+
+    def __len__(self) -> int:
+        return len(self.buf)
+
+
+def _orphan_proof_count(buf: memoryview, start: int) -> int:
+    # Checks the fixed part of the header starting at `start`, and returns the number
+    # of orphan proofs following it.
+    if len(buf) < start + HEADER_SIZE:
+        raise DecodeError("Truncated header")
+    if buf[start] != VERSION:
+        raise DecodeError(f"Unsupported header version: {buf[start]}")
+    return int.from_bytes(buf[start + _ORPHAN_PROOF_CNT : start + _ORPHAN_PROOFS], "big")
+
+
+def _header_end(buf: memoryview, start: int) -> int:
+    # Returns the end of the header starting at `start`. Orphan proofs are headers
+    # themselves, so they may nest: they are walked with an explicit stack of the
+    # number of headers left at each level, which crafted input cannot overflow.
+    end = start
+    pending = [1]
+    while pending:
+        if pending[-1] == 0:
+            pending.pop()
+            continue
+        pending[-1] -= 1
+        count = _orphan_proof_count(buf, end)
+        end += HEADER_SIZE
+        pending.append(count)
+    return end
+
+
+def _split_orphan_proofs(buf: memoryview, start: int) -> tuple[list[HeaderView], int]:
+    # Parses the orphan proofs of the header starting at `start`,
+    # and returns them along with the end of that header.
+    count = _orphan_proof_count(buf, start)
+    end = start + HEADER_SIZE
+    views = []
+    for _ in range(count):
+        view = _header_at(buf, end)
+        views.append(view)
+        end += len(view)
+    return views, end
+
+
+def _header_at(buf: memoryview, start: int) -> HeaderView:
+    if (
+        len(buf) >= start + HEADER_SIZE
+        and buf[start] == VERSION
+        and buf[start + _ORPHAN_PROOF_CNT : start + _ORPHAN_PROOFS] == bytes(4)
+    ):
+        # the common case: no orphan proofs
+        return HeaderView(buf[start : start + HEADER_SIZE])
+    return HeaderView(buf[start : _header_end(buf, start)])
+
+
+def decode_header(buf: bytes | memoryview) -> HeaderView:
+    """
+    Parses a single encoded header, which must span the whole buffer.
+
+    Raises: DecodeError if the buffer is not a valid encoded header
+    """
+    view = _header_at(memoryview(buf), 0)
+    if len(view) != len(buf):
+        raise DecodeError("Trailing bytes after header")
+    return view
+
+
+def decode_headers(buf: bytes | memoryview) -> Iterator[HeaderView]:
+    """
+    Splits a stream of concatenated encoded headers, without copying it.
+
+    Raises: DecodeError if the stream does not consist of valid encoded headers
+    """
+    buf = memoryview(buf)
+    start = 0
+    while start < len(buf):
+        view = _header_at(buf, start)
+        yield view
+        start += len(view)
+
+
+def encode_headers(headers: Iterable[BlockHeader]) -> bytes:
+    """
+    Encodes headers into a single stream, which `decode_headers` splits back.
+    """
+    return b"".join(header.encode() for header in headers)
+
+
+def encode_note(note: Note) -> bytes:
+    """
+    Encodes a note, including its secret key, in `NOTE_SIZE` bytes.
+
+    Headers only carry the commitment of their leader note: the note itself is stored
+    alongside them to rebuild the `BlockHeader`, see `HeaderView.header`.
+    """
+    return _NOTE.pack(
+        int.to_bytes(note.value, length=32, byteorder="big"),
+        note.encode_sk(),
+        note.nonce,
+        note.unit,
+        note.state,
+        note.zone_id,
+    )
+
+
+def decode_note(buf: bytes | memoryview, offset: int = 0) -> Note:
+    """
+    Raises: DecodeError if the buffer is too short
+    """
+    try:
+        value, sk, nonce, unit, state, zone_id = _NOTE.unpack_from(buf, offset)
+    except struct.error as e:
+        raise DecodeError("Truncated note") from e
+    return Note(
+        value=int.from_bytes(value, "big"),
+        sk=int.from_bytes(sk, "big"),
+        nonce=Hash.from_digest(nonce),
+        unit=Hash.from_digest(unit),
+        state=Hash.from_digest(state),
+        zone_id=Hash.from_digest(zone_id),
+    )
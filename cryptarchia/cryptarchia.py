@@ -1,16 +1,20 @@
 import functools
-from itertools import islice
 import logging
-from collections import defaultdict
-from copy import deepcopy
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Executor
 from dataclasses import dataclass, field, replace
 from hashlib import blake2b, sha256
+from decimal import Decimal, localcontext
 from math import floor
-from typing import Dict, Generator, List, TypeAlias
+from typing import Callable, Dict, Generator, Iterable, List, TypeAlias
 from enum import Enum
 
 import numpy as np
 
+from cryptarchia.block_tree import BlockTree
+from cryptarchia.persistent import PersistentSet
+from cryptarchia.store import BlockStore
+
 logger = logging.getLogger(__name__)
 
 
@@ -25,9 +29,20 @@ class Hash(bytes):
             h.update(d)
         return super().__new__(cls, h.digest())
 
+    @classmethod
+    def from_digest(cls, digest: bytes) -> "Hash":
+        """
+        Wraps an existing digest, e.g. one read back from storage, without hashing it again.
+        """
+        assert len(digest) == 32
+        return bytes.__new__(cls, digest)
+
     def __deepcopy__(self, memo):
         return self
 
+    def __reduce__(self):
+        return (Hash.from_digest, (bytes(self),))
+
 
 @dataclass(frozen=True)
 class Epoch:
@@ -69,6 +84,9 @@ class Config:
 
     time: TimeConfig
 
+    # Whether followers check that block leaders won the slot lottery
+    verify_lottery: bool = False
+
     @staticmethod
     def cryptarchia_v0_0_1(initial_total_active_stake) -> "Config":
         return Config(
@@ -115,7 +133,7 @@ class Config:
 
 
 # An absolute unique indentifier of a slot, counting incrementally from 0
-@dataclass
+@dataclass(frozen=True)
 @functools.total_ordering
 class Slot:
     absolute_slot: int
@@ -140,7 +158,9 @@ class Slot:
         return hash(self.absolute_slot)
 
 
-@dataclass
+# Notes are immutable values: their commitment and nullifier are computed once,
+# on first use.
+@dataclass(frozen=True)
 class Note:
     value: int
     sk: int  # TODO: rename to nf_sk
@@ -163,6 +183,13 @@ class Note:
         return int.to_bytes(self.pk, length=32, byteorder="big")
 
     def commitment(self) -> Hash:
+        return self._commitment
+
+    def nullifier(self) -> Hash:
+        return self._nullifier
+
+    @functools.cached_property
+    def _commitment(self) -> Hash:
         value_bytes = int.to_bytes(self.value, length=32, byteorder="big")
         return Hash(
             b"NOMOS_NOTE_CM",
@@ -174,17 +201,22 @@ class Note:
             self.zone_id,
         )
 
-    def nullifier(self) -> Hash:
+    @functools.cached_property
+    def _nullifier(self) -> Hash:
         return Hash(b"NOMOS_NOTE_NF", self.commitment(), self.encode_sk())
 
 
-@dataclass
+@dataclass(frozen=True)
 class MockLeaderProof:
     note: Note
     slot: Slot
     parent: Hash
 
     def epoch_nonce_contribution(self) -> Hash:
+        return self._epoch_nonce_contribution
+
+    @functools.cached_property
+    def _epoch_nonce_contribution(self) -> Hash:
         return Hash(
             b"NOMOS_NONCE_CONTRIB",
             self.slot.encode(),
@@ -193,18 +225,34 @@ class MockLeaderProof:
         )
 
     def verify(
-        self, slot: Slot, parent: Hash, commitments: set[Hash], nullifiers: set[Hash]
+        self,
+        slot: Slot,
+        parent: Hash,
+        commitments: set[Hash],
+        nullifiers: set[Hash],
+        epoch: "EpochState | None" = None,
+        active_slot_coeff: float | None = None,
     ):
-        # TODO: verify slot lottery
+        # The slot lottery is verified when the epoch state and the active slot
+        # coefficient are given.
         return (
             slot == self.slot
             and parent == self.parent
             and self.note.commitment() in commitments
             and self.note.nullifier() not in nullifiers
+            and (
+                epoch is None
+                or lottery_ticket(epoch.nonce(), self.slot, self.note)
+                < lottery_threshold(
+                    active_slot_coeff, self.note.value, epoch.total_active_stake()
+                )
+            )
         )
 
 
-@dataclass
+# Headers are immutable values: their ID and encoding are computed once, on first
+# use, and reused by every later lookup.
+@dataclass(frozen=True)
 class BlockHeader:
     slot: Slot
     parent: Hash
@@ -212,23 +260,44 @@ class BlockHeader:
     content_id: Hash
     leader_proof: MockLeaderProof
 
+    def id(self) -> Hash:
+        return self._id
+
+    def encode(self) -> bytes:
+        """
+        Serializes the header in the format specified by the 'HEADER' rule in 'messages.abnf'.
+        See `cryptarchia.codec` to parse it back.
+        """
+        return self._encoded
+
+    @functools.cached_property
+    def _encoded(self) -> bytes:
+        note = self.leader_proof.note
+        return b"".join(
+            (
+                b"\x01",  # version
+                int.to_bytes(self.content_size, length=4, byteorder="big"),  # content size
+                self.content_id,  # content id
+                self.slot.encode(),  # slot
+                self.parent,  # parent
+                # mock leader proof
+                note.commitment(),
+                note.nullifier(),
+                # notes are not evolved by this spec, so the leader keeps the same note
+                note.commitment(),
+                # orphan proofs
+                int.to_bytes(0, length=4, byteorder="big"),
+            )
+        )
+
     # **Attention**:
     # The ID of a block header is defined as the hash of its fields
     # as serialized in the format specified by the 'HEADER' rule in 'messages.abnf'.
     #
     # The following code is to be considered as a reference implementation, mostly to be used for testing.
-    def id(self) -> Hash:
-        return Hash(
-            b"BLOCK_ID",
-            b"\x01",  # version
-            int.to_bytes(self.content_size, length=4, byteorder="big"),  # content size
-            self.content_id,  # content id
-            self.slot.encode(),  # slot
-            self.parent,  # parent
-            # leader proof
-            self.leader_proof.epoch_nonce_contribution(),
-            # self.leader_proof -- the proof itself needs to be include in the hash
-        )
+    @functools.cached_property
+    def _id(self) -> Hash:
+        return Hash(b"BLOCK_ID", self.encode())
 
     def __hash__(self):
         return hash(self.id())
@@ -248,22 +317,30 @@ class LedgerState:
     nonce: Hash = None
 
     # set of note commitments
-    commitments: set[Hash] = field(default_factory=set)
+    commitments: PersistentSet = field(default_factory=PersistentSet)
 
     # set of nullified notes
-    nullifiers: set[Hash] = field(default_factory=set)
+    nullifiers: PersistentSet = field(default_factory=PersistentSet)
 
     # -- Stake Relativization State
     # The number of observed leaders, this measurement is
     # used in inferring total active stake in the network.
     leader_count: int = 0
 
+    def __post_init__(self):
+        # Note sets are persistent so that copying a state is O(1) and states
+        # derived from one another share all but the notes they differ in.
+        if not isinstance(self.commitments, PersistentSet):
+            self.commitments = PersistentSet(self.commitments)
+        if not isinstance(self.nullifiers, PersistentSet):
+            self.nullifiers = PersistentSet(self.nullifiers)
+
     def copy(self):
         return LedgerState(
             block=self.block,
             nonce=self.nonce,
-            commitments=deepcopy(self.commitments),
-            nullifiers=deepcopy(self.nullifiers),
+            commitments=self.commitments.copy(),
+            nullifiers=self.nullifiers.copy(),
             leader_count=self.leader_count,
         )
 
@@ -309,20 +386,161 @@ class EpochState:
     def nonce(self) -> bytes:
         return self.nonce_snapshot.nonce
 
+
+class EpochStateCache:
+    """
+    Memo of epoch states, keyed by epoch and nonce snapshot block ID.
+
+    Once it holds `max_size` entries, the least recently used entry is evicted.
+    Hit, miss and eviction counters help size it.
+
+    Pinned entries are never evicted for lack of space: a follower booted from a
+    snapshot pins the epoch states it cannot recompute, because their snapshots
+    precede the blocks it holds.
+    """
+
+    def __init__(self, max_size: int | None = None):
+        assert max_size is None or max_size > 0
+        self.max_size = max_size
+        self.entries: OrderedDict[tuple[Epoch, Hash], EpochState] = OrderedDict()
+        self.pinned: dict[tuple[Epoch, Hash], EpochState] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: tuple[Epoch, Hash]) -> EpochState | None:
+        state = self.pinned.get(key)
+        if state is None:
+            state = self.entries.get(key)
+            if state is not None:
+                self.entries.move_to_end(key)
+        if state is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return state
+
+    def pin(self, key: tuple[Epoch, Hash], state: EpochState):
+        self.pinned[key] = state
+
+    def __setitem__(self, key: tuple[Epoch, Hash], state: EpochState):
+        self.entries[key] = state
+        self.entries.move_to_end(key)
+        if self.max_size is not None and len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def __contains__(self, key) -> bool:
+        return key in self.entries or key in self.pinned
+
+    def __len__(self) -> int:
+        return len(self.entries) + len(self.pinned)
+
+    def items(self):
+        yield from self.pinned.items()
+        yield from self.entries.items()
+
+    def evict_unreachable(self, lib_epoch: Epoch, states: BlockTree):
+        """
+        Evicts the entries that blocks descending from the LIB can no longer query:
+        those of epochs before the epoch of the LIB, and those whose snapshot block
+        was pruned.
+        """
+        for key in [
+            (epoch, block_id)
+            for epoch, block_id in self.entries
+            if epoch.epoch < lib_epoch.epoch or block_id not in states
+        ]:
+            del self.entries[key]
+            self.evictions += 1
+        # pinned snapshots are not in the block tree to begin with
+        for key in [key for key in self.pinned if key[0].epoch < lib_epoch.epoch]:
+            del self.pinned[key]
+            self.evictions += 1
+
+
+# Number of blocks listed one by one at the start of a block locator
+LOCATOR_DENSE_BLOCKS = 10
+
+
 class State(Enum):
     ONLINE = 1
     BOOTSTRAPPING = 2
 
+
+@dataclass(frozen=True)
+class TipChanged:
+    """
+    Emitted by a follower whenever its local chain changes, describing how to go from
+    the previous tip to the new one: roll back `reverted`, from the previous tip down
+    to (excluding) `common_ancestor`, then apply `applied`, in chain order up to the new tip.
+
+    A plain extension of the local chain has no reverted blocks.
+    """
+
+    common_ancestor: Hash
+    reverted: list["BlockHeader"]
+    applied: list["BlockHeader"]
+
+
 class Follower:
-    def __init__(self, genesis_state: LedgerState, config: Config):
+    def __init__(
+        self,
+        genesis_state: LedgerState,
+        config: Config,
+        epoch_state_cache_size: int | None = None,
+        store: BlockStore | None = None,
+    ):
         self.config = config
         self.forks: list[Hash] = []
         self.local_chain = genesis_state.block.id()
-        self.genesis_state = genesis_state
-        self.ledger_state = {genesis_state.block.id(): genesis_state.copy()}
-        self.epoch_state = {}
+        self.genesis_id = genesis_state.block.id()
+        # With a store, immutable states are moved to it as the LIB advances,
+        # and only the states of the blocks after the LIB stay in memory.
+        self.ledger_state = BlockTree(
+            {genesis_state.block.id(): genesis_state.copy()}, store=store
+        )
+        self.epoch_state = EpochStateCache(epoch_state_cache_size)
         self.state = State.BOOTSTRAPPING
         self.lib = genesis_state.block.id()  # Last immutable block, initially the genesis block
+        # States of immutable blocks older than the root of the block tree, in chain order.
+        # Empty unless booted from a snapshot, where the tree starts at the LIB and these
+        # hold the genesis state and the epoch snapshots that precede the LIB.
+        self.anchor_states: list[LedgerState] = []
+        self.tip_listeners: list[Callable[[TipChanged], None]] = []
+
+    def subscribe(self, listener: Callable[[TipChanged], None]):
+        """
+        Registers a listener called with a `TipChanged` event every time the local
+        chain changes, before the LIB advances past the blocks it reverts.
+        """
+        self.tip_listeners.append(listener)
+
+    @staticmethod
+    def from_snapshot(path: str, config: Config, **kwargs) -> "Follower":
+        """
+        Boots a follower from a snapshot written by `export_snapshot`.
+        Extra keyword arguments are passed to the constructor.
+        """
+        from cryptarchia.snapshot import read_snapshot
+
+        return read_snapshot(path, config, **kwargs)
+
+    def export_snapshot(self, path: str):
+        """
+        Writes the LIB state, the block tree above it and the epoch states needed to
+        keep validating blocks to a file, from which `from_snapshot` boots a follower
+        without replaying the chain.
+        """
+        from cryptarchia.snapshot import write_snapshot
+
+        write_snapshot(self, path)
+
+    @property
+    def genesis_state(self) -> LedgerState:
+        if self.genesis_id in self.ledger_state:
+            return self.ledger_state[self.genesis_id]
+        return self.anchor_states[0]
 
     def to_online(self):
         """
@@ -339,10 +557,15 @@ class Follower:
         if block.parent not in self.ledger_state:
             raise ParentNotFound
 
-        if  height(block.parent, self.ledger_state) < height(self.lib, self.ledger_state):
+        if self.ledger_state.height(block.parent) < self.ledger_state.height(self.lib):
             # If the block is not a descendant of the last immutable block, we cannot process it.
             raise ImmutableFork
 
+        if block.slot < self.ledger_state[block.parent].block.slot:
+            # Slots never decrease along a chain, which the block tree relies on
+            # to search chains by slot.
+            raise InvalidSlot
+
         current_state = self.ledger_state[block.parent].copy()
 
         epoch_state = self.compute_epoch_state(
@@ -355,6 +578,8 @@ class Follower:
             block.parent,
             epoch_state.stake_distribution_snapshot.commitments,
             current_state.nullifiers,
+            epoch_state if self.config.verify_lottery else None,
+            self.config.active_slot_coeff,
         ):
             raise InvalidLeaderProof
 
@@ -365,6 +590,67 @@ class Follower:
 
         self.validate_header(block)
 
+        old_tip = self.local_chain
+        self._settle(self._apply_block(block), old_tip)
+
+    def on_blocks(
+        self, blocks: Iterable[BlockHeader]
+    ) -> list[tuple[BlockHeader, Exception]]:
+        """
+        Validates and applies a batch of blocks, in order, running the fork choice rule
+        and LIB pruning once per run of consecutive blocks of one chain, instead of after
+        every block.
+
+        Invalid blocks are skipped, and returned along with the error raised by their
+        validation, so a failure does not prevent the rest of the batch from being applied.
+
+        The resulting tip, forks and block tree, as well as the blocks rejected, are the
+        same as when calling `on_block` on each block in turn: within a run, a chain only
+        becomes more preferable to the fork choice rule as it grows, so checking it once at
+        the end of the run reaches the same decision, and the LIB only moves along with
+        the local chain. The fork choice rule and the LIB are settled before moving on to
+        another branch, whose blocks may depend on them to be validated.
+
+        Listeners are notified once per run that changes the local chain.
+        """
+        old_tip = self.local_chain
+        rejected = []
+        forked = False
+        previous = None
+        for block in blocks:
+            if block.id() in self.ledger_state:
+                logger.warning("dropping already processed block")
+                continue
+            if previous is not None and block.parent != previous:
+                # The batch moves on to another branch.
+                self._settle(forked, old_tip)
+                forked = False
+                old_tip = self.local_chain
+            previous = block.id()
+            try:
+                self.validate_header(block)
+            except Exception as e:
+                rejected.append((block, e))
+                continue
+            forked |= self._apply_block(block)
+
+        self._settle(forked, old_tip)
+        return rejected
+
+    # Runs the fork choice rule if a block was added to a fork, notifies listeners of
+    # any change of the local chain since `old_tip`, and updates the LIB.
+    def _settle(self, forked: bool, old_tip: Hash):
+        if forked:
+            # We may need to switch forks, lets run the fork choice rule to check.
+            self._switch_to_fork_choice()
+        self._notify_tip_change(old_tip)
+        if self.state == State.ONLINE:
+            self.update_lib()
+
+    # Stores the state of a validated block and updates the tips it extends.
+    # Returns True if the block is on a fork, in which case the fork choice
+    # rule has to be run again.
+    def _apply_block(self, block: BlockHeader) -> bool:
         new_state = self.ledger_state[block.parent].copy()
         new_state.apply(block)
         self.ledger_state[block.id()] = new_state
@@ -372,23 +658,34 @@ class Follower:
         if block.parent == self.local_chain:
             # simply extending the local chain
             self.local_chain = block.id()
-        else:
-            # otherwise, this block creates a fork
-            self.forks.append(block.id())
+            return False
 
-            # remove any existing fork that is superceded by this block
-            if block.parent in self.forks:
-                self.forks.remove(block.parent)
+        # otherwise, this block creates a fork
+        self.forks.append(block.id())
 
-            # We may need to switch forks, lets run the fork choice rule to check.
-            new_tip = self.fork_choice()
-            self.forks.append(self.local_chain)
-            self.forks.remove(new_tip)
-            self.local_chain = new_tip
+        # remove any existing fork that is superceded by this block
+        if block.parent in self.forks:
+            self.forks.remove(block.parent)
+        return True
 
-        if self.state == State.ONLINE:
-            self.update_lib()
+    def _switch_to_fork_choice(self):
+        new_tip = self.fork_choice()
+        self.forks.append(self.local_chain)
+        self.forks.remove(new_tip)
+        self.local_chain = new_tip
 
+    def _notify_tip_change(self, old_tip: Hash):
+        if old_tip == self.local_chain or not self.tip_listeners:
+            return
+        tree = self.ledger_state
+        common_ancestor = tree.lca(old_tip, self.local_chain)
+        event = TipChanged(
+            common_ancestor,
+            reverted=tree.chain(old_tip, common_ancestor)[:0:-1],
+            applied=tree.chain(self.local_chain, common_ancestor)[1:],
+        )
+        for listener in self.tip_listeners:
+            listener(event)
 
     # Update the lib, and prune forks that do not descend from it.
     def update_lib(self):
@@ -399,17 +696,26 @@ class Follower:
         """
         if self.state != State.ONLINE:
             return
-        # prune forks that do not descend from the last immutable block, this is needed to avoid Genesis rule to roll back
-        # past the LIB
-        self.lib = next(islice(iter_chain(self.local_chain, self.ledger_state), self.config.k, None), self.genesis_state).block.id()
-        self.forks = [
-            f for f in self.forks if is_ancestor(self.lib, f, self.ledger_state)
-        ]
-        self.ledger_state = {
-            k: v
-            for k, v in self.ledger_state.items()
-            if is_ancestor(self.lib, k, self.ledger_state) or is_ancestor(k, self.lib, self.ledger_state)
-        }
+        lib = self.ledger_state.ancestor(self.local_chain, self.config.k)
+        if lib != self.lib and self.ledger_state.is_ancestor(self.lib, lib):
+            # prune forks that do not descend from the last immutable block, this is needed to avoid Genesis rule to roll back
+            # past the LIB.
+            # Every block in the tree is either an ancestor or a descendant of the previous LIB,
+            # so only the branches forking off the chain between the previous and the new LIB need to go.
+            self.ledger_state.prune_forks(lib, self.lib)
+            self.forks = [
+                f
+                for f in self.forks
+                if f in self.ledger_state and self.ledger_state.is_ancestor(lib, f)
+            ]
+            # Blocks yet to be validated descend from the LIB, so they never query an epoch
+            # before the LIB's, nor a snapshot off the LIB's chain.
+            self.epoch_state.evict_unreachable(
+                self.ledger_state[lib].block.slot.epoch(self.config), self.ledger_state
+            )
+            # Immutable blocks are now on a single chain, which the store can hold.
+            self.ledger_state.persist(lib)
+        self.lib = lib
 
 
     # Evaluate the fork choice rule and return the chain we should be following
@@ -442,7 +748,14 @@ class Follower:
         return self.ledger_state[self.tip_id()]
 
     def state_at_slot_beginning(self, tip: Hash, slot: Slot) -> LedgerState:
-        for state in iter_chain(tip, self.ledger_state):
+        # The state of the last block strictly before `slot` on the chain ending at `tip`,
+        # found in O(log n) through the block tree's skip pointers.
+        block_id = self.ledger_state.last_before_slot(tip, slot.absolute_slot)
+        if block_id is not None:
+            return self.ledger_state[block_id]
+        # The whole chain in the tree is at or after `slot`, so the state is older than
+        # the root of the tree.
+        for state in reversed(self.anchor_states):
             if state.block.slot < slot:
                 return state
         return self.genesis_state
@@ -473,18 +786,33 @@ class Follower:
                 inferred_total_active_stake=self.config.initial_total_active_stake,
             )
 
-        stake_distribution_snapshot = self.stake_distribution_snapshot(epoch, tip)
+        if tip not in self.ledger_state:
+            # `tip` precedes the block tree, like the anchor states of a follower booted
+            # from a snapshot: the chain leading to it is unknown.
+            raise MissingEpochState(epoch)
+
         nonce_snapshot = self.nonce_snapshot(epoch, tip)
 
-        # we memoize epoch states to avoid recursion killing our performance
+        # we memoize epoch states to avoid recursion killing our performance.
+        # The epoch state only depends on the chain up to the nonce snapshot, so all
+        # forks sharing that block share the memoized state.
         memo_block_id = nonce_snapshot.block.id()
         if state := self.epoch_state.get((epoch, memo_block_id)):
             return state
+        if memo_block_id not in self.ledger_state:
+            # the snapshots precede the block tree and the state was not pinned for them
+            raise MissingEpochState(epoch)
+
+        # Every other snapshot of this and earlier epochs precedes the nonce snapshot,
+        # so the remaining lookups start from it rather than from the tip.
+        stake_distribution_snapshot = self.stake_distribution_snapshot(
+            epoch, memo_block_id
+        )
 
         # To update our inference of total stake, we need the prior estimate which
         # was calculated last epoch. Thus we recurse here to retreive the previous
         # estimate of total stake.
-        prev_epoch = self.compute_epoch_state(epoch.prev(), tip)
+        prev_epoch = self.compute_epoch_state(epoch.prev(), memo_block_id)
         inferred_total_active_stake = self._infer_total_active_stake(
             prev_epoch, nonce_snapshot, stake_distribution_snapshot
         )
@@ -523,16 +851,124 @@ class Follower:
         )
         return int(prev_epoch.inferred_total_active_stake - h * blocks_per_slot_err)
 
-    def blocks_by_slot(self, from_slot: Slot) -> Generator[BlockHeader, None, None]:
-        # Returns blocks in the given range of slots in order of slot
-        # NOTE: In real implementation, this should be done by optimized data structures.
-        blocks_by_slot: dict[Slot, list[BlockHeader]] = defaultdict(list)
-        for state in self.ledger_state.values():
-            if from_slot <= state.block.slot:
-                blocks_by_slot[state.block.slot].append(state.block)
-        for slot in sorted(blocks_by_slot.keys()):
-            for block in blocks_by_slot[slot]:
-                yield block
+    def blocks_by_slot(
+        self,
+        from_slot: Slot,
+        to_slot: Slot | None = None,
+        limit: int | None = None,
+        after: Hash | None = None,
+    ) -> Generator[BlockHeader, None, None]:
+        # Returns blocks in the given range of slots [from_slot, to_slot) in order of slot,
+        # served from the slot index of the block tree.
+        # At most `limit` blocks are returned: the next page is requested from the slot
+        # of the last block received, `after` that block.
+        yield from self.ledger_state.blocks_by_slot(
+            from_slot.absolute_slot,
+            None if to_slot is None else to_slot.absolute_slot,
+            limit,
+            after,
+        )
+
+    def block_locator(self, tip: Hash | None = None) -> list[Hash]:
+        # Returns the IDs of blocks on the chain ending at `tip` (the local chain by default),
+        # from the tip back to the root of the block tree: the last blocks one by one, then
+        # with steps doubling in size, so that the list holds O(log n) IDs.
+        # A peer finds where its chains fork off this one from the list alone.
+        tip = self.local_chain if tip is None else tip
+        height = self.ledger_state.height(tip)
+        locator = []
+        depth = 0
+        step = 1
+        while depth < height:
+            locator.append(self.ledger_state.ancestor(tip, depth))
+            if len(locator) >= LOCATOR_DENSE_BLOCKS:
+                step *= 2
+            depth += step
+        locator.append(self.ledger_state.ancestor(tip, height))
+        return locator
+
+    def blocks_after_locator(
+        self, locator: list[Hash], tip: Hash, limit: int | None = None
+    ) -> list[BlockHeader] | None:
+        # Serves a block locator: finds the first block of `locator` on the chain ending
+        # at `tip`, which is where that chain forks off the requester's chain, and returns
+        # the blocks after it on the chain, up to `tip` and in chain order.
+        # At most `limit` blocks are returned: the next page is requested with the last
+        # block received as the locator.
+        # Returns None if `tip` is unknown, or if no block of the locator is on its chain.
+        tree = self.ledger_state
+        if tip not in tree:
+            return None
+        fork_point = next((b for b in locator if tree.is_ancestor(b, tip)), None)
+        if fork_point is None:
+            return None
+        end = tip
+        if limit is not None:
+            depth = tree.height(tip) - tree.height(fork_point) - limit
+            end = tree.ancestor(tip, max(depth, 0))
+        return tree.chain(end, fork_point)[1:]
+
+
+def prevalidate_header(block: BlockHeader) -> BlockHeader:
+    """
+    Runs the checks of `Follower.validate_header` that do not depend on any ledger
+    state, and computes the hashes that validating and applying the block need, which
+    the header and its leader note cache. Returns the header.
+
+    Raises: InvalidLeaderProof if the proof is not for the slot and parent of the header
+    """
+    proof = block.leader_proof
+    if proof.slot != block.slot or proof.parent != block.parent:
+        raise InvalidLeaderProof
+    block.id()
+    proof.epoch_nonce_contribution()
+    proof.note.commitment()
+    proof.note.nullifier()
+    return block
+
+
+def _prevalidate_chunk(blocks: list[BlockHeader]) -> list[BlockHeader | Exception]:
+    results = []
+    for block in blocks:
+        try:
+            results.append(prevalidate_header(block))
+        except InvalidLeaderProof as e:
+            results.append(e)
+    return results
+
+
+def prevalidate_headers(
+    blocks: Iterable[BlockHeader],
+    executor: Executor | None = None,
+    chunk_size: int = 256,
+) -> tuple[list[BlockHeader], list[tuple[BlockHeader, Exception]]]:
+    """
+    Runs `prevalidate_header` on a batch of headers, in chunks of `chunk_size`
+    spread over `executor` if given, or in the calling thread otherwise.
+
+    Returns the headers that passed, in order and ready for `Follower.on_blocks`, and
+    the headers that failed along with their error. With a process pool, the headers
+    that passed come back as copies carrying the computed hashes.
+
+    Hashing only releases the GIL for large inputs, and headers are small, so a process
+    pool is needed to spread the work over several cores.
+    """
+    blocks = list(blocks)
+    chunks = [blocks[i : i + chunk_size] for i in range(0, len(blocks), chunk_size)]
+    if executor is None:
+        results = map(_prevalidate_chunk, chunks)
+    else:
+        results = executor.map(_prevalidate_chunk, chunks)
+
+    valid = []
+    rejected = []
+    for chunk, chunk_results in zip(chunks, results):
+        for block, result in zip(chunk, chunk_results):
+            if isinstance(result, Exception):
+                rejected.append((block, result))
+            else:
+                valid.append(result)
+    return valid, rejected
 
 
 def phi(f: float, alpha: float) -> float:
@@ -546,6 +982,65 @@ def phi(f: float, alpha: float) -> float:
     return 1 - (1 - f) ** alpha
 
 
+# Decimal digits used to evaluate the lottery threshold, well beyond the 78 digits of Hash.ORDER
+LOTTERY_THRESHOLD_PRECISION = 100
+
+
+@functools.lru_cache(maxsize=4096)
+def lottery_threshold(f: float, value: int, total_active_stake: int) -> int:
+    """
+    Returns the threshold below which a lottery ticket of a note of the given value wins,
+    i.e. Hash.ORDER * phi(f, value / total_active_stake) rounded up, since tickets are
+    integers uniform over [0, Hash.ORDER).
+
+    The threshold is evaluated in fixed point arithmetic rather than with floats, whose
+    53 bits of precision are far from enough to scale up to Hash.ORDER. Thresholds are
+    cached, so checking a ticket is a single integer comparison for the rest of the epoch.
+    """
+    with localcontext() as ctx:
+        ctx.prec = LOTTERY_THRESHOLD_PRECISION
+        alpha = Decimal(int(value)) / Decimal(int(total_active_stake))
+        # phi(f, alpha) = 1 - (1 - f) ** alpha
+        p = 1 - (alpha * (1 - Decimal(str(f))).ln()).exp()
+        return int((Hash.ORDER * p).to_integral_value(rounding="ROUND_CEILING"))
+
+
+class LotteryTickets:
+    """
+    Hashes the slot lottery tickets of an epoch.
+
+    A ticket is `H(b"LEAD" || epoch nonce || slot || note commitment || note sk)`, so
+    all tickets of an epoch share a hash prefix, as do all tickets of a slot: the
+    prefixes are hashed once and copied for each ticket.
+    """
+
+    def __init__(self, epoch_nonce: bytes):
+        self.prefix = sha256(b"LEAD")
+        self.prefix.update(epoch_nonce)
+
+    def slot_prefix(self, absolute_slot: int):
+        prefix = self.prefix.copy()
+        prefix.update(int.to_bytes(absolute_slot, length=8, byteorder="big"))
+        return prefix
+
+    @staticmethod
+    def note_suffix(note: Note) -> bytes:
+        return note.commitment() + note.encode_sk()
+
+    @staticmethod
+    def ticket(slot_prefix, note_suffix: bytes) -> int:
+        ticket = slot_prefix.copy()
+        ticket.update(note_suffix)
+        return int.from_bytes(ticket.digest())
+
+
+def lottery_ticket(epoch_nonce: bytes, slot: Slot, note: Note) -> int:
+    tickets = LotteryTickets(epoch_nonce)
+    return tickets.ticket(
+        tickets.slot_prefix(slot.absolute_slot), tickets.note_suffix(note)
+    )
+
+
 @dataclass
 class Leader:
     config: Config
@@ -557,19 +1052,108 @@ class Leader:
         if self._is_slot_leader(epoch, slot):
             return MockLeaderProof(self.note, slot, parent)
 
+    def compute_schedule(self, epoch: EpochState, slot_range: range) -> list[Slot]:
+        """
+        Returns, in order, the slots of `slot_range` (absolute slot numbers) in which this
+        leader wins the lottery of the given epoch.
+
+        The win threshold is computed once and the tickets of all slots are hashed from a
+        shared prefix, so a proposer can plan a whole epoch at its boundary and then check
+        each slot against the schedule in O(1).
+        """
+        threshold = lottery_threshold(
+            self.config.active_slot_coeff, self.note.value, epoch.total_active_stake()
+        )
+        tickets = LotteryTickets(epoch.nonce())
+        suffix = tickets.note_suffix(self.note)
+
+        schedule = []
+        for absolute_slot in sorted(slot_range):
+            ticket = tickets.ticket(tickets.slot_prefix(absolute_slot), suffix)
+            if ticket < threshold:
+                schedule.append(Slot(absolute_slot))
+        return schedule
+
     def _is_slot_leader(self, epoch: EpochState, slot: Slot):
-        relative_stake = self.note.value / epoch.total_active_stake()
+        ticket = lottery_ticket(epoch.nonce(), slot, self.note)
+        return ticket < lottery_threshold(
+            self.config.active_slot_coeff, self.note.value, epoch.total_active_stake()
+        )
+
+
+@dataclass
+class WalletLeader:
+    """
+    A leader taking part in the slot lottery with many notes at once.
+
+    Per epoch, the ticket suffix and win threshold of every note are computed once;
+    each slot is then evaluated for all notes in a single pass, hashing the tickets
+    from a shared per-slot prefix. When several notes win a slot, the note with the
+    lowest ticket is used.
+    """
 
-        ticket = Hash(
-            b"LEAD",
+    config: Config
+    notes: list[Note]
+    # lottery parameters of the last epoch evaluated, see `_epoch_lottery`
+    _lottery: tuple | None = field(default=None, init=False, repr=False, compare=False)
+
+    def try_prove_slot_leader(
+        self, epoch: EpochState, slot: Slot, parent: Hash
+    ) -> MockLeaderProof | None:
+        if note := self._slot_winner(self._epoch_lottery(epoch), slot.absolute_slot):
+            return MockLeaderProof(note, slot, parent)
+
+    def compute_schedule(
+        self, epoch: EpochState, slot_range: range
+    ) -> list[tuple[Slot, Note]]:
+        """
+        Returns, in order of slot, the slots of `slot_range` (absolute slot numbers)
+        won by any of the notes, along with the note to prove leadership with.
+        """
+        lottery = self._epoch_lottery(epoch)
+        schedule = []
+        for absolute_slot in sorted(slot_range):
+            if note := self._slot_winner(lottery, absolute_slot):
+                schedule.append((Slot(absolute_slot), note))
+        return schedule
+
+    def _epoch_lottery(self, epoch: EpochState) -> tuple:
+        # the notes are part of the key so that notes added to or removed from the
+        # wallet mid-epoch are taken into account
+        key = (
             epoch.nonce(),
-            slot.encode(),
-            self.note.commitment(),
-            self.note.encode_sk(),
+            epoch.total_active_stake(),
+            tuple(note.commitment() for note in self.notes),
         )
-        ticket = int.from_bytes(ticket)
+        if self._lottery is None or self._lottery[0] != key:
+            tickets = LotteryTickets(epoch.nonce())
+            notes = [
+                (
+                    note,
+                    tickets.note_suffix(note),
+                    lottery_threshold(
+                        self.config.active_slot_coeff,
+                        note.value,
+                        epoch.total_active_stake(),
+                    ),
+                )
+                for note in self.notes
+            ]
+            self._lottery = (key, tickets, notes)
+        return self._lottery
+
+    @staticmethod
+    def _slot_winner(lottery: tuple, absolute_slot: int) -> Note | None:
+        _, tickets, notes = lottery
+        slot_prefix = tickets.slot_prefix(absolute_slot)
+
+        winner, winning_ticket = None, Hash.ORDER
+        for note, suffix, threshold in notes:
+            ticket = tickets.ticket(slot_prefix, suffix)
+            if ticket < threshold and ticket < winning_ticket:
+                winner, winning_ticket = note, ticket
+        return winner
 
-        return ticket < Hash.ORDER * phi(self.config.active_slot_coeff, relative_stake)
 
 def height(block: Hash, states: Dict[Hash, LedgerState]) -> int:
     """
@@ -579,6 +1163,9 @@ def height(block: Hash, states: Dict[Hash, LedgerState]) -> int:
     if block not in states:
         raise ValueError("State not found in states")
 
+    if isinstance(states, BlockTree):
+        return states.height(block) + 1
+
     height = 0
     while block in states:
         height += 1
@@ -589,6 +1176,9 @@ def height(block: Hash, states: Dict[Hash, LedgerState]) -> int:
 def iter_chain(
     tip: Hash, states: Dict[Hash, LedgerState]
 ) -> Generator[LedgerState, None, None]:
+    if isinstance(states, BlockTree):
+        yield from states.iter_chain(tip)
+        return
     while tip in states:
         yield states[tip]
         tip = states[tip].block.parent
@@ -597,6 +1187,9 @@ def iter_chain(
 def iter_chain_blocks(
     tip: Hash, states: Dict[Hash, LedgerState]
 ) -> Generator[BlockHeader, None, None]:
+    if isinstance(states, BlockTree):
+        yield from states.iter_chain_blocks(tip)
+        return
     for state in iter_chain(tip, states):
         yield state.block
 
@@ -604,6 +1197,8 @@ def is_ancestor(a: Hash, b: Hash, states: Dict[Hash, LedgerState]) -> bool:
     """
     Returns True if `a` is an ancestor of `b` in the chain.
     """
+    if isinstance(states, BlockTree):
+        return states.is_ancestor(a, b)
     for state in iter_chain(b, states):
         if state.block.id() == a:
             return True
@@ -612,54 +1207,9 @@ def is_ancestor(a: Hash, b: Hash, states: Dict[Hash, LedgerState]) -> bool:
 def common_prefix_depth(
     a: Hash, b: Hash, states: Dict[Hash, LedgerState]
 ) -> tuple[int, list[BlockHeader], int, list[BlockHeader]]:
-    a_blocks = iter_chain_blocks(a, states)
-    b_blocks = iter_chain_blocks(b, states)
-
-    seen = {}
-    a_suffix: list[BlockHeader] = []
-    b_suffix: list[BlockHeader] = []
-    depth = 0
-    while True:
-        try:
-            a_block = next(a_blocks)
-            a_suffix.append(a_block)
-            a_block_id = a_block.id()
-            if a_block_id in seen:
-                # we had seen this block from the fork chain
-                return (
-                    depth,
-                    list(reversed(a_suffix[: depth + 1])),
-                    seen[a_block_id],
-                    list(reversed(b_suffix[: seen[a_block_id] + 1])),
-                )
-
-            seen[a_block_id] = depth
-        except StopIteration:
-            pass
-
-        try:
-            b_block = next(b_blocks)
-            b_suffix.append(b_block)
-            b_block_id = b_block.id()
-            if b_block_id in seen:
-                # we had seen the fork in the local chain
-                return (
-                    seen[b_block_id],
-                    list(reversed(a_suffix[: seen[b_block_id] + 1])),
-                    depth,
-                    list(reversed(b_suffix[: depth + 1])),
-                )
-            seen[b_block_id] = depth
-        except StopIteration:
-            pass
-
-        depth += 1
-
-    assert False
-
-
-def chain_density(chain: list[BlockHeader], slot: Slot) -> int:
-    return sum(1 for b in chain if b.slot < slot)
+    tree = BlockTree.of(states)
+    lca, a_depth, b_depth = tree.divergence(a, b)
+    return a_depth, tree.chain(a, lca), b_depth, tree.chain(b, lca)
 
 
 def block_children(states: Dict[Hash, LedgerState]) -> Dict[Hash, set[Hash]]:
@@ -687,11 +1237,10 @@ def maxvalid_bg(
     assert type(local_chain) == Hash, type(local_chain)
     assert all(type(f) == Hash for f in forks)
 
+    tree = BlockTree.of(states)
     cmax = local_chain
     for fork in forks:
-        cmax_depth, cmax_suffix, fork_depth, fork_suffix = common_prefix_depth(
-            cmax, fork, states
-        )
+        lca, cmax_depth, fork_depth = tree.divergence(cmax, fork)
         if cmax_depth <= k:
             # Longest chain fork choice rule
             if cmax_depth < fork_depth:
@@ -699,11 +1248,11 @@ def maxvalid_bg(
         else:
             # The chain is forking too much, we need to pay a bit more attention
             # In particular, select the chain that is the densest after the fork
-            cmax_divergent_block = cmax_suffix[0]
+            cmax_divergent_block = tree[lca].block
 
-            forking_slot = Slot(cmax_divergent_block.slot.absolute_slot + s)
-            cmax_density = chain_density(cmax_suffix, forking_slot)
-            fork_density = chain_density(fork_suffix, forking_slot)
+            forking_slot = cmax_divergent_block.slot.absolute_slot + s
+            cmax_density = tree.density(cmax, lca, forking_slot)
+            fork_density = tree.density(fork, lca, forking_slot)
 
             if cmax_density < fork_density:
                 cmax = fork
@@ -726,11 +1275,10 @@ def maxvalid_mc(
     assert type(local_chain) == Hash, type(local_chain)
     assert all(type(f) == Hash for f in forks)
 
+    tree = BlockTree.of(states)
     cmax = local_chain
     for fork in forks:
-        cmax_depth, _, fork_depth, _ = common_prefix_depth(
-            cmax, fork, states
-        )
+        _, cmax_depth, fork_depth = tree.divergence(cmax, fork)
         if cmax_depth <= k:
             # Longest chain fork choice rule
             if cmax_depth < fork_depth:
@@ -751,6 +1299,19 @@ class ImmutableFork(Exception):
     def __str__(self):
         return "Block is forking deeper than the last immutable block"
 
+class InvalidSlot(Exception):
+    def __str__(self):
+        return "Block slot is earlier than the slot of its parent"
+
+
+class MissingEpochState(Exception):
+    def __init__(self, epoch: Epoch):
+        super().__init__(epoch)
+        self.epoch = epoch
+
+    def __str__(self):
+        return f"Epoch state of epoch {self.epoch.epoch} precedes the block tree"
+
 
 if __name__ == "__main__":
     pass
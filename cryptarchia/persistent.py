@@ -0,0 +1,247 @@
+from collections.abc import Hashable, Iterable, Iterator, MutableSet
+
+# A hash array mapped trie (HAMT) consumes the hash of an item 5 bits at a time,
+# giving nodes of up to 32 entries. Items whose 64 bit hashes fully collide are
+# kept together in a collision node at the bottom of the trie.
+_BITS = 5
+_MASK = (1 << _BITS) - 1
+_HASH_BITS = 64
+_HASH_MASK = (1 << _HASH_BITS) - 1
+
+
+class _Node:
+    __slots__ = ()
+
+
+class _BitmapNode(_Node):
+    # `bitmap` has a bit set for every occupied slot of this node, and `entries`
+    # holds, in slot order, either an item or a child node for each occupied slot.
+    __slots__ = ("bitmap", "entries")
+
+    def __init__(self, bitmap: int, entries: tuple):
+        self.bitmap = bitmap
+        self.entries = entries
+
+
+class _CollisionNode(_Node):
+    __slots__ = ("items",)
+
+    def __init__(self, items: tuple):
+        self.items = items
+
+
+_EMPTY_ROOT = _BitmapNode(0, ())
+
+# marker returned by `_remove` when a node has no entries left
+_EMPTY = object()
+
+
+def _hash(item: Hashable) -> int:
+    return hash(item) & _HASH_MASK
+
+
+def _contains(node: _Node, item: Hashable, h: int) -> bool:
+    shift = 0
+    while True:
+        if type(node) is _CollisionNode:
+            return item in node.items
+        bit = 1 << ((h >> shift) & _MASK)
+        if not node.bitmap & bit:
+            return False
+        entry = node.entries[(node.bitmap & (bit - 1)).bit_count()]
+        if not isinstance(entry, _Node):
+            return entry == item
+        node = entry
+        shift += _BITS
+
+
+def _merge(a: Hashable, a_hash: int, b: Hashable, b_hash: int, shift: int) -> _Node:
+    # Builds the smallest sub-trie holding two distinct items
+    if shift >= _HASH_BITS:
+        return _CollisionNode((a, b))
+    a_idx = (a_hash >> shift) & _MASK
+    b_idx = (b_hash >> shift) & _MASK
+    if a_idx == b_idx:
+        return _BitmapNode(1 << a_idx, (_merge(a, a_hash, b, b_hash, shift + _BITS),))
+    entries = (a, b) if a_idx < b_idx else (b, a)
+    return _BitmapNode((1 << a_idx) | (1 << b_idx), entries)
+
+
+def _add(node: _Node, item: Hashable, h: int, shift: int) -> _Node:
+    # Returns a new node containing `item`, or `node` itself if the item is already present.
+    if type(node) is _CollisionNode:
+        if item in node.items:
+            return node
+        return _CollisionNode(node.items + (item,))
+
+    bit = 1 << ((h >> shift) & _MASK)
+    idx = (node.bitmap & (bit - 1)).bit_count()
+    entries = node.entries
+    if not node.bitmap & bit:
+        return _BitmapNode(node.bitmap | bit, entries[:idx] + (item,) + entries[idx:])
+
+    entry = entries[idx]
+    if isinstance(entry, _Node):
+        child = _add(entry, item, h, shift + _BITS)
+        if child is entry:
+            return node
+    elif entry == item:
+        return node
+    else:
+        child = _merge(entry, _hash(entry), item, h, shift + _BITS)
+    return _BitmapNode(node.bitmap, entries[:idx] + (child,) + entries[idx + 1 :])
+
+
+def _remove(node: _Node, item: Hashable, h: int, shift: int):
+    # Returns the entry replacing `node` once `item` is removed: a new node, a single
+    # item (when only one is left below the root), `_EMPTY`, or `node` itself if the
+    # item is absent.
+    if type(node) is _CollisionNode:
+        if item not in node.items:
+            return node
+        items = tuple(i for i in node.items if i != item)
+        return items[0] if len(items) == 1 else _CollisionNode(items)
+
+    bit = 1 << ((h >> shift) & _MASK)
+    if not node.bitmap & bit:
+        return node
+    idx = (node.bitmap & (bit - 1)).bit_count()
+    entries = node.entries
+    entry = entries[idx]
+    if isinstance(entry, _Node):
+        child = _remove(entry, item, h, shift + _BITS)
+        if child is entry:
+            return node
+    elif entry == item:
+        child = _EMPTY
+    else:
+        return node
+
+    if child is _EMPTY:
+        bitmap = node.bitmap & ~bit
+        if not bitmap:
+            return _EMPTY
+        entries = entries[:idx] + entries[idx + 1 :]
+    else:
+        bitmap = node.bitmap
+        entries = entries[:idx] + (child,) + entries[idx + 1 :]
+
+    if shift and len(entries) == 1 and not isinstance(entries[0], _Node):
+        # collapse single item nodes into their parent
+        return entries[0]
+    return _BitmapNode(bitmap, entries)
+
+
+def _iter(node: _Node) -> Iterator[Hashable]:
+    if type(node) is _CollisionNode:
+        yield from node.items
+        return
+    for entry in node.entries:
+        if isinstance(entry, _Node):
+            yield from _iter(entry)
+        else:
+            yield entry
+
+
+def _entry_items(entry) -> list[Hashable]:
+    if entry is _EMPTY:
+        return []
+    if isinstance(entry, _Node):
+        return list(_iter(entry))
+    return [entry]
+
+
+def _diff(a, b, only_a: list, only_b: list):
+    # Collects the items found only under `a` and only under `b`,
+    # skipping the subtrees that both share.
+    if a is b:
+        return
+    if type(a) is _BitmapNode and type(b) is _BitmapNode:
+        bitmap = a.bitmap | b.bitmap
+        while bitmap:
+            bit = bitmap & -bitmap
+            bitmap ^= bit
+            ea = a.entries[(a.bitmap & (bit - 1)).bit_count()] if a.bitmap & bit else _EMPTY
+            eb = b.entries[(b.bitmap & (bit - 1)).bit_count()] if b.bitmap & bit else _EMPTY
+            if isinstance(ea, _Node) and isinstance(eb, _Node):
+                _diff(ea, eb, only_a, only_b)
+            elif ea is not eb:
+                _diff_items(_entry_items(ea), _entry_items(eb), only_a, only_b)
+    else:
+        _diff_items(_entry_items(a), _entry_items(b), only_a, only_b)
+
+
+def _diff_items(a: list, b: list, only_a: list, only_b: list):
+    only_a.extend(item for item in a if item not in b)
+    only_b.extend(item for item in b if item not in a)
+
+
+class PersistentSet(MutableSet):
+    """
+    A mutable set with O(1) copies.
+
+    Items are stored in an immutable hash array mapped trie, which is shared between
+    a set and its copies. Adding or removing an item rebuilds only the O(log n) nodes
+    on the path to that item, so the memory held by a family of copies grows with the
+    number of items in which they differ rather than with their size.
+    """
+
+    __slots__ = ("_root", "_len")
+
+    def __init__(self, items: Iterable[Hashable] = ()):
+        self._root = _EMPTY_ROOT
+        self._len = 0
+        for item in items:
+            self.add(item)
+
+    def copy(self) -> "PersistentSet":
+        other = PersistentSet.__new__(PersistentSet)
+        other._root = self._root
+        other._len = self._len
+        return other
+
+    # Trie nodes are never mutated, so copying the set is enough to get an independent
+    # instance. Items are expected to be immutable, as with any hashable set member.
+    __copy__ = copy
+
+    def __deepcopy__(self, memo) -> "PersistentSet":
+        return self.copy()
+
+    def diff(self, other: "PersistentSet") -> tuple[list, list]:
+        """
+        Returns the items only in this set and the items only in `other`.
+
+        Subtrees shared by both sets, as between a set and its copies, are skipped, so
+        the cost grows with the number of differences rather than with the size of the sets.
+        """
+        only_self: list = []
+        only_other: list = []
+        _diff(self._root, other._root, only_self, only_other)
+        return only_self, only_other
+
+    def add(self, item: Hashable):
+        root = _add(self._root, item, _hash(item), 0)
+        if root is not self._root:
+            self._root = root
+            self._len += 1
+
+    def discard(self, item: Hashable):
+        root = _remove(self._root, item, _hash(item), 0)
+        if root is not self._root:
+            self._root = _EMPTY_ROOT if root is _EMPTY else root
+            self._len -= 1
+
+    def __contains__(self, item: Hashable) -> bool:
+        return _contains(self._root, item, _hash(item))
+
+    def __iter__(self) -> Iterator[Hashable]:
+        return _iter(self._root)
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __repr__(self) -> str:
+        return f"PersistentSet({list(self)!r})"
+
+    def __reduce__(self):
+        return (PersistentSet, (list(self),))
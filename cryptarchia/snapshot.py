@@ -0,0 +1,281 @@
+"""
+Snapshots of a follower, to restart it without replaying the chain.
+
+A snapshot holds the block tree from the LIB up, the epoch states that blocks built
+on it may need, and the few older states those epoch states refer to. The file is
+laid out as fixed size records, and is read through a memory map:
+
+    header       MAGIC, genesis ID, LIB, local chain, follower state, record counts
+    notes        the notes leading the blocks below, by commitment
+    headers      the block of every state, encoded with the 'HEADER' rule
+    states       for every block, the rest of its ledger state: its note sets are
+                 stored in full for older states and for the LIB, and as the changes
+                 from the parent state for the blocks above the LIB
+    forks        the fork tips
+    epoch states the epoch state memo, referring to snapshot states by block ID
+"""
+
+import mmap
+import os
+import struct
+
+from cryptarchia.codec import (
+    HEADER_SIZE,
+    NOTE_SIZE,
+    DecodeError,
+    decode_headers,
+    decode_note,
+    encode_note,
+)
+from cryptarchia.cryptarchia import (
+    Config,
+    Epoch,
+    EpochState,
+    Follower,
+    Hash,
+    LedgerState,
+    State,
+)
+from cryptarchia.persistent import PersistentSet
+
+MAGIC = b"CRYSNAP\x01"
+
+_HEADER = struct.Struct(">8s32s32s32sBIIIII")
+# index of the parent state (-1 for full note sets), nonce presence, nonce,
+# leader count, and the number of commitments and nullifiers added and removed
+_STATE = struct.Struct(">iB32sQIIII")
+# epoch, memo block ID, stake distribution and nonce snapshot block IDs,
+# and the inferred total active stake as a signed integer
+_EPOCH_STATE = struct.Struct(">Q32s32s32s16s")
+
+
+class InvalidSnapshot(Exception):
+    pass
+
+
+def write_snapshot(follower: Follower, path: str):
+    tree = follower.ledger_state
+    lib = follower.lib
+    lib_epoch = tree[lib].block.slot.epoch(follower.config)
+
+    # Blocks after the LIB only query the epoch states of the LIB's epoch or later
+    # ones, and only those of the LIB's epoch and the next one have snapshots that may
+    # precede the LIB. Compute them now, while the chain before the LIB is at hand, and
+    # keep them: a bounded memo may already have evicted them.
+    required = {}
+    for epoch in (lib_epoch, Epoch(lib_epoch.epoch + 1)):
+        state = follower.compute_epoch_state(epoch, lib)
+        required[(epoch, state.nonce_snapshot.block.id())] = state
+
+    tree_ids = list(tree.subtree(lib))
+    in_tree = set(tree_ids)
+    anchor_ids = {state.block.id() for state in follower.anchor_states}
+
+    def immutable(block_id: Hash) -> bool:
+        return block_id in anchor_ids or tree.is_ancestor(block_id, lib)
+
+    epoch_states = list(required.items()) + [
+        (key, state)
+        for key, state in follower.epoch_state.items()
+        if key not in required
+        and key[0].epoch >= lib_epoch.epoch
+        and all(
+            s.block.id() in in_tree or immutable(s.block.id())
+            for s in (state.stake_distribution_snapshot, state.nonce_snapshot)
+        )
+    ]
+
+    # older states, needed by the epoch states or as the genesis state
+    anchors = {}
+    if follower.genesis_id not in in_tree:
+        anchors[follower.genesis_id] = follower.genesis_state
+    for _, state in epoch_states:
+        for s in (state.stake_distribution_snapshot, state.nonce_snapshot):
+            if s.block.id() not in in_tree:
+                anchors[s.block.id()] = s
+    anchor_states = sorted(
+        anchors.values(), key=lambda s: (s.block.slot.absolute_slot, s.leader_count)
+    )
+
+    states = anchor_states + [tree[block_id] for block_id in tree_ids]
+    index = {state.block.id(): i for i, state in enumerate(states)}
+    notes = {}
+    for state in states:
+        note = state.block.leader_proof.note
+        notes.setdefault(note.commitment(), note)
+
+    out = bytearray()
+    out += _HEADER.pack(
+        MAGIC,
+        follower.genesis_id,
+        lib,
+        follower.local_chain,
+        follower.state.value,
+        len(notes),
+        len(anchor_states),
+        len(tree_ids),
+        len(follower.forks),
+        len(epoch_states),
+    )
+    for note in notes.values():
+        out += encode_note(note)
+    for state in states:
+        out += state.block.encode()
+    for i, state in enumerate(states):
+        parent = index.get(state.block.parent, -1) if i > len(anchor_states) else -1
+        if parent == -1:
+            changes = [(list(state.commitments), []), (list(state.nullifiers), [])]
+        else:
+            changes = [
+                state.commitments.diff(states[parent].commitments),
+                state.nullifiers.diff(states[parent].nullifiers),
+            ]
+        out += _STATE.pack(
+            parent,
+            state.nonce is not None,
+            bytes(32) if state.nonce is None else state.nonce,
+            state.leader_count,
+            *(len(items) for change in changes for items in change),
+        )
+        for change in changes:
+            for items in change:
+                out += b"".join(items)
+    for fork in follower.forks:
+        out += fork
+    for (epoch, memo_block_id), state in epoch_states:
+        out += _EPOCH_STATE.pack(
+            epoch.epoch,
+            memo_block_id,
+            state.stake_distribution_snapshot.block.id(),
+            state.nonce_snapshot.block.id(),
+            state.inferred_total_active_stake.to_bytes(16, "big", signed=True),
+        )
+
+    # write to a temporary file first, so that a crash never leaves a partial snapshot
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(out)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def read_snapshot(path: str, config: Config, **kwargs) -> Follower:
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            try:
+                return _read_snapshot(memoryview(buf), config, kwargs)
+            except (struct.error, IndexError, KeyError, DecodeError) as e:
+                raise InvalidSnapshot("Truncated or corrupted snapshot") from e
+
+
+def _digest(buf: memoryview, offset: int) -> Hash:
+    return Hash.from_digest(buf[offset : offset + 32].tobytes())
+
+
+def _read_snapshot(buf: memoryview, config: Config, kwargs: dict) -> Follower:
+    with buf:
+        (
+            magic,
+            genesis_id,
+            lib,
+            local_chain,
+            follower_state,
+            n_notes,
+            n_anchors,
+            n_tree,
+            n_forks,
+            n_epoch_states,
+        ) = _HEADER.unpack_from(buf, 0)
+        if magic != MAGIC:
+            raise InvalidSnapshot("Not a snapshot")
+        offset = _HEADER.size
+
+        notes = {}
+        for _ in range(n_notes):
+            note = decode_note(buf, offset)
+            notes[note.commitment()] = note
+            offset += NOTE_SIZE
+
+        n_states = n_anchors + n_tree
+        end = offset + n_states * HEADER_SIZE
+        blocks = [view.header(notes) for view in decode_headers(buf[offset:end])]
+        if len(blocks) != n_states:
+            raise InvalidSnapshot("Truncated snapshot")
+        offset = end
+
+        states: list[LedgerState] = []
+        for block in blocks:
+            parent, has_nonce, nonce, leader_count, *counts = _STATE.unpack_from(buf, offset)
+            offset += _STATE.size
+            if parent == -1:
+                sets = [PersistentSet(), PersistentSet()]
+            else:
+                sets = [states[parent].commitments.copy(), states[parent].nullifiers.copy()]
+            for i, count in enumerate(counts):
+                items = sets[i // 2]
+                for _ in range(count):
+                    if i % 2 == 0:
+                        items.add(_digest(buf, offset))
+                    else:
+                        items.discard(_digest(buf, offset))
+                    offset += 32
+            states.append(
+                LedgerState(
+                    block=block,
+                    nonce=Hash.from_digest(nonce) if has_nonce else None,
+                    commitments=sets[0],
+                    nullifiers=sets[1],
+                    leader_count=leader_count,
+                )
+            )
+
+        forks = []
+        for _ in range(n_forks):
+            forks.append(_digest(buf, offset))
+            offset += 32
+
+        epoch_states = []
+        for _ in range(n_epoch_states):
+            epoch, memo_block_id, stake_id, nonce_id, stake = _EPOCH_STATE.unpack_from(
+                buf, offset
+            )
+            offset += _EPOCH_STATE.size
+            epoch_states.append(
+                (
+                    Epoch(epoch),
+                    Hash.from_digest(memo_block_id),
+                    Hash.from_digest(stake_id),
+                    Hash.from_digest(nonce_id),
+                    int.from_bytes(stake, "big", signed=True),
+                )
+            )
+
+        if offset != len(buf):
+            raise InvalidSnapshot("Trailing bytes in snapshot")
+
+    anchors, tree_states = states[:n_anchors], states[n_anchors:]
+    follower = Follower(tree_states[0], config, **kwargs)
+    # keep the very objects the epoch states refer to
+    for state in tree_states:
+        follower.ledger_state[state.block.id()] = state
+    follower.genesis_id = Hash.from_digest(genesis_id)
+    follower.anchor_states = anchors
+    follower.lib = Hash.from_digest(lib)
+    follower.local_chain = Hash.from_digest(local_chain)
+    follower.forks = forks
+    follower.state = State(follower_state)
+
+    by_id = {state.block.id(): state for state in states}
+    for epoch, memo_block_id, stake_id, nonce_id, stake in epoch_states:
+        epoch_state = EpochState(
+            stake_distribution_snapshot=by_id[stake_id],
+            nonce_snapshot=by_id[nonce_id],
+            inferred_total_active_stake=stake,
+        )
+        if memo_block_id in follower.ledger_state:
+            follower.epoch_state[(epoch, memo_block_id)] = epoch_state
+        else:
+            # the snapshots precede the tree, so this epoch state cannot be recomputed
+            follower.epoch_state.pin((epoch, memo_block_id), epoch_state)
+    return follower
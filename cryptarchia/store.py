@@ -0,0 +1,262 @@
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from collections.abc import Hashable
+from typing import TYPE_CHECKING, Any
+
+from cryptarchia.persistent import PersistentSet
+
+if TYPE_CHECKING:
+    from cryptarchia.cryptarchia import BlockHeader, Hash, LedgerState
+
+
+class BlockStore(ABC):
+    """
+    Persistent storage for the immutable part of a block tree: the blocks at or below
+    the last immutable block, along with their ledger states.
+
+    Those blocks form a single chain, which is stored in chain order: every block but
+    the first one is stored after its parent.
+    """
+
+    @abstractmethod
+    def put(self, block_id: "Hash", state: "LedgerState"):
+        pass
+
+    @abstractmethod
+    def get_block(self, block_id: "Hash") -> "BlockHeader":
+        """
+        Raises: KeyError if the block is not stored
+        """
+        pass
+
+    @abstractmethod
+    def get_state(self, block_id: "Hash") -> "LedgerState":
+        """
+        Raises: KeyError if the block is not stored
+        """
+        pass
+
+    @abstractmethod
+    def __contains__(self, block_id: "Hash") -> bool:
+        pass
+
+
+class LRUCache:
+    """
+    A mapping holding at most `max_size` entries, evicting the least recently used one.
+
+    Safe to use from several threads, e.g. by peers serving requests concurrently.
+    """
+
+    def __init__(self, max_size: int):
+        assert max_size > 0
+        self.max_size = max_size
+        self.entries: OrderedDict[Hashable, Any] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Any | None:
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value: Any):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def discard(self, key: Hashable):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+# kinds of note sets, in the `notes` table
+_COMMITMENTS = 0
+_NULLIFIERS = 1
+
+
+class SqliteBlockStore(BlockStore):
+    """
+    A block store backed by a local SQLite database.
+
+    Consecutive ledger states share almost all of their notes, so the notes of a state
+    are stored as the changes from its parent's state, except every `snapshot_interval`
+    blocks, where the full note sets are stored. Loading a state replays at most
+    `snapshot_interval` sets of changes, on top of the previous snapshot or of the
+    nearest ancestor among the last `cache_size` states stored or loaded, whose note
+    sets the loaded state then shares.
+
+    Headers are stored encoded with the 'HEADER' rule, along with their leader note.
+
+    The store can be read and written from several threads: they share one connection,
+    used by one thread at a time.
+    """
+
+    def __init__(
+        self, path: str = ":memory:", snapshot_interval: int = 128, cache_size: int = 16
+    ):
+        assert snapshot_interval > 0
+        self.snapshot_interval = snapshot_interval
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS blocks (
+                id BLOB PRIMARY KEY,
+                parent BLOB NOT NULL,
+                -- number of blocks since the last snapshot, 0 for a snapshot
+                depth INTEGER NOT NULL,
+                header BLOB NOT NULL,
+                leader_note BLOB NOT NULL,
+                nonce BLOB,
+                leader_count INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS notes (
+                block BLOB NOT NULL,
+                kind INTEGER NOT NULL,
+                -- 1 if the note is added to the set, 0 if it is removed
+                added INTEGER NOT NULL,
+                note BLOB NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS notes_by_block ON notes (block);
+            """
+        )
+        # The last states stored or loaded, by block ID: the next state stored or loaded
+        # most likely derives from one of them
+        self._states = LRUCache(cache_size)
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+    def _query(self, sql: str, params: tuple) -> list[tuple]:
+        with self._lock:
+            return self.db.execute(sql, params).fetchall()
+
+    def put(self, block_id: "Hash", state: "LedgerState"):
+        from cryptarchia.codec import encode_note
+
+        parent_id = state.block.parent
+        parent_depth = self._depth(parent_id)
+        if parent_depth is None or parent_depth + 1 >= self.snapshot_interval:
+            depth = 0
+            notes = [(_COMMITMENTS, 1, n) for n in state.commitments]
+            notes += [(_NULLIFIERS, 1, n) for n in state.nullifiers]
+        else:
+            depth = parent_depth + 1
+            parent = self.get_state(parent_id)
+            notes = self._changes(_COMMITMENTS, parent.commitments, state.commitments)
+            notes += self._changes(_NULLIFIERS, parent.nullifiers, state.nullifiers)
+
+        with self._lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO blocks VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    bytes(block_id),
+                    bytes(parent_id),
+                    depth,
+                    state.block.encode(),
+                    encode_note(state.block.leader_proof.note),
+                    None if state.nonce is None else bytes(state.nonce),
+                    state.leader_count,
+                ),
+            )
+            self.db.execute("DELETE FROM notes WHERE block = ?", (bytes(block_id),))
+            self.db.executemany(
+                "INSERT INTO notes VALUES (?, ?, ?, ?)",
+                [(bytes(block_id), kind, added, bytes(n)) for kind, added, n in notes],
+            )
+        self._states.put(bytes(block_id), state)
+
+    @staticmethod
+    def _changes(
+        kind: int, parent: PersistentSet, child: PersistentSet
+    ) -> list[tuple[int, int, "Hash"]]:
+        added, removed = child.diff(parent)
+        return [(kind, 1, n) for n in added] + [(kind, 0, n) for n in removed]
+
+    def _depth(self, block_id: "Hash") -> int | None:
+        rows = self._query("SELECT depth FROM blocks WHERE id = ?", (bytes(block_id),))
+        return rows[0][0] if rows else None
+
+    def __contains__(self, block_id: "Hash") -> bool:
+        return self._depth(block_id) is not None
+
+    def get_block(self, block_id: "Hash") -> "BlockHeader":
+        if (state := self._states.get(bytes(block_id))) is not None:
+            return state.block
+        rows = self._query(
+            "SELECT header, leader_note FROM blocks WHERE id = ?", (bytes(block_id),)
+        )
+        if not rows:
+            raise KeyError(block_id)
+        return self._decode_block(*rows[0])
+
+    @staticmethod
+    def _decode_block(header: bytes, leader_note: bytes) -> "BlockHeader":
+        from cryptarchia.codec import decode_header, decode_note
+
+        note = decode_note(leader_note)
+        return decode_header(header).header({note.commitment(): note})
+
+    def get_state(self, block_id: "Hash") -> "LedgerState":
+        from cryptarchia.cryptarchia import Hash, LedgerState
+
+        if (state := self._states.get(bytes(block_id))) is not None:
+            return state
+
+        # walk back to the nearest cached ancestor, or to the last snapshot
+        rows = []
+        base = None
+        id = bytes(block_id)
+        while True:
+            found = self._query(
+                "SELECT id, parent, depth, header, leader_note, nonce, leader_count "
+                "FROM blocks WHERE id = ?",
+                (id,),
+            )
+            if not found:
+                raise KeyError(block_id)
+            row = found[0]
+            rows.append(row)
+            if row[2] == 0:
+                break
+            id = row[1]
+            if (base := self._states.get(id)) is not None:
+                break
+
+        if base is None:
+            commitments = PersistentSet()
+            nullifiers = PersistentSet()
+        else:
+            commitments = base.commitments.copy()
+            nullifiers = base.nullifiers.copy()
+        sets = {_COMMITMENTS: commitments, _NULLIFIERS: nullifiers}
+        for row in reversed(rows):
+            for kind, added, note in self._query(
+                "SELECT kind, added, note FROM notes WHERE block = ? ORDER BY rowid",
+                (row[0],),
+            ):
+                if added:
+                    sets[kind].add(Hash.from_digest(note))
+                else:
+                    sets[kind].discard(Hash.from_digest(note))
+
+        _, _, _, header, leader_note, nonce, leader_count = rows[0]
+        state = LedgerState(
+            block=self._decode_block(header, leader_note),
+            nonce=None if nonce is None else Hash.from_digest(nonce),
+            commitments=commitments,
+            nullifiers=nullifiers,
+            leader_count=leader_count,
+        )
+        self._states.put(bytes(block_id), state)
+        return state
@@ -1,22 +1,69 @@
-from collections import defaultdict
-from typing import Generator
+import math
+import queue
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    Future,
+    ThreadPoolExecutor,
+    wait,
+)
+from dataclasses import dataclass, field
+from typing import Callable, Generator, Iterable, TypeVar
 
 from cryptarchia.cryptarchia import (
     BlockHeader,
     Follower,
     Hash,
+    InvalidLeaderProof,
+    InvalidSlot,
     LedgerState,
     ParentNotFound,
     Slot,
     iter_chain_blocks,
+    prevalidate_headers,
 )
 
+T = TypeVar("T")
+
 
-def sync(local: Follower, peers: list[Follower], checkpoint: LedgerState | None = None):
+def sync(
+    local: Follower,
+    peers: list[Follower],
+    checkpoint: LedgerState | None = None,
+    executor: Executor | None = None,
+    batch_size: int = 256,
+    queue_size: int = 8,
+    orphan_pool_size: int = 4096,
+    orphan_max_age: float | None = None,
+    peer_manager: "PeerManager | None" = None,
+):
     # Syncs the local block tree with the peers, starting from the local tip.
     # This covers the case where the local tip is not on the latest honest chain anymore.
+    #
+    # Blocks go through a pipeline of three stages, each on its own thread, so that
+    # waiting for peers, pre-validation and application overlap:
+    #   fetch:       blocks are fetched from the peers and cut into batches of at most
+    #                `batch_size` consecutive blocks of the same chain
+    #   prevalidate: the checks of fetched headers that need no ledger state are run,
+    #                on `executor` if given
+    #   apply:       batches are validated against the block tree and applied, on the
+    #                calling thread
+    # Stages are connected by queues of at most `queue_size` batches, which block
+    # the stages ahead when the apply stage falls behind.
+    #
+    # Batches are applied in the order they are fetched, so the resulting block tree is
+    # the same as when applying blocks one by one as they are fetched.
+    #
+    # Peers are chosen according to their record in `peer_manager`, which can be shared
+    # across syncs, and are demoted when they serve blocks that get rejected.
+    #
+    # Blocks whose parent is missing wait in a pool of at most `orphan_pool_size`
+    # blocks, for at most `orphan_max_age` seconds.
 
-    block_fetcher = BlockFetcher(peers)
+    block_fetcher = BlockFetcher(peers, peer_manager=peer_manager)
 
     # If the checkpoint is provided, start backfilling the checkpoint chain in the background.
     # But for simplicity, we do it in the foreground here.
@@ -28,71 +75,448 @@ def sync(local: Follower, peers: list[Follower], checkpoint: LedgerState | None
     # Repeat the sync process until no peer has a tip ahead of the local tip,
     # because peers' tips may advance during the sync process.
     rejected_blocks: set[Hash] = set()
+    orphans = OrphanPool(orphan_pool_size, orphan_max_age)
     while True:
         # Fetch blocks from the peers in the range of slots from the local tip to the latest tip.
         # Gather orphaned blocks, which are blocks from forks that are absent in the local block tree.
 
         start_slot = local.tip().slot
-        orphans: set[BlockHeader] = set()
         num_blocks = 0
-        for block in block_fetcher.fetch_blocks_from(start_slot):
-            num_blocks += 1
-            # Reject blocks that have been rejected in the past
-            # or whose parent has been rejected.
-            if {block.id(), block.parent} & rejected_blocks:
-                rejected_blocks.add(block.id())
-                continue
-
-            try:
-                local.on_block(block)
-                orphans.discard(block)
-            except ParentNotFound:
-                orphans.add(block)
-            except Exception:
-                rejected_blocks.add(block.id())
+        with _Pipeline(queue_size) as pipeline:
+            batches = pipeline.stage(
+                _batches(block_fetcher.fetch_blocks_from(start_slot), batch_size)
+            )
+            prevalidated = pipeline.stage(
+                (batch, *prevalidate_headers(batch, executor)) for batch in batches
+            )
+            for batch, valid, rejected in prevalidated:
+                num_blocks += len(batch)
+                apply_prevalidated_batch(
+                    local,
+                    batch,
+                    valid,
+                    rejected,
+                    orphans,
+                    rejected_blocks,
+                    block_fetcher,
+                )
 
         # Finish the sync process if no block has been fetched,
         # which means that no peer has a tip ahead of the local tip.
         if num_blocks == 0:
             return
 
-        # Backfill the orphan forks starting from the orphan blocks with applying fork choice rule.
+        # Backfill the orphan forks, once per subtree of orphans: fetch the chain up to
+        # the root of the subtree, then apply the orphans waiting for it in cascade.
         #
-        # Sort the orphan blocks by slot in descending order to minimize the number of backfillings.
-        for orphan in sorted(orphans, key=lambda b: b.slot, reverse=True):
-            # Skip the orphan block if it has been processed during the previous backfillings
-            # (i.e. if it has been already added to the local block tree).
-            # Or, skip if it has been rejected during the previous backfillings.
-            if (
-                orphan.id() not in local.ledger_state
-                and orphan.id() not in rejected_blocks
-            ):
-                try:
-                    backfill_fork(local, orphan, block_fetcher)
-                except InvalidBlockFromBackfillFork as e:
-                    rejected_blocks.update(block.id() for block in e.invalid_suffix)
+        # Sort the roots by slot in descending order to minimize the number of backfillings,
+        # since backfilling a fork may bring in the missing parent of an older root.
+        for root in sorted(orphans.roots(), key=lambda b: b.slot, reverse=True):
+            if root.id() not in orphans:
+                # resolved by a previous backfilling
+                continue
+            orphans.discard(root.id())
+            try:
+                applied = backfill_fork(local, root, block_fetcher)
+            except InvalidBlockFromBackfillFork as e:
+                descendants = orphans.pop_descendants(root.id())
+                rejected_blocks.update(block.id() for block in e.invalid_suffix)
+                rejected_blocks.update(b.id() for b in descendants)
+                block_fetcher.forget(descendants)
+                continue
+            if root.id() in local.ledger_state:
+                # The backfilled blocks may be the missing parents of other roots too.
+                resolve_orphans(
+                    local,
+                    applied,
+                    orphans,
+                    rejected_blocks,
+                    block_fetcher,
+                )
+            else:
+                # None of the peers could serve the fork, so drop it until it is fetched again.
+                block_fetcher.forget(orphans.pop_descendants(root.id()))
+
+        # Every block fetched in this round is settled by now, but for orphans evicted
+        # from the pool.
+        block_fetcher.sources.clear()
+
+
+def _batches(
+    blocks: Iterable[BlockHeader], batch_size: int
+) -> Generator[list[BlockHeader], None, None]:
+    # Cuts a stream of blocks into batches of consecutive blocks of the same chain,
+    # so that the fork choice rule is run once per batch instead of once per block.
+    batch: list[BlockHeader] = []
+    for block in blocks:
+        if batch and (block.parent != batch[-1].id() or len(batch) == batch_size):
+            yield batch
+            batch = []
+        batch.append(block)
+    if batch:
+        yield batch
+
+
+def apply_prevalidated_batch(
+    local: Follower,
+    batch: list[BlockHeader],
+    valid: list[BlockHeader],
+    rejected: list[tuple[BlockHeader, Exception]],
+    orphans: "OrphanPool",
+    rejected_blocks: set[Hash],
+    block_fetcher: "BlockFetcher | None" = None,
+):
+    # Applies a batch of consecutive blocks of one chain, given the outcome of
+    # `prevalidate_headers` on it, along with the orphans waiting for its blocks.
+    # Records the blocks that turned out to be orphaned or invalid, and reports the
+    # invalid ones to the fetcher they came from.
+    newly_rejected: list[BlockHeader] = []
+    invalid: list[BlockHeader] = []
+
+    # Reject blocks that have been rejected in the past
+    # or whose parent has been rejected. Those are a suffix of the batch.
+    for i, block in enumerate(batch):
+        if {block.id(), block.parent} & rejected_blocks:
+            rejected_blocks.update(b.id() for b in batch[i:])
+            newly_rejected += batch[i:]
+            skipped = {b.id() for b in batch[i:]}
+            batch = batch[:i]
+            valid = [b for b in valid if b.id() not in skipped]
+            rejected = [(b, e) for b, e in rejected if b.id() not in skipped]
+            break
+
+    rejected = rejected + local.on_blocks(valid)
+    failed = {block.id(): e for block, e in rejected}
+    applied = []
+    for block in batch:
+        e = failed.get(block.id())
+        if e is None:
+            applied.append(block.id())
+        elif isinstance(e, ParentNotFound) and block.parent not in rejected_blocks:
+            orphans.add(block)
+        else:
+            # Either the block is invalid, or its parent was rejected earlier in the batch.
+            descendants = orphans.pop_descendants(block.id())
+            rejected_blocks.add(block.id())
+            rejected_blocks.update(b.id() for b in descendants)
+            newly_rejected += [block] + descendants
+            if is_invalid_block(e):
+                invalid.append(block)
+    if block_fetcher is not None:
+        block_fetcher.report_invalid(invalid)
+        block_fetcher.forget(newly_rejected)
+        block_fetcher.forget(b for b in batch if b.id() not in orphans)
+    resolve_orphans(local, applied, orphans, rejected_blocks, block_fetcher)
+
+
+def is_invalid_block(e: Exception) -> bool:
+    # Whether a block was rejected for being invalid in itself, which only a faulty or
+    # malicious peer serves, rather than for where it sits in the local block tree.
+    return isinstance(e, (InvalidLeaderProof, InvalidSlot))
+
+
+def resolve_orphans(
+    local: Follower,
+    parents: list[Hash],
+    orphans: "OrphanPool",
+    rejected_blocks: set[Hash],
+    block_fetcher: "BlockFetcher | None" = None,
+):
+    # Applies the orphans waiting for blocks that have just been added to the local
+    # block tree, along with the orphans waiting for them, and so on.
+    # Orphans have been pre-validated before entering the pool.
+    for parent in parents:
+        orphans.discard(parent)
+        descendants = orphans.pop_descendants(parent)
+        for batch in _batches(descendants, len(descendants)):
+            apply_prevalidated_batch(
+                local, batch, batch, [], orphans, rejected_blocks, block_fetcher
+            )
+
+
+@dataclass
+class PeerStats:
+    # What the requests served by a peer have shown so far.
+    requests: int = 0
+    failures: int = 0
+    blocks: int = 0
+    invalid_blocks: int = 0
+    # moving averages, over successful requests, of their duration in seconds
+    # and of the number of blocks per second they delivered
+    latency: float | None = None
+    throughput: float | None = None
+
+    @property
+    def failure_rate(self) -> float:
+        return self.failures / self.requests if self.requests else 0.0
+
+
+class PeerManager:
+    # Keeps track of how well each peer serves requests, to choose the peers to fetch
+    # blocks from.
+    #
+    # A request to a peer is expected to take its average latency, times the number of
+    # attempts its failure rate implies, so that fast and reliable peers get most of the
+    # requests, while peers not tried yet are tried first. Bulk downloads go to the peers
+    # with the best throughput instead.
+    #
+    # Peers that have served `max_invalid_blocks` invalid blocks are demoted: they are
+    # only used when no other peer is available.
+    # Records are kept by peer object, and may be updated from several threads.
+
+    def __init__(self, max_invalid_blocks: int = 3, smoothing: float = 0.3):
+        assert max_invalid_blocks > 0 and 0 < smoothing <= 1
+        self.max_invalid_blocks = max_invalid_blocks
+        self.smoothing = smoothing
+        self.stats: dict[Follower, PeerStats] = {}
+        self.lock = threading.Lock()
+
+    def stats_of(self, peer: Follower) -> PeerStats:
+        with self.lock:
+            return self.stats.setdefault(peer, PeerStats())
+
+    def _average(self, average: float | None, value: float) -> float:
+        if average is None:
+            return value
+        return average + self.smoothing * (value - average)
+
+    def record_success(self, peer: Follower, blocks: int, seconds: float):
+        stats = self.stats_of(peer)
+        with self.lock:
+            stats.requests += 1
+            stats.blocks += blocks
+            stats.latency = self._average(stats.latency, seconds)
+            if blocks > 0:
+                stats.throughput = self._average(
+                    stats.throughput, blocks / max(seconds, 1e-6)
+                )
+
+    def record_failure(self, peer: Follower):
+        stats = self.stats_of(peer)
+        with self.lock:
+            stats.requests += 1
+            stats.failures += 1
+
+    def record_invalid(self, peer: Follower, blocks: int):
+        stats = self.stats_of(peer)
+        with self.lock:
+            stats.invalid_blocks += blocks
+
+    def is_demoted(self, peer: Follower) -> bool:
+        return self.stats_of(peer).invalid_blocks >= self.max_invalid_blocks
+
+    def expected_time(self, peer: Follower) -> float:
+        stats = self.stats_of(peer)
+        if stats.requests == 0:
+            return 0.0
+        if stats.latency is None:
+            # every request failed
+            return math.inf
+        return stats.latency / (1 - stats.failure_rate)
+
+    def expected_throughput(self, peer: Follower) -> float:
+        stats = self.stats_of(peer)
+        if stats.requests == 0:
+            return math.inf
+        if stats.throughput is None:
+            return 0.0
+        return stats.throughput * (1 - stats.failure_rate)
+
+    def available(self, peers: list[Follower]) -> list[Follower]:
+        # The peers that are not demoted, in the given order, or all of them if all are.
+        return [p for p in peers if not self.is_demoted(p)] or list(peers)
+
+    def rank(self, peers: list[Follower], bulk: bool = False) -> list[Follower]:
+        # All peers, the best ones first and the demoted ones last.
+        if bulk:
+            return sorted(
+                peers, key=lambda p: (self.is_demoted(p), -self.expected_throughput(p))
+            )
+        return sorted(peers, key=lambda p: (self.is_demoted(p), self.expected_time(p)))
+
+
+class OrphanPool:
+    # Blocks whose parent is missing from the local block tree, indexed by that parent,
+    # until the parent arrives or they are evicted.
+    #
+    # The pool holds at most `max_size` blocks, evicting the oldest ones first,
+    # and blocks older than `max_age` seconds are evicted as well.
+
+    def __init__(
+        self,
+        max_size: int = 4096,
+        max_age: float | None = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        assert max_size > 0
+        self.max_size = max_size
+        self.max_age = max_age
+        self.clock = clock
+        # blocks by ID, oldest first, with the time they were added
+        self.blocks: OrderedDict[Hash, tuple[BlockHeader, float]] = OrderedDict()
+        # IDs of the blocks waiting for each parent
+        self.children: dict[Hash, list[Hash]] = defaultdict(list)
+
+    def __len__(self) -> int:
+        return len(self.blocks)
+
+    def __contains__(self, block_id: Hash) -> bool:
+        return block_id in self.blocks
+
+    def add(self, block: BlockHeader):
+        if block.id() in self.blocks:
+            return
+        self.blocks[block.id()] = (block, self.clock())
+        self.children[block.parent].append(block.id())
+        while len(self.blocks) > self.max_size:
+            self.discard(next(iter(self.blocks)))
+        self.expire()
+
+    def expire(self):
+        if self.max_age is None:
+            return
+        deadline = self.clock() - self.max_age
+        while self.blocks:
+            block_id, (_, added) = next(iter(self.blocks.items()))
+            if added > deadline:
+                break
+            self.discard(block_id)
+
+    def discard(self, block_id: Hash):
+        # Removes a block, leaving the blocks waiting for it in the pool.
+        entry = self.blocks.pop(block_id, None)
+        if entry is None:
+            return
+        parent = entry[0].parent
+        siblings = self.children[parent]
+        siblings.remove(block_id)
+        if not siblings:
+            del self.children[parent]
+
+    def pop_descendants(self, parent: Hash) -> list[BlockHeader]:
+        # Removes the blocks waiting for `parent`, directly or through other blocks
+        # of the pool, and returns them in depth-first order, parents before children.
+        descendants = []
+        stack = list(reversed(self.children.pop(parent, [])))
+        while stack:
+            block, _ = self.blocks.pop(stack.pop())
+            descendants.append(block)
+            stack.extend(reversed(self.children.pop(block.id(), [])))
+        return descendants
+
+    def roots(self) -> list[BlockHeader]:
+        # The blocks whose parent is not in the pool either: the blocks to backfill,
+        # one per subtree of orphans.
+        self.expire()
+        return [
+            block for block, _ in self.blocks.values() if block.parent not in self.blocks
+        ]
+
+
+class _StageError:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+_DONE = object()
+
+
+class _Pipeline:
+    # Runs the stages of a pipeline on their own threads, each connected to the next
+    # stage by a bounded queue. Leaving the context stops the stages still running.
+    #
+    # Every stage ends its queue with a sentinel, `_DONE` or a `_StageError`, which
+    # stays at the end of the queue: whoever takes it puts it back, so that every
+    # consumer of the queue sees the end of the stream.
+
+    def __init__(self, queue_size: int):
+        assert queue_size > 0
+        self.queue_size = queue_size
+        self.stopped = threading.Event()
+        self.threads: list[threading.Thread] = []
+        self.queues: list[queue.Queue] = []
+
+    def stage(self, items: Iterable[T]) -> Generator[T, None, None]:
+        # Produces `items` on a new thread, and returns a stream of them for the next stage.
+        # Errors raised while producing them are raised by the stream.
+        out: queue.Queue = queue.Queue(self.queue_size)
+        thread = threading.Thread(target=self._produce, args=(items, out), daemon=True)
+        thread.start()
+        self.threads.append(thread)
+        self.queues.append(out)
+        return self._consume(out)
+
+    def _produce(self, items: Iterable, out: queue.Queue):
+        try:
+            try:
+                for item in items:
+                    if self.stopped.is_set():
+                        break
+                    out.put(item)
+            finally:
+                # release what the items hold, e.g. the executor of the block fetcher
+                if isinstance(items, Generator):
+                    items.close()
+        except BaseException as e:
+            out.put(_StageError(e))
+        else:
+            out.put(_DONE)
+
+    @staticmethod
+    def _is_end(item) -> bool:
+        return item is _DONE or isinstance(item, _StageError)
+
+    def _consume(self, out: queue.Queue) -> Generator:
+        while not self._is_end(item := out.get()):
+            yield item
+        out.put(item)
+        if isinstance(item, _StageError):
+            raise item.error
+
+    def __enter__(self) -> "_Pipeline":
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        # Drain the queues, upstream first, so that no stage stays blocked on a full
+        # queue, until each stage has ended its stream.
+        for thread, out in zip(self.threads, self.queues):
+            while not self._is_end(item := out.get()):
+                pass
+            out.put(item)
+            thread.join()
 
 
 def backfill_fork(
     local: Follower,
     fork_tip: BlockHeader,
     block_fetcher: "BlockFetcher",
-):
+) -> list[Hash]:
     # Backfills a fork, which is absent in the local block tree, by fetching blocks from the peers.
-    # During backfilling, the fork choice rule is continuously applied.
+    # The fork choice rule is applied once the whole fork suffix has been added.
+    # Returns the IDs of the blocks added, in chain order.
 
-    suffix = find_missing_part(
-        local,
-        block_fetcher.fetch_chain_backward(fork_tip.id(), local),
-    )
+    suffix = block_fetcher.fetch_chain_forward(fork_tip.id(), local)
+    if suffix is None:
+        # No peer could locate the fork, so walk it backwards instead.
+        suffix = find_missing_part(
+            local,
+            block_fetcher.fetch_chain_backward(fork_tip.id(), local),
+        )
 
-    # Add blocks in the fork suffix with applying fork choice rule.
-    # After all, add the tip of the fork suffix to apply the fork choice rule.
-    for i, block in enumerate(suffix):
-        try:
-            local.on_block(block)
-        except Exception as e:
-            raise InvalidBlockFromBackfillFork(e, suffix[i:])
+    # Add blocks in the fork suffix as a single batch.
+    # Since the suffix is a single chain, the outcome is the same
+    # as applying the fork choice rule after each block.
+    rejected = local.on_blocks(suffix)
+    if rejected:
+        block, e = rejected[0]
+        if is_invalid_block(e):
+            block_fetcher.report_invalid([block])
+    block_fetcher.forget(suffix)
+    if rejected:
+        i = next(i for i, b in enumerate(suffix) if b.id() == block.id())
+        raise InvalidBlockFromBackfillFork(e, suffix[i:])
+    return [block.id() for block in suffix]
 
 
 def find_missing_part(
@@ -113,48 +537,232 @@ def find_missing_part(
 
 
 class BlockFetcher:
-    # NOTE: This class is a mock, which uses a naive approach to fetch blocks from multiple peers.
-    # In real implementation, any optimized way can be used, such as parallel fetching.
+    # Fetches blocks from multiple peers concurrently, on a pool of threads.
+    #
+    # The range of slots to fetch is split into windows of `window_size` slots, which are
+    # requested from different peers in parallel and reassembled in order of slot.
+    # A window is reassigned to another peer if its peer fails, or has not answered
+    # within `timeout` seconds, in which case the first answer received is used.
+    #
+    # Every request is recorded in `peer_manager`, whose estimates decide which peer
+    # serves each window. The blocks served are remembered along with their peer until
+    # they are settled, so that peers can be held to account for invalid blocks.
 
-    def __init__(self, peers: list[Follower]):
+    def __init__(
+        self,
+        peers: list[Follower],
+        window_size: int = 64,
+        max_workers: int = 8,
+        timeout: float | None = None,
+        peer_manager: "PeerManager | None" = None,
+    ):
+        assert window_size > 0 and max_workers > 0
         self.peers = peers
+        self.window_size = window_size
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.peer_manager = PeerManager() if peer_manager is None else peer_manager
+        # the peer that served each block
+        self.sources: dict[Hash, Follower] = {}
+
+    def report_invalid(self, blocks: list[BlockHeader]):
+        # Charges the peers that served blocks which turned out to be invalid.
+        counts: dict[Follower, int] = defaultdict(int)
+        for block in blocks:
+            peer = self.sources.get(block.id())
+            if peer is not None:
+                counts[peer] += 1
+        for peer, count in counts.items():
+            self.peer_manager.record_invalid(peer, count)
+
+    def forget(self, blocks: Iterable[BlockHeader]):
+        # Forgets the peers of blocks that have been applied or rejected.
+        for block in blocks:
+            self.sources.pop(block.id(), None)
 
     def fetch_blocks_from(self, start_slot: Slot) -> Generator[BlockHeader, None, None]:
         # Filter peers that have a tip ahead of the local tip
         # and group peers by their tip to minimize the number of fetches.
+        # Peers of a group share a chain, so any of them can serve any window of it.
+        # The last window of a group is left open-ended, since peers may hold fork blocks
+        # at slots after the slot of their tip.
         groups = self.filter_and_group_peers_by_tip(start_slot)
-        for group in groups.values():
-            for block in BlockFetcher.fetch_blocks_by_slot(group, start_slot):
-                yield block
+        windows = []
+        for tip, group in groups.items():
+            starts = range(
+                start_slot.absolute_slot, tip.slot.absolute_slot + 1, self.window_size
+            )
+            for from_slot in starts:
+                to_slot = from_slot + self.window_size
+                windows.append(
+                    _Window(
+                        group,
+                        Slot(from_slot),
+                        Slot(to_slot) if to_slot <= tip.slot.absolute_slot else None,
+                    )
+                )
+        pool = ThreadPoolExecutor(self.max_workers)
+        try:
+            yield from self._fetch_windows(pool, windows)
+        finally:
+            # Do not wait for stalled peers.
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def _fetch_windows(
+        self, pool: ThreadPoolExecutor, windows: list["_Window"]
+    ) -> Generator[BlockHeader, None, None]:
+        # Keeps up to `max_workers` requests in flight, and yields the blocks of each
+        # window, group by group and in order of slot, as soon as all windows before
+        # it have been yielded.
+        inflight: dict[Future, tuple[int, Follower, float]] = {}
+        load: dict[Follower, int] = defaultdict(int)  # requests in flight, by peer
+        stalled: set[Future] = set()
+        fetched: dict[int, list[BlockHeader]] = {}
+        next_request = 0
+        next_yield = 0
+
+        def request(i: int):
+            window = windows[i]
+            peers = [p for p in window.peers if p not in window.tried]
+            if not peers:
+                if not any(j == i for j, _, _ in inflight.values()):
+                    # Every peer failed. The missing blocks are left for the next round
+                    # of the sync, or to backfilling.
+                    fetched[i] = []
+                return
+            # The peer expected to answer first, given the requests it already has in flight.
+            peer = min(
+                peers,
+                key=lambda p: (
+                    (load[p] + 1) * self.peer_manager.expected_time(p),
+                    load[p],
+                ),
+            )
+            window.tried.add(peer)
+            load[peer] += 1
+            future = pool.submit(_fetch_window, peer, window.from_slot, window.to_slot)
+            inflight[future] = (i, peer, time.monotonic())
+
+        while next_yield < len(windows):
+            while next_request < len(windows) and len(inflight) < self.max_workers:
+                request(next_request)
+                next_request += 1
+
+            if next_yield in fetched:
+                yield from fetched.pop(next_yield)
+                next_yield += 1
+                continue
+
+            done, _ = wait(
+                inflight,
+                timeout=self._wait_timeout(inflight, stalled),
+                return_when=FIRST_COMPLETED,
+            )
+            for future in done:
+                i, peer, started = inflight.pop(future)
+                load[peer] -= 1
+                try:
+                    blocks = future.result()
+                except Exception:
+                    blocks = None
+                # A stalled request has already been recorded as a failure.
+                if future not in stalled:
+                    if blocks is None:
+                        self.peer_manager.record_failure(peer)
+                    else:
+                        self.peer_manager.record_success(
+                            peer, len(blocks), time.monotonic() - started
+                        )
+                stalled.discard(future)
+                if i in fetched or i < next_yield:
+                    # already answered by another peer
+                    continue
+                if blocks is None:
+                    request(i)
+                else:
+                    for block in blocks:
+                        self.sources[block.id()] = peer
+                    fetched[i] = blocks
+
+            if self.timeout is not None:
+                now = time.monotonic()
+                for future, (i, peer, started) in list(inflight.items()):
+                    if future not in stalled and now - started >= self.timeout:
+                        stalled.add(future)
+                        # a late answer is still used, but counts as a failure
+                        self.peer_manager.record_failure(peer)
+                        if i not in fetched and i >= next_yield:
+                            request(i)
+
+    def _wait_timeout(self, inflight: dict, stalled: set[Future]) -> float | None:
+        # Time until the next request in flight stalls.
+        if self.timeout is None:
+            return None
+        deadlines = [
+            started + self.timeout
+            for future, (_, _, started) in inflight.items()
+            if future not in stalled
+        ]
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - time.monotonic())
 
     def filter_and_group_peers_by_tip(
         self, start_slot: Slot
     ) -> dict[BlockHeader, list[Follower]]:
         # Group peers by their tip.
-        # Filter only the peers whose tip is ahead of the start_slot.
+        # Filter only the peers whose tip is ahead of the start_slot,
+        # leaving out demoted peers as long as other peers are available.
         groups: dict[BlockHeader, list[Follower]] = defaultdict(list)
-        for peer in self.peers:
+        for peer in self.peer_manager.available(self.peers):
             if peer.tip().slot.absolute_slot > start_slot.absolute_slot:
                 groups[peer.tip()].append(peer)
         return groups
 
-    @staticmethod
-    def fetch_blocks_by_slot(
-        peers: list[Follower], start_slot: Slot
-    ) -> Generator[BlockHeader, None, None]:
-        # Fetch blocks in the given range of slots from one of the peers.
-        # Blocks should be returned in order of slot.
-        # If a peer fails, try the next peer.
-        for peer in peers:
+    def fetch_chain_forward(
+        self, tip: Hash, local: Follower, page_size: int = 512
+    ) -> list[BlockHeader] | None:
+        # Fetches the blocks of the chain ending at the given tip that are missing from
+        # the local block tree, in chain order.
+        # A block locator of the local chain finds where the chain forks off it in a single
+        # request, then the blocks after that point are downloaded forward, in pages of
+        # `page_size` blocks. Returns None if no peer can locate the chain.
+        locator = local.block_locator()
+        for peer in self.peer_manager.rank(self.peers, bulk=True):
+            started = time.monotonic()
             try:
-                for block in peer.blocks_by_slot(start_slot):
-                    yield block
-                    # Update start_slot for the potential try with the next peer.
-                    start_slot = block.slot
-                # The peer successfully returned all blocks. No need to try the next peer.
-                break
+                blocks = self._fetch_after_locator(peer, locator, tip, page_size)
             except Exception:
+                self.peer_manager.record_failure(peer)
+                continue
+            if blocks is None:
                 continue
+            self.peer_manager.record_success(
+                peer, len(blocks), time.monotonic() - started
+            )
+            for block in blocks:
+                self.sources[block.id()] = peer
+            # The fork point is on the local chain, so blocks of the chain that are
+            # already in the local block tree, from a partial backfilling, come first.
+            i = 0
+            while i < len(blocks) and blocks[i].id() in local.ledger_state:
+                i += 1
+            return blocks[i:]
+        return None
+
+    @staticmethod
+    def _fetch_after_locator(
+        peer: Follower, locator: list[Hash], tip: Hash, page_size: int
+    ) -> list[BlockHeader] | None:
+        blocks: list[BlockHeader] = []
+        while True:
+            page = peer.blocks_after_locator(locator, tip, page_size)
+            if page is None:
+                return None
+            blocks += page
+            if not page or page[-1].id() == tip:
+                return blocks
+            locator = [page[-1].id()]
 
     def fetch_chain_backward(
         self, tip: Hash, local: Follower
@@ -180,6 +788,22 @@ class BlockFetcher:
                 id = block.parent
 
 
+@dataclass
+class _Window:
+    # A range of slots [from_slot, to_slot) to fetch from one of the peers, with no upper
+    # bound if `to_slot` is None, along with the peers it has been requested from.
+    peers: list[Follower]
+    from_slot: Slot
+    to_slot: Slot | None
+    tried: set[Follower] = field(default_factory=set)
+
+
+def _fetch_window(
+    peer: Follower, from_slot: Slot, to_slot: Slot | None
+) -> list[BlockHeader]:
+    return list(peer.blocks_by_slot(from_slot, to_slot))
+
+
 class InvalidBlockFromBackfillFork(Exception):
     def __init__(self, cause: Exception, invalid_suffix: list[BlockHeader]):
         super().__init__()
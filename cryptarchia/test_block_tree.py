@@ -0,0 +1,243 @@
+from unittest import TestCase
+import random
+
+from .block_tree import BlockTree
+from .cryptarchia import LedgerState, Note, height, is_ancestor, iter_chain
+from .test_common import mk_block, mk_genesis_state
+
+
+def mk_random_tree(n: int, seed: int = 0) -> list:
+    # Builds `n` blocks on top of the genesis block, each extending a random earlier block
+    rng = random.Random(seed)
+    notes = [Note(sk=i, value=1) for i in range(4)]
+    blocks = [mk_genesis_state([]).block]
+    for i in range(1, n + 1):
+        parent = rng.choice(blocks[-8:] if rng.random() < 0.9 else blocks)
+        slot = parent.slot.absolute_slot + 1
+        # distinct contents keep blocks with the same parent, slot and note apart
+        content = i.to_bytes(4, "big")
+        blocks.append(mk_block(parent, slot, rng.choice(notes), content=content))
+    return blocks
+
+
+class TestBlockTree(TestCase):
+    def test_queries_match_chain_walks(self):
+        blocks = mk_random_tree(300)
+        states = {b.id(): LedgerState(block=b) for b in blocks}
+        tree = BlockTree(states)
+
+        assert set(tree) == set(states)
+        rng = random.Random(1)
+        for _ in range(500):
+            a, b = rng.choice(blocks).id(), rng.choice(blocks).id()
+            assert tree.height(a) == height(a, states) - 1
+            assert tree.is_ancestor(a, b) == is_ancestor(a, b, states)
+            assert tree.is_ancestor(b, a) == is_ancestor(b, a, states)
+
+            depth = rng.randrange(tree.height(b) + 3)
+            chain = list(iter_chain(b, states))
+            expected = chain[min(depth, len(chain) - 1)].block.id()
+            assert tree.ancestor(b, depth) == expected
+
+    def test_lca_matches_chain_walks(self):
+        blocks = mk_random_tree(300, seed=4)
+        states = {b.id(): LedgerState(block=b) for b in blocks}
+        tree = BlockTree(states)
+
+        rng = random.Random(5)
+        for _ in range(500):
+            a, b = rng.choice(blocks).id(), rng.choice(blocks).id()
+            a_chain = [s.block.id() for s in iter_chain(a, states)]
+            b_chain = {s.block.id() for s in iter_chain(b, states)}
+            expected = next(x for x in a_chain if x in b_chain)
+
+            lca, a_depth, b_depth = tree.divergence(a, b)
+            assert lca == expected
+            assert a_depth == a_chain.index(lca)
+            assert b_depth == tree.height(b) - tree.height(lca)
+            assert [x.id() for x in tree.chain(a, lca)] == a_chain[: a_depth + 1][::-1]
+
+    def test_density_matches_chain_scan(self):
+        blocks = mk_random_tree(300, seed=6)
+        states = {b.id(): LedgerState(block=b) for b in blocks}
+        tree = BlockTree(states)
+
+        rng = random.Random(7)
+        for _ in range(500):
+            tip = rng.choice(blocks).id()
+            chain = [s.block for s in iter_chain(tip, states)]
+            ancestor = rng.choice(chain)
+            slot = ancestor.slot.absolute_slot + rng.randrange(-2, 40)
+
+            suffix = chain[: chain.index(ancestor) + 1]
+            expected = sum(1 for b in suffix if b.slot.absolute_slot < slot)
+            assert tree.density(tip, ancestor.id(), slot) == expected
+
+            before = next((b.id() for b in chain if b.slot.absolute_slot < slot), None)
+            assert tree.last_before_slot(tip, slot) == before
+
+    def test_insertion_order(self):
+        # parents are indexed before their children regardless of the input order
+        blocks = mk_random_tree(50, seed=2)
+        states = {b.id(): LedgerState(block=b) for b in reversed(blocks)}
+        tree = BlockTree(states)
+        for b in blocks:
+            assert tree.height(b.id()) == height(b.id(), states) - 1
+
+    def test_delete(self):
+        genesis = mk_genesis_state([]).block
+        note = Note(sk=0, value=1)
+        b1 = mk_block(genesis, 1, note)
+        b2 = mk_block(b1, 2, note)
+        tree = BlockTree({b.id(): LedgerState(block=b) for b in [genesis, b1, b2]})
+
+        del tree[b2.id()]
+        assert b2.id() not in tree
+        assert len(tree) == 2
+        assert not tree.is_ancestor(b1.id(), b2.id())
+        assert tree.is_ancestor(genesis.id(), b1.id())
+
+    def test_prune_forks(self):
+        #       b3 - b4
+        #      /
+        # g - b1 - b2 - b5
+        #            \
+        #             b6
+        genesis = mk_genesis_state([]).block
+        n_a, n_b = Note(sk=0, value=1), Note(sk=1, value=1)
+        b1 = mk_block(genesis, 1, n_a)
+        b2 = mk_block(b1, 2, n_a)
+        b5 = mk_block(b2, 3, n_a)
+        b3 = mk_block(b1, 2, n_b)
+        b4 = mk_block(b3, 3, n_b)
+        b6 = mk_block(b2, 3, n_b)
+        blocks = [genesis, b1, b2, b3, b4, b5, b6]
+        tree = BlockTree({b.id(): LedgerState(block=b) for b in blocks})
+
+        removed = tree.prune_forks(b2.id(), genesis.id())
+        assert set(removed) == {b3.id(), b4.id()}
+        assert set(tree) == {genesis.id(), b1.id(), b2.id(), b5.id(), b6.id()}
+
+        removed = tree.prune_forks(b5.id(), b2.id())
+        assert removed == [b6.id()]
+        assert set(tree) == {genesis.id(), b1.id(), b2.id(), b5.id()}
+
+        with self.assertRaises(ValueError):
+            del tree[b2.id()]
+
+    def test_removed_blocks_free_their_integers(self):
+        # Grow a random tree while repeatedly pruning its forks, as a follower does, and
+        # check the tree against chain walks over a plain dict of the remaining states.
+        rng = random.Random(2)
+        notes = [Note(sk=i, value=1) for i in range(4)]
+        genesis = mk_genesis_state([]).block
+        tree = BlockTree({genesis.id(): LedgerState(block=genesis)})
+        tips = [genesis]
+        root = genesis.id()
+        peak = 0
+        for i in range(1, 600):
+            parent = rng.choice(tips)
+            slot = parent.slot.absolute_slot + 1
+            content = i.to_bytes(4, "big")
+            block = mk_block(parent, slot, rng.choice(notes), content=content)
+            tree[block.id()] = LedgerState(block=block, leader_count=i)
+            tips.append(block)
+            peak = max(peak, len(tree))
+            if i % 20 == 0:
+                new_root = tree.ancestor(block.id(), 5)
+                tree.prune_forks(new_root, root)
+                root = new_root
+            # keep building on the blocks descending from the root only
+            tips = [t for t in tips[-10:] if tree.is_ancestor(root, t.id())]
+
+        # removed blocks left their integers to later blocks
+        assert len(tree._ids) <= peak
+
+        states = {b: tree[b] for b in tree}
+        assert sorted(tree.subtree(genesis.id())) == sorted(tree)
+        for b in states:
+            assert height(b, tree) == height(b, states)
+            assert tree.leader_count(b) == states[b].leader_count
+            assert list(iter_chain(b, tree)) == list(iter_chain(b, states))
+            a = rng.choice(list(states))
+            assert is_ancestor(a, b, tree) == is_ancestor(a, b, states)
+
+    def test_blocks_by_slot(self):
+        blocks = mk_random_tree(200, seed=3)
+        tree = BlockTree({b.id(): LedgerState(block=b) for b in blocks})
+
+        def expected(from_slot, to_slot=None):
+            return sorted(
+                (
+                    b
+                    for b in blocks
+                    if from_slot <= b.slot.absolute_slot
+                    and (to_slot is None or b.slot.absolute_slot < to_slot)
+                ),
+                key=lambda b: b.slot,
+            )
+
+        assert list(tree.blocks_by_slot(0)) == expected(0)
+        assert list(tree.blocks_by_slot(10, 20)) == expected(10, 20)
+        assert list(tree.blocks_by_slot(10, 20, limit=3)) == expected(10, 20)[:3]
+        assert list(tree.blocks_by_slot(10_000)) == []
+
+        # paginating from the last block returned covers the whole range
+        pages = []
+        from_slot, after = 0, None
+        while page := list(tree.blocks_by_slot(from_slot, limit=7, after=after)):
+            pages.extend(page)
+            from_slot, after = page[-1].slot.absolute_slot, page[-1].id()
+        assert pages == expected(0)
+
+    def test_blocks_by_slot_follows_changes(self):
+        genesis = mk_genesis_state([]).block
+        note = Note(sk=0, value=1)
+        b1 = mk_block(genesis, 1, note)
+        b2 = mk_block(b1, 2, note)
+        b3 = mk_block(b2, 3, note)
+        fork = mk_block(genesis, 2, Note(sk=1, value=1))
+        tree = BlockTree({b.id(): LedgerState(block=b) for b in [genesis, b1, b2]})
+
+        stream = tree.blocks_by_slot(1)
+        assert next(stream) == b1
+        tree[b3.id()] = LedgerState(block=b3)
+        tree[fork.id()] = LedgerState(block=fork)
+        assert list(stream) == [b2, fork, b3]
+
+        stream = tree.blocks_by_slot(0)
+        assert next(stream) == genesis
+        tree.prune_forks(b1.id(), genesis.id())
+        assert list(stream) == [b1, b2, b3]
+
+    def test_blocks_by_slot_resumes_after_removed_block(self):
+        # genesis - a1 - a2
+        #         \ b1
+        #         \ c1
+        genesis = mk_genesis_state([]).block
+        a1 = mk_block(genesis, 1, Note(sk=0, value=1))
+        b1 = mk_block(genesis, 1, Note(sk=1, value=1))
+        c1 = mk_block(genesis, 1, Note(sk=2, value=1))
+        a2 = mk_block(a1, 2, Note(sk=0, value=1))
+        tree = BlockTree(
+            {b.id(): LedgerState(block=b) for b in [genesis, a1, b1, c1, a2]}
+        )
+
+        stream = tree.blocks_by_slot(1)
+        assert [next(stream), next(stream)] == [a1, b1]
+        # the last block returned is removed mid-stream, the blocks before it are not
+        # returned again
+        del tree[b1.id()]
+        assert list(stream) == [c1, a2]
+
+    def test_overwrite_updates_every_column(self):
+        genesis = mk_genesis_state([]).block
+        b1 = mk_block(genesis, 1, Note(sk=0, value=1))
+        tree = BlockTree({b.id(): LedgerState(block=b) for b in [genesis, b1]})
+
+        state = LedgerState(block=b1, leader_count=5)
+        tree[b1.id()] = state
+        assert tree[b1.id()] is state
+        assert tree.leader_count(b1.id()) == 5
+        assert len(tree) == 2
+        assert list(tree.blocks_by_slot(0)) == [genesis, b1]
@@ -0,0 +1,92 @@
+from unittest import TestCase
+
+from .codec import HEADER_SIZE, DecodeError, decode_header, decode_headers, encode_headers
+from .cryptarchia import Hash, Note, Slot
+from .test_common import mk_block, mk_chain, mk_genesis_state
+
+
+class TestCodec(TestCase):
+    def test_encoding_follows_header_rule(self):
+        note = Note(sk=1, value=10)
+        genesis = mk_genesis_state([note])
+        block = mk_block(genesis.block, 3, note, content=Hash(b"CONTENT"))
+        encoded = block.encode()
+
+        assert len(encoded) == HEADER_SIZE
+        assert encoded[0] == 1
+        assert int.from_bytes(encoded[1:5], "big") == block.content_size
+        assert encoded[5:37] == block.content_id
+        assert encoded[37:45] == Slot(3).encode()
+        assert encoded[45:77] == genesis.block.id()
+        assert encoded[77:109] == note.commitment()
+        assert encoded[109:141] == note.nullifier()
+        assert encoded[141:173] == note.commitment()
+        assert encoded[173:] == bytes(4)
+        assert block.id() == Hash(b"BLOCK_ID", encoded)
+        # the encoding is computed once
+        assert block.encode() is encoded
+
+    def test_round_trip(self):
+        notes = [Note(sk=0, value=10), Note(sk=1, value=20)]
+        genesis = mk_genesis_state(notes)
+        chain = mk_chain(genesis.block, notes[0], slots=[1, 2, 5])
+        chain += mk_chain(chain[-1], notes[1], slots=[7, 8])
+        by_commitment = {n.commitment(): n for n in notes}
+
+        stream = encode_headers(chain)
+        views = list(decode_headers(stream))
+        assert len(views) == len(chain)
+        for view, block in zip(views, chain):
+            # views share the stream's buffer
+            assert view.buf.obj is stream
+            assert view.id() == block.id()
+            assert view.slot == block.slot
+            assert view.parent == block.parent
+            assert view.content_size == block.content_size
+            assert view.content_id == block.content_id
+            assert view.orphan_proofs() == []
+            assert bytes(view) == block.encode()
+
+            header = view.header(by_commitment)
+            assert header == block
+            assert header.id() == block.id()
+
+        assert decode_header(chain[0].encode()).header(by_commitment) == chain[0]
+
+    def test_orphan_proofs(self):
+        note = Note(sk=0, value=10)
+        genesis = mk_genesis_state([note])
+        a, b = mk_chain(genesis.block, note, slots=[1, 2])
+        orphan = mk_block(genesis.block, 1, note, content=Hash(b"ORPHAN"))
+
+        # a header carrying one orphan proof, followed by a plain header
+        with_orphan = a.encode()[:-4] + (1).to_bytes(4, "big") + orphan.encode()
+        views = list(decode_headers(with_orphan + b.encode()))
+        assert [bytes(v) for v in views] == [with_orphan, b.encode()]
+        assert [o.id() for o in views[0].orphan_proofs()] == [orphan.id()]
+        with self.assertRaises(DecodeError):
+            views[0].header({note.commitment(): note})
+
+    def test_invalid_encodings(self):
+        note = Note(sk=0, value=10)
+        block = mk_block(mk_genesis_state([note]).block, 1, note)
+        encoded = block.encode()
+
+        with self.assertRaises(DecodeError):
+            decode_header(encoded[:-1])
+        with self.assertRaises(DecodeError):
+            decode_header(encoded + b"\x00")
+        with self.assertRaises(DecodeError):
+            decode_header(b"\x02" + encoded[1:])
+        with self.assertRaises(DecodeError):
+            list(decode_headers(encoded + encoded[:10]))
+        with self.assertRaises(DecodeError):
+            decode_header(encoded).header({})
+
+        # orphan proofs nested deeper than the call stack allows
+        nested = encoded[:-4] + (1).to_bytes(4, "big")
+        with self.assertRaises(DecodeError):
+            decode_header(nested * 10_000)
+        view = decode_header(nested * 10_000 + encoded)
+        assert len(view) == 10_001 * len(encoded)
+        assert [len(o) for o in view.orphan_proofs()] == [10_000 * len(encoded)]
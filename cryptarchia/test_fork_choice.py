@@ -1,5 +1,6 @@
 from unittest import TestCase
 
+import random
 from copy import deepcopy
 from cryptarchia.cryptarchia import (
     maxvalid_bg,
@@ -11,6 +12,9 @@ from cryptarchia.cryptarchia import (
     common_prefix_depth,
     LedgerState,
     ImmutableFork,
+    InvalidSlot,
+    ParentNotFound,
+    is_ancestor,
 )
 
 from .test_common import mk_chain, mk_config, mk_genesis_state, mk_block
@@ -397,3 +401,200 @@ class TestForkChoice(TestCase):
         follower.on_block(b11)
 
         assert follower.lib == blocks[1].id(), follower.lib
+
+    def test_lib_pruning_matches_full_scan(self):
+        # Grow a random block tree on an online follower and check that the incremental
+        # pruning keeps exactly the blocks that a full scan relative to the LIB would keep.
+        rng = random.Random(0)
+        notes = [Note(sk=i, value=10) for i in range(4)]
+        config = mk_config(notes).replace(k=3)
+        genesis = mk_genesis_state(notes)
+        follower = Follower(genesis, config)
+        follower.to_online()
+
+        # every block ever accepted by the follower
+        accepted = {genesis.block.id(): LedgerState(block=genesis.block)}
+        for slot in range(1, 300):
+            parent = accepted[rng.choice(list(follower.ledger_state.keys())[-6:])]
+            block = mk_block(parent.block, slot, rng.choice(notes))
+            try:
+                follower.on_block(block)
+            except ImmutableFork:
+                continue
+            accepted[block.id()] = LedgerState(block=block)
+
+            lib = follower.lib
+            assert set(follower.ledger_state) == {
+                b
+                for b in accepted
+                if is_ancestor(lib, b, accepted) or is_ancestor(b, lib, accepted)
+            }
+            assert all(is_ancestor(lib, f, accepted) for f in follower.forks)
+            assert follower.tip_id() not in follower.forks
+
+    def test_on_blocks_matches_on_block(self):
+        # Feed the same random chains to two followers, block by block to one and as
+        # batches to the other, and check that they always agree on the block tree.
+        rng = random.Random(1)
+        notes = [Note(sk=i, value=10) for i in range(4)]
+        config = mk_config(notes).replace(k=5)
+        genesis = mk_genesis_state(notes)
+
+        for online in [False, True]:
+            one_by_one = Follower(genesis, config)
+            batched = Follower(genesis, config)
+            if online:
+                one_by_one.to_online()
+                batched.to_online()
+
+            slot = 0
+            for _ in range(60):
+                tree = one_by_one.ledger_state
+                candidates = [b for b in tree if tree.is_ancestor(one_by_one.lib, b)]
+                parent = tree[rng.choice(candidates[-8:])].block
+                chain = []
+                for _ in range(rng.randint(1, 6)):
+                    slot += rng.randint(1, 2)
+                    chain.append(mk_block(parent, slot, rng.choice(notes)))
+                    parent = chain[-1]
+
+                for block in chain:
+                    one_by_one.on_block(block)
+                assert batched.on_blocks(chain) == []
+
+                assert batched.tip_id() == one_by_one.tip_id()
+                assert batched.forks == one_by_one.forks
+                assert batched.lib == one_by_one.lib
+                assert list(batched.ledger_state) == list(one_by_one.ledger_state)
+
+    def test_on_blocks_with_several_branches_matches_on_block(self):
+        # Batches mixing branches, some of which fork off before the LIB or off branches
+        # that the LIB prunes in the middle of the batch.
+        rng = random.Random(3)
+        notes = [Note(sk=i, value=10) for i in range(4)]
+        config = mk_config(notes).replace(k=2)
+        genesis = mk_genesis_state(notes)
+
+        for online in [False, True]:
+            one_by_one = Follower(genesis, config)
+            batched = Follower(genesis, config)
+            if online:
+                one_by_one.to_online()
+                batched.to_online()
+            # every block ever created, including those that were rejected
+            blocks = [genesis.block]
+
+            slot = 0
+            for _ in range(80):
+                batch = []
+                for _ in range(rng.randint(1, 8)):
+                    parent = rng.choice(blocks[-12:])
+                    slot = max(slot + rng.randint(0, 1), parent.slot.absolute_slot)
+                    batch.append(mk_block(parent, slot, rng.choice(notes)))
+                    blocks.append(batch[-1])
+
+                expected = []
+                for block in batch:
+                    try:
+                        one_by_one.on_block(block)
+                    except Exception as e:
+                        expected.append((block, type(e)))
+                rejected = batched.on_blocks(batch)
+
+                assert [(b, type(e)) for b, e in rejected] == expected
+                assert batched.tip_id() == one_by_one.tip_id()
+                assert batched.forks == one_by_one.forks
+                assert batched.lib == one_by_one.lib
+                assert list(batched.ledger_state) == list(one_by_one.ledger_state)
+
+    def test_on_blocks_skips_invalid_blocks(self):
+        # b1 is invalid (its slot is before its parent's), so b2 is orphaned,
+        # but the blocks on the other branch are still applied.
+        #
+        # b0 - b1 - b2
+        #    \
+        #     b3 - b4
+        note = Note(sk=0, value=10)
+        genesis = mk_genesis_state([note])
+        follower = Follower(genesis, mk_config([note]))
+
+        b0 = mk_block(genesis.block, 2, note)
+        b1 = mk_block(b0, 1, note)
+        b2 = mk_block(b1, 3, note)
+        b3, b4 = mk_chain(b0, note, slots=[3, 4])
+
+        rejected = follower.on_blocks([b0, b1, b2, b3, b4])
+
+        assert [block for block, _ in rejected] == [b1, b2]
+        assert isinstance(rejected[0][1], InvalidSlot)
+        assert isinstance(rejected[1][1], ParentNotFound)
+        assert follower.tip() == b4
+        assert follower.forks == []
+
+    def test_tip_changed_on_reorg(self):
+        # b0 - b1 - b2
+        #    \
+        #     b3 - b4 - b5
+        note = Note(sk=0, value=10)
+        genesis = mk_genesis_state([note])
+        follower = Follower(genesis, mk_config([note]))
+        events = []
+        follower.subscribe(events.append)
+
+        b0, b1, b2 = mk_chain(genesis.block, note, slots=[1, 2, 3])
+        b3, b4, b5 = mk_chain(b0, note, slots=[4, 5, 6])
+        for block in [b0, b1, b2, b3, b4]:
+            follower.on_block(block)
+
+        # b3 and b4 do not change the tip
+        assert [(e.common_ancestor, e.reverted, e.applied) for e in events] == [
+            (genesis.block.id(), [], [b0]),
+            (b0.id(), [], [b1]),
+            (b1.id(), [], [b2]),
+        ]
+
+        events.clear()
+        follower.on_block(b5)
+        assert follower.tip() == b5
+        assert len(events) == 1
+        assert events[0].common_ancestor == b0.id()
+        assert events[0].reverted == [b2, b1]
+        assert events[0].applied == [b3, b4, b5]
+
+    def test_tip_changed_tracks_local_chain(self):
+        # A listener maintaining the local chain from the events alone always agrees
+        # with the follower, whether blocks are applied one by one or in batches.
+        rng = random.Random(2)
+        notes = [Note(sk=i, value=10) for i in range(4)]
+        genesis = mk_genesis_state(notes)
+        follower = Follower(genesis, mk_config(notes).replace(k=5))
+        follower.to_online()
+
+        chain = [genesis.block]
+
+        def on_tip_changed(event):
+            for block in event.reverted:
+                assert chain.pop() == block
+            assert chain[-1].id() == event.common_ancestor
+            chain.extend(event.applied)
+
+        follower.subscribe(on_tip_changed)
+
+        slot = 0
+        for i in range(60):
+            tree = follower.ledger_state
+            candidates = [b for b in tree if tree.is_ancestor(follower.lib, b)]
+            parent = tree[rng.choice(candidates[-8:])].block
+            blocks = []
+            for _ in range(rng.randint(1, 6)):
+                slot += rng.randint(1, 2)
+                blocks.append(mk_block(parent, slot, rng.choice(notes)))
+                parent = blocks[-1]
+
+            if i % 2:
+                for block in blocks:
+                    follower.on_block(block)
+            else:
+                assert follower.on_blocks(blocks) == []
+
+            assert chain[::-1] == list(tree.iter_chain_blocks(follower.tip_id()))
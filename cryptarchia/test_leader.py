@@ -2,8 +2,22 @@ from unittest import TestCase
 
 import numpy as np
 
-from .cryptarchia import Leader, EpochState, LedgerState, Note, phi, Slot
-from .test_common import mk_config
+from .cryptarchia import (
+    Epoch,
+    Follower,
+    Hash,
+    InvalidLeaderProof,
+    Leader,
+    EpochState,
+    LedgerState,
+    MockLeaderProof,
+    Note,
+    lottery_threshold,
+    phi,
+    Slot,
+    WalletLeader,
+)
+from .test_common import mk_block, mk_config, mk_genesis_state
 
 
 class TestLeader(TestCase):
@@ -41,3 +55,122 @@ class TestLeader(TestCase):
         assert (
             abs(leader_rate - p) < margin_of_error
         ), f"{leader_rate} != {p}, err={abs(leader_rate - p)} > {margin_of_error}"
+
+    def test_schedule_matches_slot_by_slot_lottery(self):
+        epoch = EpochState(
+            stake_distribution_snapshot=LedgerState(block=None),
+            nonce_snapshot=LedgerState(block=None, nonce=b"1010101010"),
+            inferred_total_active_stake=1000,
+        )
+        note = Note(sk=0, value=100)
+        l = Leader(config=mk_config([note]).replace(active_slot_coeff=0.05), note=note)
+
+        slots = range(100, 5000)
+        schedule = l.compute_schedule(epoch, slots)
+        assert schedule == [
+            Slot(s) for s in slots if l.try_prove_slot_leader(epoch, Slot(s), bytes(32))
+        ]
+        assert len(schedule) > 0
+        assert l.compute_schedule(epoch, range(0)) == []
+
+    def test_wallet_leader_matches_single_note_leaders(self):
+        epoch = EpochState(
+            stake_distribution_snapshot=LedgerState(block=None),
+            nonce_snapshot=LedgerState(block=None, nonce=b"1010101010"),
+            inferred_total_active_stake=1000,
+        )
+        notes = [Note(sk=i, value=10 * (i + 1)) for i in range(20)]
+        config = mk_config(notes).replace(active_slot_coeff=0.05)
+        wallet = WalletLeader(config=config, notes=notes)
+        leaders = [Leader(config=config, note=note) for note in notes]
+
+        slots = range(0, 2000)
+        schedule = dict(wallet.compute_schedule(epoch, slots))
+        for s in map(Slot, slots):
+            winners = [l.note for l in leaders if l.try_prove_slot_leader(epoch, s, bytes(32))]
+            proof = wallet.try_prove_slot_leader(epoch, s, bytes(32))
+            if not winners:
+                assert proof is None and s not in schedule
+                continue
+            assert proof.note in winners
+            assert proof.slot == s and proof.parent == bytes(32)
+            assert schedule[s] == proof.note
+
+        assert len(schedule) > 0
+
+    def test_wallet_leader_follows_note_changes_within_epoch(self):
+        epoch = EpochState(
+            stake_distribution_snapshot=LedgerState(block=None),
+            nonce_snapshot=LedgerState(block=None, nonce=b"1010101010"),
+            inferred_total_active_stake=1000,
+        )
+        notes = [Note(sk=i, value=100) for i in range(3)]
+        config = mk_config(notes).replace(active_slot_coeff=0.05)
+        wallet = WalletLeader(config=config, notes=notes[:1])
+
+        slots = range(0, 2000)
+        assert {note for _, note in wallet.compute_schedule(epoch, slots)} == {notes[0]}
+
+        wallet.notes.extend(notes[1:])
+        assert {note for _, note in wallet.compute_schedule(epoch, slots)} == set(notes)
+
+        wallet.notes.remove(notes[0])
+        schedule = wallet.compute_schedule(epoch, slots)
+        assert {note for _, note in schedule} == set(notes[1:])
+        assert schedule == WalletLeader(config=config, notes=notes[1:]).compute_schedule(
+            epoch, slots
+        )
+
+    def test_lottery_threshold_is_exact(self):
+        # with all the stake, a note wins with probability f
+        assert lottery_threshold(0.05, 1000, 1000) == Hash.ORDER // 20 + 1
+        assert lottery_threshold(0.5, 1000, 1000) == Hash.ORDER // 2
+
+        for value, total in [(1, 1000), (10, 1000), (999, 1000), (3, 7)]:
+            threshold = lottery_threshold(0.05, value, total)
+            # floats lose precision computing 1 - (1 - f) ** alpha for small alpha
+            approx = Hash.ORDER * phi(0.05, value / total)
+            assert abs(threshold - approx) / approx < 1e-9
+
+        # thresholds only change with the note value and the total stake
+        assert lottery_threshold(0.05, 10, 1000) is lottery_threshold(0.05, 10, 1000)
+        assert lottery_threshold(0.05, 10, 1000) < lottery_threshold(0.05, 11, 1000)
+        assert lottery_threshold(0.05, 10, 1000) > lottery_threshold(0.05, 10, 1001)
+
+    def test_leader_proof_verifies_slot_lottery(self):
+        epoch = EpochState(
+            stake_distribution_snapshot=LedgerState(block=None),
+            nonce_snapshot=LedgerState(block=None, nonce=b"1010101010"),
+            inferred_total_active_stake=1000,
+        )
+        note = Note(sk=0, value=100)
+        f = 0.05
+        l = Leader(config=mk_config([note]).replace(active_slot_coeff=f), note=note)
+
+        won = l.compute_schedule(epoch, range(200))
+        assert len(won) > 0
+        for slot in map(Slot, range(200)):
+            proof = MockLeaderProof(note, slot, bytes(32))
+            args = (slot, bytes(32), {note.commitment()}, set())
+            assert proof.verify(*args)
+            assert proof.verify(*args, epoch=epoch, active_slot_coeff=f) == (slot in won)
+
+    def test_follower_verifies_slot_lottery_when_configured(self):
+        note = Note(sk=0, value=10)
+        genesis = mk_genesis_state([note])
+        config = mk_config([note]).replace(verify_lottery=True)
+        follower = Follower(genesis, config)
+
+        epoch = follower.compute_epoch_state(Epoch(0), genesis.block.id())
+        won = Leader(config=config, note=note).compute_schedule(epoch, range(1, 50))
+        lost = next(Slot(s) for s in range(1, 50) if Slot(s) not in won)
+
+        with self.assertRaises(InvalidLeaderProof):
+            follower.on_block(mk_block(genesis.block, lost.absolute_slot, note))
+        block = mk_block(genesis.block, won[0].absolute_slot, note)
+        follower.on_block(block)
+        assert follower.tip() == block
+
+        # without the option, the lottery is not checked
+        follower = Follower(genesis, config.replace(verify_lottery=False))
+        follower.on_block(mk_block(genesis.block, lost.absolute_slot, note))
@@ -1,16 +1,60 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import FrozenInstanceError, replace
 from unittest import TestCase
 
 from .cryptarchia import (
+    Slot,
     Note,
     Follower,
     InvalidLeaderProof,
+    InvalidSlot,
     ParentNotFound,
     iter_chain,
+    prevalidate_headers,
 )
 from .test_common import mk_block, mk_config, mk_genesis_state
 
 
 class TestLedgerStateUpdate(TestCase):
+    def test_prevalidate_headers(self):
+        note = Note(sk=0, value=100)
+        genesis = mk_genesis_state([note])
+        b1 = mk_block(slot=1, parent=genesis.block, note=note)
+        b2 = mk_block(slot=2, parent=b1, note=note)
+        # a proof for another slot than the header's
+        b3 = replace(b2, slot=Slot(3))
+        b4 = mk_block(slot=4, parent=b2, note=note)
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            valid, rejected = prevalidate_headers(
+                [b1, b2, b3, b4], executor, chunk_size=3
+            )
+
+        assert valid == [b1, b2, b4]
+        assert [(block, type(e)) for block, e in rejected] == [(b3, InvalidLeaderProof)]
+        # the hashes needed to validate the blocks are computed
+        for block in valid:
+            assert "_id" in block.__dict__
+            assert "_epoch_nonce_contribution" in block.leader_proof.__dict__
+            assert "_nullifier" in block.leader_proof.note.__dict__
+
+        # the sequential stage then validates against the ledger state
+        follower = Follower(genesis, mk_config([note]))
+        assert follower.on_blocks(valid) == []
+        assert follower.tip() == b4
+
+    def test_note_is_an_immutable_value(self):
+        note = Note(sk=0, value=100)
+        with self.assertRaises(FrozenInstanceError):
+            note.value = 1000
+
+        # commitments and nullifiers are computed once
+        assert note.commitment() is note.commitment()
+        assert note.nullifier() is note.nullifier()
+        assert note.commitment() == Note(sk=0, value=100).commitment()
+        assert note.commitment() != Note(sk=0, value=101).commitment()
+        assert note.nullifier() != Note(sk=1, value=100).nullifier()
+
     def test_on_block_idempotent(self):
         leader_note = Note(sk=0, value=100)
         genesis = mk_genesis_state([leader_note])
@@ -52,6 +96,19 @@ class TestLedgerStateUpdate(TestCase):
         assert len(list(iter_chain(follower.tip_id(), follower.ledger_state))) == 3
         assert follower.tip() == reuse_note_block
 
+    def test_block_slot_must_not_precede_parent_slot(self):
+        leader_note = Note(sk=0, value=100)
+        genesis = mk_genesis_state([leader_note])
+
+        follower = Follower(genesis, mk_config([leader_note]))
+
+        block = mk_block(slot=5, parent=genesis.block, note=leader_note)
+        follower.on_block(block)
+
+        with self.assertRaises(InvalidSlot):
+            follower.on_block(mk_block(slot=4, parent=block, note=leader_note))
+        assert follower.tip() == block
+
     def test_ledger_state_is_properly_updated_on_reorg(self):
         note = [Note(sk=0, value=100), Note(sk=1, value=100), Note(sk=2, value=100)]
 
@@ -177,6 +234,87 @@ class TestLedgerStateUpdate(TestCase):
         assert follower.tip() == block_4
         assert follower.tip().slot.epoch(config).epoch == 2
 
+    def test_epoch_state_is_shared_by_forks_with_the_same_snapshots(self):
+        notes = [Note(sk=i, value=100) for i in range(3)]
+        genesis = mk_genesis_state(notes)
+        config = mk_config(notes)
+        follower = Follower(genesis, config)
+
+        # epoch 0 and 1, then two forks diverging in epoch 2, after the epoch 2 snapshots
+        b1 = mk_block(slot=1, parent=genesis.block, note=notes[0])
+        b2 = mk_block(slot=25, parent=b1, note=notes[0])
+        b3 = mk_block(slot=41, parent=b2, note=notes[0])
+        fork_a = mk_block(slot=42, parent=b3, note=notes[1])
+        fork_b = mk_block(slot=43, parent=b3, note=notes[2])
+        for b in [b1, b2, b3, fork_a, fork_b]:
+            follower.on_block(b)
+
+        epoch = Slot(config.epoch_length * 2).epoch(config)
+        state_a = follower.compute_epoch_state(epoch, fork_a.id())
+        state_b = follower.compute_epoch_state(epoch, fork_b.id())
+        assert state_a is state_b
+        assert state_a.nonce_snapshot == follower.ledger_state[b2.id()]
+        assert state_a.stake_distribution_snapshot == follower.ledger_state[b1.id()]
+
+        # the lookup agrees with a walk down the chain
+        for tip in [fork_a.id(), fork_b.id(), b2.id()]:
+            for slot in range(0, 50):
+                expected = next(
+                    (s for s in iter_chain(tip, follower.ledger_state) if s.block.slot < Slot(slot)),
+                    follower.genesis_state,
+                )
+                assert follower.state_at_slot_beginning(tip, Slot(slot)) is expected
+
+    def test_epoch_state_cache_is_bounded(self):
+        note = Note(sk=0, value=100)
+        genesis = mk_genesis_state([note])
+        config = mk_config([note])
+        follower = Follower(genesis, config, epoch_state_cache_size=2)
+
+        # one block per epoch: each computes the state of its epoch, which misses,
+        # from the state of the previous epoch, which hits
+        parent = genesis.block
+        for epoch in range(1, 6):
+            block = mk_block(slot=epoch * config.epoch_length, parent=parent, note=note)
+            follower.on_block(block)
+            parent = block
+
+        cache = follower.epoch_state
+        assert len(cache) == 2
+        assert [epoch.epoch for epoch, _ in cache.entries] == [4, 5]
+        assert cache.misses == 5 and cache.hits == 4
+        assert cache.evictions == 3
+
+        # the most recent epoch state is served from the cache
+        follower.compute_epoch_state(Slot(5 * config.epoch_length).epoch(config), parent.id())
+        assert cache.hits == 5
+
+    def test_epoch_state_cache_evicts_behind_the_lib(self):
+        notes = [Note(sk=0, value=100), Note(sk=1, value=100)]
+        genesis = mk_genesis_state(notes)
+        config = mk_config(notes)
+        follower = Follower(genesis, config)
+        follower.to_online()
+
+        # a fork in epoch 1, which gets pruned once the LIB moves past it
+        b1 = mk_block(slot=20, parent=genesis.block, note=notes[0])
+        fork = mk_block(slot=21, parent=genesis.block, note=notes[1])
+        follower.on_block(b1)
+        follower.on_block(fork)
+        epoch_1 = Slot(20).epoch(config)
+        assert (epoch_1, genesis.block.id()) in follower.epoch_state
+
+        b2 = mk_block(slot=40, parent=b1, note=notes[0])
+        b3 = mk_block(slot=41, parent=b2, note=notes[0])
+        follower.on_block(b2)
+        follower.on_block(b3)
+        assert follower.lib == b2.id()
+        assert fork.id() not in follower.ledger_state
+
+        # the LIB is in epoch 2, epoch 1 can no longer be queried
+        assert all(epoch.epoch >= 2 for epoch, _ in follower.epoch_state.entries)
+        assert follower.epoch_state.evictions == 1
+
     def test_note_added_after_stake_freeze_is_ineligible_for_leadership(self):
         note = Note(sk=0, value=100)
 
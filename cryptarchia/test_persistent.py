@@ -0,0 +1,120 @@
+from unittest import TestCase
+import random
+
+from .cryptarchia import Hash, LedgerState
+from .persistent import PersistentSet
+
+
+class Colliding:
+    # An item type whose instances all share the same hash
+    def __init__(self, value):
+        self.value = value
+
+    def __hash__(self):
+        return 42
+
+    def __eq__(self, other):
+        return isinstance(other, Colliding) and self.value == other.value
+
+
+class TestPersistentSet(TestCase):
+    def test_set_operations(self):
+        items = [Hash(b"ITEM", bytes([i])) for i in range(100)]
+        s = PersistentSet(items[:50])
+
+        assert len(s) == 50
+        assert all(i in s for i in items[:50])
+        assert not any(i in s for i in items[50:])
+        assert s == set(items[:50])
+
+        # adding an existing item is a no-op
+        s.add(items[0])
+        assert len(s) == 50
+
+        s.discard(items[0])
+        s.discard(items[99])
+        assert len(s) == 49
+        assert items[0] not in s
+        assert s == set(items[1:50])
+
+    def test_copies_are_independent(self):
+        s = PersistentSet(range(1000))
+        c = s.copy()
+        c.add(1000)
+        c.discard(0)
+        s.add(-1)
+
+        assert 1000 not in s and 0 in s and -1 in s
+        assert 1000 in c and 0 not in c and -1 not in c
+        assert s == set(range(-1, 1000))
+        assert c == set(range(1, 1001))
+
+    def test_copies_share_structure(self):
+        s = PersistentSet(range(1000))
+        c = s.copy()
+        assert c._root is s._root
+        c.add(1000)
+        # only the path to the new item is rebuilt
+        shared = {id(e) for e in s._root.entries} & {id(e) for e in c._root.entries}
+        assert len(shared) == len(s._root.entries) - 1
+
+    def test_hash_collisions(self):
+        items = [Colliding(i) for i in range(10)]
+        s = PersistentSet(items)
+        assert len(s) == 10
+        assert all(i in s for i in items)
+        assert Colliding(10) not in s
+
+        for i in items[:9]:
+            s.discard(i)
+        assert len(s) == 1
+        assert list(s) == [items[9]]
+
+    def test_matches_builtin_set(self):
+        rng = random.Random(0)
+        expected = set()
+        s = PersistentSet()
+        for _ in range(5000):
+            item = rng.randrange(2000)
+            if rng.random() < 0.6:
+                expected.add(item)
+                s.add(item)
+            else:
+                expected.discard(item)
+                s.discard(item)
+            assert len(s) == len(expected)
+        assert s == expected
+        assert sorted(s) == sorted(expected)
+
+        for item in list(expected):
+            s.discard(item)
+        assert len(s) == 0 and list(s) == []
+
+    def test_ledger_state_copy_is_independent(self):
+        state = LedgerState(block=None, commitments={Hash(b"A")}, nullifiers=set())
+        assert isinstance(state.commitments, PersistentSet)
+
+        child = state.copy()
+        child.commitments.add(Hash(b"B"))
+        child.nullifiers.add(Hash(b"C"))
+
+        assert state.commitments == {Hash(b"A")}
+        assert state.nullifiers == set()
+        assert child.commitments == {Hash(b"A"), Hash(b"B")}
+        assert child.nullifiers == {Hash(b"C")}
+
+    def test_diff_skips_shared_structure(self):
+        s = PersistentSet(range(1000))
+        c = s.copy()
+        c.add(1000)
+        c.discard(0)
+        assert c.diff(s) == ([1000], [0])
+        assert s.diff(c) == ([0], [1000])
+        assert s.diff(s.copy()) == ([], [])
+
+        rng = random.Random(1)
+        a = PersistentSet(rng.sample(range(3000), 1500))
+        b = PersistentSet(rng.sample(range(3000), 1500))
+        only_a, only_b = a.diff(b)
+        assert set(only_a) == set(a) - set(b)
+        assert set(only_b) == set(b) - set(a)
@@ -0,0 +1,136 @@
+import os
+import random
+import tempfile
+from unittest import TestCase
+
+from .cryptarchia import Follower, MissingEpochState, Note, Slot
+from .snapshot import InvalidSnapshot
+from .test_common import mk_block, mk_chain, mk_config, mk_genesis_state
+
+
+def mk_blocks(follower: Follower, rng: random.Random, notes: list[Note], slots: range):
+    # Random blocks building on the tips of the follower, skipping some slots
+    for slot in slots:
+        if rng.random() < 0.4:
+            continue
+        tips = [follower.local_chain] + follower.forks
+        if rng.random() < 0.2:
+            # start a new fork just behind the tip
+            tips.append(follower.ledger_state.ancestor(follower.local_chain, 1))
+        parent = follower.ledger_state[rng.choice(tips)].block
+        yield mk_block(parent, slot, rng.choice(notes))
+
+
+class TestSnapshot(TestCase):
+    def assert_same_follower(self, booted: Follower, follower: Follower):
+        assert booted.tip_id() == follower.tip_id()
+        assert booted.forks == follower.forks
+        assert booted.lib == follower.lib
+        assert booted.state == follower.state
+        assert booted.genesis_state == follower.genesis_state
+        # the booted tree holds the blocks from the LIB up
+        assert list(booted.ledger_state.subtree(booted.lib)) == list(
+            follower.ledger_state.subtree(follower.lib)
+        )
+        for block_id in booted.ledger_state.subtree(booted.lib):
+            assert booted.ledger_state[block_id] == follower.ledger_state[block_id]
+
+    def test_boot_from_snapshot_and_keep_following(self):
+        rng = random.Random(0)
+        notes = [Note(sk=i, value=10) for i in range(3)]
+        genesis = mk_genesis_state(notes)
+        config = mk_config(notes).replace(k=3)
+        follower = Follower(genesis, config)
+        follower.to_online()
+        for block in mk_blocks(follower, rng, notes, range(1, 150)):
+            follower.on_block(block)
+
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "snapshot")
+            follower.export_snapshot(path)
+            booted = Follower.from_snapshot(path, config)
+            # a small memo must still be able to recompute every epoch state
+            bounded = Follower.from_snapshot(path, config, epoch_state_cache_size=1)
+
+        self.assert_same_follower(booted, follower)
+        self.assert_same_follower(bounded, follower)
+
+        # the booted followers validate and choose the same blocks, across epochs
+        for block in mk_blocks(follower, rng, notes, range(150, 400)):
+            follower.on_block(block)
+            booted.on_block(block)
+            bounded.on_block(block)
+            epoch = block.slot.epoch(config)
+            expected = follower.compute_epoch_state(epoch, block.id())
+            for f in [booted, bounded]:
+                state = f.compute_epoch_state(epoch, block.id())
+                assert state.inferred_total_active_stake == expected.inferred_total_active_stake
+                assert state.nonce() == expected.nonce()
+                assert state.stake_distribution_snapshot == expected.stake_distribution_snapshot
+        self.assert_same_follower(booted, follower)
+        self.assert_same_follower(bounded, follower)
+
+    def test_snapshot_of_follower_with_small_memo(self):
+        # Writing the snapshot must not depend on which epoch states the follower
+        # happens to have memoized.
+        rng = random.Random(2)
+        notes = [Note(sk=i, value=10) for i in range(3)]
+        genesis = mk_genesis_state(notes)
+        config = mk_config(notes).replace(k=3)
+        follower = Follower(genesis, config, epoch_state_cache_size=1)
+        follower.to_online()
+        for block in mk_blocks(follower, rng, notes, range(1, 150)):
+            follower.on_block(block)
+
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "snapshot")
+            follower.export_snapshot(path)
+            booted = Follower.from_snapshot(path, config, epoch_state_cache_size=1)
+
+            # without its pinned states, the follower cannot recompute the epoch states
+            # whose snapshots precede its block tree
+            unpinned = Follower.from_snapshot(path, config)
+            unpinned.epoch_state.pinned.clear()
+            lib_epoch = unpinned.ledger_state[unpinned.lib].block.slot.epoch(config)
+            with self.assertRaises(MissingEpochState):
+                unpinned.compute_epoch_state(lib_epoch, unpinned.lib)
+        self.assert_same_follower(booted, follower)
+
+        for block in mk_blocks(follower, rng, notes, range(150, 400)):
+            follower.on_block(block)
+            booted.on_block(block)
+            epoch = block.slot.epoch(config)
+            expected = follower.compute_epoch_state(epoch, block.id())
+            state = booted.compute_epoch_state(epoch, block.id())
+            assert state.inferred_total_active_stake == expected.inferred_total_active_stake
+            assert state.nonce() == expected.nonce()
+        self.assert_same_follower(booted, follower)
+
+    def test_snapshot_while_bootstrapping(self):
+        # b0 - b1 - b2
+        #    \
+        #     b3
+        note = Note(sk=0, value=10)
+        genesis = mk_genesis_state([note])
+        config = mk_config([note])
+        follower = Follower(genesis, config)
+        b0, b1, b2 = mk_chain(genesis.block, note, slots=[1, 2, 3])
+        b3 = mk_block(b0, 2, note, content=b"fork")
+        for b in [b0, b1, b2, b3]:
+            follower.on_block(b)
+
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "snapshot")
+            follower.export_snapshot(path)
+            booted = Follower.from_snapshot(path, config)
+
+            # the whole tree is exported, since the LIB is still the genesis block
+            self.assert_same_follower(booted, follower)
+            assert booted.anchor_states == []
+
+            with open(path, "rb") as f:
+                data = f.read()
+            with open(path, "wb") as f:
+                f.write(data[:-1])
+            with self.assertRaises(InvalidSnapshot):
+                Follower.from_snapshot(path, config)
@@ -0,0 +1,138 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from .cryptarchia import Follower, Hash, Note, Slot
+from .store import SqliteBlockStore
+from .sync import BlockFetcher
+from .test_common import mk_block, mk_chain, mk_config, mk_genesis_state
+
+
+class TestBlockStore(TestCase):
+    def test_states_round_trip(self):
+        notes = [Note(sk=i, value=10) for i in range(3)]
+        genesis = mk_genesis_state(notes)
+        chain = mk_chain(genesis.block, notes[0], slots=list(range(1, 11)))
+
+        # the note sets change along the chain, so that states are stored as changes
+        states = [genesis.copy()]
+        for i, block in enumerate(chain):
+            state = states[-1].copy()
+            state.apply(block)
+            state.commitments.add(Hash(b"NEW", bytes([i])))
+            if i % 3 == 0:
+                state.commitments.discard(notes[i % 3].commitment())
+                state.nullifiers.add(notes[i % 3].nullifier())
+            states.append(state)
+
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "blocks.db")
+            store = SqliteBlockStore(path, snapshot_interval=4)
+            for state in states:
+                store.put(state.block.id(), state)
+            store.close()
+
+            # read back from a fresh connection
+            store = SqliteBlockStore(path, snapshot_interval=4)
+            for state in reversed(states):
+                assert state.block.id() in store
+                assert store.get_block(state.block.id()) == state.block
+                assert store.get_state(state.block.id()) == state
+            assert Hash(b"UNKNOWN") not in store
+            with self.assertRaises(KeyError):
+                store.get_state(Hash(b"UNKNOWN"))
+            store.close()
+
+    def test_follower_moves_immutable_states_to_store(self):
+        # b0 - b1 - ... - b19 == tip
+        #    \
+        #     f0 - f1
+        notes = [Note(sk=0, value=10), Note(sk=1, value=10)]
+        genesis = mk_genesis_state(notes)
+        config = mk_config(notes).replace(k=3)
+        chain = mk_chain(genesis.block, notes[0], slots=list(range(1, 21)))
+        fork = mk_chain(chain[0], notes[1], slots=[2, 3])
+
+        in_memory = Follower(genesis, config)
+        stored = Follower(genesis, config, store=SqliteBlockStore())
+        for follower in [in_memory, stored]:
+            follower.to_online()
+            for block in chain[:2] + fork + chain[2:]:
+                follower.on_block(block)
+
+        assert stored.tip() == in_memory.tip() == chain[-1]
+        assert stored.lib == in_memory.lib == chain[-4].id()
+        assert list(stored.ledger_state) == list(in_memory.ledger_state)
+        for block_id, state in in_memory.ledger_state.items():
+            assert stored.ledger_state[block_id] == state
+        assert stored.genesis_state == genesis
+        assert list(stored.blocks_by_slot(Slot(0))) == list(in_memory.blocks_by_slot(Slot(0)))
+
+        # only the states after the LIB, and the LIB's, stay in memory
+        tree = stored.ledger_state
+        assert {b for b in tree if tree.in_memory(b)} == {b.id() for b in chain[-3:]}
+        assert len(tree._state_cache) <= tree._state_cache.max_size
+
+        # blocks keep building on the immutable chain
+        block = mk_block(chain[-1], 21, notes[1])
+        stored.on_block(block)
+        in_memory.on_block(block)
+        assert stored.lib == in_memory.lib
+        assert stored.ledger_state[stored.lib] == in_memory.ledger_state[in_memory.lib]
+
+    def test_states_load_from_nearest_cached_ancestor(self):
+        notes = [Note(sk=i, value=10) for i in range(2)]
+        genesis = mk_genesis_state(notes)
+        chain = mk_chain(genesis.block, notes[0], slots=list(range(1, 11)))
+
+        states = [genesis.copy()]
+        for i, block in enumerate(chain):
+            state = states[-1].copy()
+            state.apply(block)
+            state.commitments.add(Hash(b"NEW", bytes([i])))
+            states.append(state)
+
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "blocks.db")
+            store = SqliteBlockStore(path)
+            for state in states:
+                store.put(state.block.id(), state)
+            store.close()
+
+            store = SqliteBlockStore(path, cache_size=2)
+            # headers are stored encoded, not pickled
+            (header,) = store.db.execute(
+                "SELECT header FROM blocks WHERE id = ?", (bytes(chain[4].id()),)
+            ).fetchone()
+            assert header == chain[4].encode()
+
+            queries = []
+            store.db.set_trace_callback(queries.append)
+            assert store.get_state(chain[4].id()) == states[5]
+            assert sum("FROM notes" in q for q in queries) == 6
+
+            # only the changes since the cached state are replayed
+            queries.clear()
+            assert store.get_state(chain[6].id()) == states[7]
+            assert sum("FROM notes" in q for q in queries) == 2
+            assert store.get_block(chain[6].id()) == chain[6]
+            store.close()
+
+    def test_peer_reads_store_from_fetcher_threads(self):
+        notes = [Note(sk=0, value=10)]
+        genesis = mk_genesis_state(notes)
+        config = mk_config(notes).replace(k=3)
+        # more blocks than the tree caches, so that the oldest are read from the store
+        chain = mk_chain(genesis.block, notes[0], slots=list(range(1, 401)))
+        peer = Follower(genesis, config, store=SqliteBlockStore())
+        peer.to_online()
+        for block in chain:
+            peer.on_block(block)
+        tree = peer.ledger_state
+        assert len(tree) > tree._state_cache.max_size
+
+        # the windows are served from the fetcher's worker threads
+        fetcher = BlockFetcher([peer], window_size=50, max_workers=4)
+        blocks = list(fetcher.fetch_blocks_from(Slot(0)))
+        assert blocks == [genesis.block] + chain
+        assert fetcher.peer_manager.stats_of(peer).failures == 0
@@ -1,7 +1,27 @@
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import replace
 from unittest import TestCase
+from unittest.mock import patch
 
-from cryptarchia.cryptarchia import BlockHeader, Follower, Note
-from cryptarchia.sync import InvalidBlockFromBackfillFork, sync
+from cryptarchia.cryptarchia import (
+    BlockHeader,
+    Follower,
+    MockLeaderProof,
+    Note,
+    Slot,
+    prevalidate_headers,
+)
+from cryptarchia.sync import (
+    BlockFetcher,
+    InvalidBlockFromBackfillFork,
+    OrphanPool,
+    PeerManager,
+    _Pipeline,
+    apply_prevalidated_batch,
+    sync,
+)
 from cryptarchia.test_common import mk_block, mk_chain, mk_config, mk_genesis_state
 
 
@@ -264,6 +284,183 @@ class TestSync(TestCase):
         self.assertNotIn(b6.id(), local.ledger_state)
         self.assertNotIn(b7.id(), local.ledger_state)
 
+    def test_pipelined_sync_matches_sequential_application(self):
+        # The peer of `test_sync_with_prevalidation_in_process_pool`, with more forks.
+        # Whatever the batch and queue sizes, the result is the same as applying the
+        # fetched blocks one by one.
+        n_a, n_b = Note(sk=0, value=10), Note(sk=1, value=10)
+        config = mk_config([n_a, n_b])
+        genesis = mk_genesis_state([n_a, n_b])
+        peer = Follower(genesis, config)
+
+        b0, b1, b2, b5 = mk_chain(genesis.block, n_a, slots=[1, 2, 3, 4])
+        b3, b4 = mk_chain(b0, n_b, slots=[2, 3])
+        b9, b10 = mk_chain(b1, n_b, slots=[5, 6])
+        for b in [b0, b1, b2, b3, b4, b5, b9, b10]:
+            peer.on_block(b)
+        b6 = mk_block(b5, 3, n_a)
+        b7 = mk_block(b6, 7, n_a)
+        b8 = replace(
+            mk_block(b4, 7, n_b),
+            leader_proof=MockLeaderProof(n_b, Slot(6), parent=b4.id()),
+        )
+        for b in [b6, b7, b8]:
+            apply_invalid_block_to_ledger_state(peer, b)
+
+        expected = Follower(genesis, config)
+        for block in BlockFetcher([peer]).fetch_blocks_from(Slot(0)):
+            try:
+                expected.on_block(block)
+            except Exception:
+                pass
+
+        for batch_size, queue_size in [(1, 1), (2, 1), (256, 8)]:
+            local = Follower(genesis, config)
+            sync(local, [peer], batch_size=batch_size, queue_size=queue_size)
+            self.assertEqual(local.tip(), expected.tip())
+            self.assertEqual(local.forks, expected.forks)
+            self.assertEqual(list(local.ledger_state), list(expected.ledger_state))
+
+    def test_pipeline_stages_overlap_with_backpressure(self):
+        produced = []
+
+        def produce():
+            for i in range(20):
+                produced.append(i)
+                yield i
+
+        with _Pipeline(queue_size=2) as pipeline:
+            stream = pipeline.stage(x * 2 for x in pipeline.stage(produce()))
+            consumed = []
+            for item in stream:
+                time.sleep(0.005)
+                consumed.append(item)
+                # each of the two queues holds at most 2 items, and each stage holds
+                # at most one item while waiting for room in its queue
+                self.assertLessEqual(len(produced) - len(consumed), 2 * 2 + 2)
+            self.assertEqual(consumed, [2 * i for i in range(20)])
+
+    def test_pipeline_stage_errors_are_raised(self):
+        def produce():
+            yield 1
+            raise ValueError("fetch failed")
+
+        with self.assertRaises(ValueError):
+            with _Pipeline(queue_size=1) as pipeline:
+                list(pipeline.stage(x for x in pipeline.stage(produce())))
+        self.assertFalse(any(thread.is_alive() for thread in pipeline.threads))
+
+    def test_pipeline_closes_stopped_stages(self):
+        closed = threading.Event()
+
+        def produce():
+            try:
+                while True:
+                    yield 0
+            finally:
+                closed.set()
+
+        # the generator is closed by the stopped stage, even though it is still
+        # referenced here
+        items = produce()
+        with _Pipeline(queue_size=1) as pipeline:
+            self.assertEqual(next(pipeline.stage(items)), 0)
+        self.assertTrue(closed.is_set())
+        self.assertFalse(any(thread.is_alive() for thread in pipeline.threads))
+
+    def test_backfill_once_per_orphan_subtree(self):
+        # Prepare a peer with forks:
+        #             b2 == local tip
+        #           /
+        # b0 - b1 - b6 - b7 - b8 == tip
+        #    \
+        #      b3 - b4 - b5
+        #              \
+        #                b9
+        # Syncing from b2, b4, b5 and b9 are orphans waiting for b3, which is before
+        # the local tip. Only b4 needs to be backfilled, after which the others follow.
+        n_a, n_b = Note(sk=0, value=10), Note(sk=1, value=10)
+        config = mk_config([n_a, n_b])
+        genesis = mk_genesis_state([n_a, n_b])
+        peer = Follower(genesis, config)
+
+        b0, b1, b2 = mk_chain(genesis.block, n_a, slots=[1, 2, 3])
+        b3, b4, b5 = mk_chain(b0, n_b, slots=[2, 4, 5])
+        b6, b7, b8 = mk_chain(b1, n_a, slots=[4, 5, 6])
+        b9 = mk_block(b4, 6, n_a)
+        for b in [b0, b1, b2, b3, b4, b5, b6, b7, b8, b9]:
+            peer.on_block(b)
+
+        local = Follower(genesis, config)
+        for b in [b0, b1, b2]:
+            local.on_block(b)
+        with patch.object(
+            BlockFetcher,
+            "fetch_chain_forward",
+            autospec=True,
+            side_effect=BlockFetcher.fetch_chain_forward,
+        ) as fetch_chain_forward:
+            sync(local, [peer])
+        self.assertEqual(
+            [call.args[1] for call in fetch_chain_forward.call_args_list], [b4.id()]
+        )
+        self.assertEqual(local.tip(), peer.tip())
+        self.assertEqual(sorted(local.forks), sorted(peer.forks))
+        self.assertEqual(set(local.ledger_state), set(peer.ledger_state))
+
+    def test_backfill_resolves_other_roots(self):
+        # Prepare a peer with forks:
+        #             b2 == local tip
+        #           /
+        # b0 - b1
+        #    \
+        #      b3 - b4
+        #         \
+        #           b5 - b6 == tip
+        # Syncing from b2, b4 and b5 are both roots of orphan subtrees, waiting for b3.
+        # Backfilling b5 brings in b3, after which b4 follows without another backfilling.
+        n_a, n_b = Note(sk=0, value=10), Note(sk=1, value=10)
+        config = mk_config([n_a, n_b])
+        genesis = mk_genesis_state([n_a, n_b])
+        peer = Follower(genesis, config)
+
+        b0, b1, b2 = mk_chain(genesis.block, n_a, slots=[1, 2, 3])
+        b3, b4 = mk_chain(b0, n_b, slots=[2, 4])
+        b5, b6 = mk_chain(b3, n_a, slots=[5, 6])
+        for b in [b0, b1, b2, b3, b4, b5, b6]:
+            peer.on_block(b)
+
+        local = Follower(genesis, config)
+        for b in [b0, b1, b2]:
+            local.on_block(b)
+        with patch.object(
+            BlockFetcher,
+            "fetch_chain_forward",
+            autospec=True,
+            side_effect=BlockFetcher.fetch_chain_forward,
+        ) as fetch_chain_forward:
+            sync(local, [peer])
+        self.assertEqual(
+            [call.args[1] for call in fetch_chain_forward.call_args_list], [b5.id()]
+        )
+        self.assertEqual(local.tip(), peer.tip())
+        self.assertEqual(sorted(local.forks), sorted(peer.forks))
+        self.assertEqual(set(local.ledger_state), set(peer.ledger_state))
+
+    def test_orphan_pool_limits(self):
+        note = Note(sk=0, value=10)
+        config = mk_config([note])
+        genesis = mk_genesis_state([note])
+        peer = Follower(genesis, config)
+        for b in mk_chain(genesis.block, note, slots=[1, 2, 3]):
+            peer.on_block(b)
+
+        local = Follower(genesis, config)
+        with patch("cryptarchia.sync.OrphanPool", wraps=OrphanPool) as pool:
+            sync(local, [peer], orphan_pool_size=16, orphan_max_age=30.0)
+        pool.assert_called_once_with(16, 30.0)
+        self.assertEqual(local.tip(), peer.tip())
+
 
 class TestSyncFromCheckpoint(TestCase):
     def test_sync_single_chain(self):
@@ -460,6 +657,432 @@ class TestSyncFromCheckpoint(TestCase):
         with self.assertRaises(InvalidBlockFromBackfillFork):
             sync(local, [peer], checkpoint)
 
+    def test_sync_with_prevalidation_in_process_pool(self):
+        # Prepare a peer with forks and invalid blocks:
+        # b0 - b1 - b2 - b5 - (invalid_b6) - (invalid_b7)
+        #    \
+        #      b3 - b4 - (invalid_b8)
+        #
+        # invalid_b6 and invalid_b8 carry a leader proof for another slot,
+        # which the pre-validation stage rejects.
+        n_a, n_b = Note(sk=0, value=10), Note(sk=1, value=10)
+        config = mk_config([n_a, n_b])
+        genesis = mk_genesis_state([n_a, n_b])
+        peer = Follower(genesis, config)
+
+        b0, b1, b2, b5 = mk_chain(genesis.block, n_a, slots=[1, 2, 3, 4])
+        b3, b4 = mk_chain(b0, n_b, slots=[2, 3])
+        for b in [b0, b1, b2, b3, b4, b5]:
+            peer.on_block(b)
+
+        b6 = replace(
+            mk_block(b5, 5, n_a),
+            leader_proof=MockLeaderProof(n_a, Slot(4), parent=b5.id()),
+        )
+        b7 = mk_block(b6, 6, n_a)
+        b8 = replace(
+            mk_block(b4, 7, n_b),
+            leader_proof=MockLeaderProof(n_b, Slot(6), parent=b4.id()),
+        )
+        for b in [b6, b7, b8]:
+            apply_invalid_block_to_ledger_state(peer, b)
+
+        # Result: The same block tree as with a sequential sync.
+        expected = Follower(genesis, config)
+        sync(expected, [peer])
+        local = Follower(genesis, config)
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            sync(local, [peer], executor=executor)
+        self.assertEqual(local.tip(), b5)
+        self.assertEqual(local.tip(), expected.tip())
+        self.assertEqual(local.forks, expected.forks)
+        self.assertEqual(list(local.ledger_state), list(expected.ledger_state))
+
+
+class TestBlockFetcher(TestCase):
+    def setUp(self):
+        self.notes = [Note(sk=0, value=10), Note(sk=1, value=10)]
+        self.config = mk_config(self.notes)
+        self.genesis = mk_genesis_state(self.notes)
+        self.chain = mk_chain(
+            self.genesis.block, self.notes[0], slots=list(range(1, 41))
+        )
+        self.follower = Follower(self.genesis, self.config)
+        for b in self.chain:
+            self.follower.on_block(b)
+        # the genesis block is at slot 0
+        self.blocks = [self.genesis.block] + self.chain
+
+    def test_fetch_windows_in_parallel(self):
+        concurrency = Concurrency()
+        peers = [RemotePeer(self.follower, 0.02, concurrency) for _ in range(4)]
+        fetcher = BlockFetcher(peers, window_size=5, max_workers=4)
+        blocks = list(fetcher.fetch_blocks_from(Slot(0)))
+        self.assertEqual(blocks, self.blocks)
+        self.assertGreater(concurrency.max_active, 1)
+        # every peer served some windows
+        self.assertTrue(all(peer.requests > 0 for peer in peers))
+
+    def test_reassign_windows_of_failed_peers(self):
+        peers = [
+            RemotePeer(self.follower, 0.01, fail=True),
+            RemotePeer(self.follower, 0.01),
+            RemotePeer(self.follower, 0.01, fail=True),
+        ]
+        fetcher = BlockFetcher(peers, window_size=5, max_workers=3)
+        self.assertEqual(list(fetcher.fetch_blocks_from(Slot(0))), self.blocks)
+        self.assertEqual(list(fetcher.fetch_blocks_from(Slot(25))), self.blocks[25:])
+
+    def test_reassign_windows_of_stalled_peers(self):
+        stalled = RemotePeer(self.follower, 1.0)
+        peers = [stalled, RemotePeer(self.follower, 0.01)]
+        fetcher = BlockFetcher(peers, window_size=10, max_workers=4, timeout=0.1)
+        start = time.monotonic()
+        self.assertEqual(list(fetcher.fetch_blocks_from(Slot(0))), self.blocks)
+        self.assertLess(time.monotonic() - start, 1.0)
+        self.assertGreater(stalled.requests, 0)
+
+    def test_fetch_forks_past_the_peer_tip(self):
+        # b0 - b1 - b2 - b3 - b4 == tip
+        #         \
+        #           f0 - f1
+        # The fork is at slots 8 and 9, after the slot 5 of the tip.
+        b0, b1, b2, b3, b4 = mk_chain(self.genesis.block, self.notes[0], [1, 2, 3, 4, 5])
+        f0, f1 = mk_chain(b1, self.notes[1], slots=[8, 9])
+        peer = Follower(self.genesis, self.config)
+        for b in [b0, b1, b2, b3, b4, f0, f1]:
+            peer.on_block(b)
+        self.assertEqual(peer.tip(), b4)
+
+        for window_size in [1, 2, 64]:
+            fetcher = BlockFetcher([RemotePeer(peer, 0)], window_size=window_size)
+            self.assertEqual(
+                list(fetcher.fetch_blocks_from(Slot(0))),
+                list(peer.blocks_by_slot(Slot(0))),
+            )
+
+        local = Follower(self.genesis, self.config)
+        sync(local, [peer])
+        self.assertEqual(local.tip(), b4)
+        self.assertEqual(local.forks, [f1.id()])
+        self.assertEqual(len(local.ledger_state), 8)
+
+    def test_missing_windows_if_all_peers_fail(self):
+        fetcher = BlockFetcher(
+            [RemotePeer(self.follower, 0, fail=True)], window_size=5, max_workers=2
+        )
+        self.assertEqual(list(fetcher.fetch_blocks_from(Slot(0))), [])
+
+    def test_sync_from_remote_peers(self):
+        # Peer-0: b0 - b1 - ... - b39
+        #            \
+        # Peer-1:      b1' - ... - b12'
+        fork = mk_chain(self.chain[0], self.notes[1], slots=list(range(2, 14)))
+        peer1 = Follower(self.genesis, self.config)
+        for b in [self.chain[0], *fork]:
+            peer1.on_block(b)
+
+        local = Follower(self.genesis, self.config)
+        sync(
+            local,
+            [
+                RemotePeer(self.follower, 0.01),
+                RemotePeer(peer1, 0.01),
+                RemotePeer(self.follower, 0.01, fail=True),
+            ],
+        )
+        self.assertEqual(local.tip(), self.chain[-1])
+        self.assertEqual(local.forks, [fork[-1].id()])
+        self.assertEqual(len(local.ledger_state), 1 + len(self.chain) + len(fork))
+
+    def test_prefer_fast_peers(self):
+        slow = RemotePeer(self.follower, 0.05)
+        fast = RemotePeer(self.follower, 0.001)
+        failing = RemotePeer(self.follower, 0.001, fail=True)
+        fetcher = BlockFetcher([slow, failing, fast], window_size=1, max_workers=1)
+        self.assertEqual(list(fetcher.fetch_blocks_from(Slot(0))), self.blocks)
+        # Each peer is tried once, then the fast one serves every other window.
+        self.assertEqual(slow.requests, 1)
+        self.assertEqual(failing.requests, 1)
+        self.assertEqual(fast.requests, 40)
+        stats = fetcher.peer_manager.stats_of(fast)
+        self.assertEqual((stats.requests, stats.failures, stats.blocks), (40, 0, 40))
+        self.assertEqual(fetcher.peer_manager.stats_of(failing).failure_rate, 1)
+
+    def test_demote_peers_serving_invalid_blocks(self):
+        # The malicious peer follows the honest chain up to b19,
+        # then serves three invalid blocks, and a chain on top of the last one:
+        #                 (invalid_0)
+        #               /
+        # b0 - ... - b19 - (invalid_1)
+        #               \
+        #                 (invalid_2) - m0 - ... - m26
+        malicious = Follower(self.genesis, self.config)
+        for b in self.chain[:20]:
+            malicious.on_block(b)
+        invalid = [
+            replace(
+                mk_block(self.chain[19], slot, self.notes[1]),
+                leader_proof=MockLeaderProof(
+                    self.notes[1], Slot(slot - 1), self.chain[19].id()
+                ),
+            )
+            for slot in [25, 26, 27]
+        ]
+        for b in [*invalid, *mk_chain(invalid[-1], self.notes[1], list(range(28, 55)))]:
+            apply_invalid_block_to_ledger_state(malicious, b)
+        malicious.local_chain = b.id()
+
+        manager = PeerManager()
+        honest = RemotePeer(self.follower, 0.001)
+        malicious = RemotePeer(malicious, 0.001)
+        local = Follower(self.genesis, self.config)
+        sync(local, [malicious, honest], peer_manager=manager)
+        self.assertEqual(local.tip(), self.chain[-1])
+        self.assertTrue(manager.is_demoted(malicious))
+        # the blocks built on invalid blocks are rejected, but only invalid blocks count
+        self.assertEqual(manager.stats_of(malicious).invalid_blocks, 3)
+        self.assertFalse(manager.is_demoted(honest))
+        self.assertEqual(manager.rank([malicious, honest]), [honest, malicious])
+
+        # The demoted peer is left out of the next sync.
+        requests = malicious.requests
+        local = Follower(self.genesis, self.config)
+        sync(local, [malicious, honest], peer_manager=manager)
+        self.assertEqual(local.tip(), self.chain[-1])
+        self.assertEqual(malicious.requests, requests)
+
+    def test_blocks_of_stale_forks_are_not_charged(self):
+        # An honest peer still on a fork that the local LIB has moved past serves blocks
+        # that are rejected as immutable forks, which does not count against it.
+        stale = Follower(self.genesis, self.config)
+        for b in self.chain[:5]:
+            stale.on_block(b)
+        fork = mk_chain(self.chain[4], self.notes[1], slots=[7, 8])
+        for b in fork:
+            stale.on_block(b)
+
+        local = Follower(self.genesis, self.config)
+        for b in self.chain:
+            local.on_block(b)
+        local.to_online()
+
+        fetcher = BlockFetcher([stale])
+        fetcher.sources = {b.id(): stale for b in fork}
+        rejected_blocks = set()
+        valid, rejected = prevalidate_headers(fork)
+        apply_prevalidated_batch(
+            local, fork, valid, rejected, OrphanPool(), rejected_blocks, fetcher
+        )
+        self.assertEqual(rejected_blocks, {b.id() for b in fork})
+        self.assertEqual(fetcher.peer_manager.stats_of(stale).invalid_blocks, 0)
+        self.assertEqual(fetcher.sources, {})
+
+
+class TestOrphanPool(TestCase):
+    def setUp(self):
+        # b0 - b1 - b2
+        #         \
+        #           b3 - b4
+        note = Note(sk=0, value=10)
+        genesis = mk_genesis_state([note])
+        self.b0, self.b1, self.b2 = mk_chain(genesis.block, note, slots=[1, 2, 3])
+        self.b3, self.b4 = mk_chain(self.b1, note, slots=[4, 5])
+        self.b5 = mk_block(genesis.block, 5, note)
+
+    def test_pop_descendants(self):
+        pool = OrphanPool()
+        for b in [self.b4, self.b2, self.b1, self.b3, self.b5]:
+            pool.add(b)
+        self.assertEqual(pool.roots(), [self.b1, self.b5])
+
+        self.assertEqual(
+            pool.pop_descendants(self.b0.id()), [self.b1, self.b2, self.b3, self.b4]
+        )
+        self.assertEqual(len(pool), 1)
+        self.assertEqual(pool.pop_descendants(self.b0.id()), [])
+
+    def test_discard_keeps_descendants(self):
+        pool = OrphanPool()
+        for b in [self.b1, self.b2, self.b3]:
+            pool.add(b)
+        pool.discard(self.b1.id())
+        self.assertNotIn(self.b1.id(), pool)
+        self.assertEqual(pool.roots(), [self.b2, self.b3])
+        self.assertEqual(pool.pop_descendants(self.b1.id()), [self.b2, self.b3])
+
+    def test_size_and_age_limits(self):
+        now = [0.0]
+        pool = OrphanPool(max_size=3, max_age=10, clock=lambda: now[0])
+        for b in [self.b1, self.b2, self.b3, self.b4]:
+            pool.add(b)
+            now[0] += 3
+        # b1, the oldest, is evicted first
+        self.assertEqual(len(pool), 3)
+        self.assertNotIn(self.b1.id(), pool)
+
+        # b2 was added at 3, and b3 at 6
+        now[0] = 14
+        self.assertEqual(pool.roots(), [self.b3])
+        self.assertEqual(len(pool), 2)
+        now[0] = 20
+        self.assertEqual(pool.roots(), [])
+        self.assertEqual(len(pool), 0)
+
+
+class TestBlockLocator(TestCase):
+    def setUp(self):
+        # b0 - ... - b99
+        #          \
+        #            f0 - ... - f59
+        n_a, n_b = Note(sk=0, value=10), Note(sk=1, value=10)
+        self.config = mk_config([n_a, n_b])
+        self.genesis = mk_genesis_state([n_a, n_b])
+        self.chain = mk_chain(self.genesis.block, n_a, slots=list(range(1, 101)))
+        self.fork = mk_chain(self.chain[29], n_b, slots=list(range(31, 91)))
+        self.peer = Follower(self.genesis, self.config)
+        for b in self.chain + self.fork:
+            self.peer.on_block(b)
+
+    def test_block_locator(self):
+        locator = self.peer.block_locator()
+        ids = [self.genesis.block.id()] + [b.id() for b in self.chain]
+        # the last 10 blocks, then steps of 2, 4, 8, ... and the root
+        depths = list(range(10)) + [11, 15, 23, 39, 71, 100]
+        self.assertEqual(locator, [ids[100 - d] for d in depths])
+        self.assertEqual(
+            self.peer.block_locator(self.chain[2].id()),
+            [ids[3], ids[2], ids[1], ids[0]],
+        )
+        self.assertEqual(self.peer.block_locator(self.genesis.block.id()), [ids[0]])
+
+    def test_blocks_after_locator(self):
+        # A follower of the main chain locates the fork in one request,
+        # up to the spacing of its locator.
+        local = Follower(self.genesis, self.config)
+        for b in self.chain:
+            local.on_block(b)
+        locator = local.block_locator()
+        tip = self.fork[-1].id()
+        blocks = self.peer.blocks_after_locator(locator, tip)
+        # b29 falls between the locator's b28 and b60
+        self.assertEqual(blocks, self.chain[29:30] + self.fork)
+
+        # paging
+        page = self.peer.blocks_after_locator(locator, tip, limit=25)
+        self.assertEqual(page, blocks[:25])
+        page = self.peer.blocks_after_locator([page[-1].id()], tip, limit=25)
+        self.assertEqual(page, blocks[25:50])
+        self.assertEqual(self.peer.blocks_after_locator([tip], tip, limit=25), [])
+
+        # unknown tip, or no common block
+        self.assertIsNone(self.peer.blocks_after_locator(locator, bytes(32)))
+        self.assertIsNone(self.peer.blocks_after_locator([self.chain[50].id()], tip))
+
+    def test_backfill_deep_fork_forward(self):
+        local = Follower(self.genesis, self.config)
+        for b in self.chain:
+            local.on_block(b)
+        fetcher = BlockFetcher([self.peer])
+        with patch.object(
+            Follower,
+            "blocks_after_locator",
+            autospec=True,
+            side_effect=Follower.blocks_after_locator,
+        ) as blocks_after_locator:
+            self.assertEqual(
+                fetcher.fetch_chain_forward(self.fork[-1].id(), local, page_size=16),
+                self.fork,
+            )
+        # 61 blocks after the fork point found by the locator, in pages of 16
+        self.assertEqual(blocks_after_locator.call_count, 4)
+        self.assertIsNone(fetcher.fetch_chain_forward(bytes(32), local))
+
+
+class TestPeerManager(TestCase):
+    def test_estimates(self):
+        manager = PeerManager(smoothing=0.5)
+        a, b, c = object(), object(), object()
+        self.assertEqual(manager.expected_time(a), 0)
+
+        manager.record_success(a, 10, 1.0)
+        manager.record_success(a, 30, 3.0)
+        manager.record_failure(a)
+        stats = manager.stats_of(a)
+        self.assertEqual((stats.requests, stats.failures, stats.blocks), (3, 1, 40))
+        self.assertEqual(stats.latency, 2.0)
+        self.assertEqual(stats.throughput, 10.0)
+        self.assertAlmostEqual(manager.expected_time(a), 2.0 / (2 / 3))
+        self.assertAlmostEqual(manager.expected_throughput(a), 10.0 * 2 / 3)
+
+        manager.record_success(b, 10, 0.5)
+        manager.record_failure(c)
+        self.assertEqual(manager.expected_time(c), float("inf"))
+        # untried peers first
+        d = object()
+        self.assertEqual(manager.rank([a, b, c, d]), [d, b, a, c])
+        self.assertEqual(manager.rank([a, b, c, d], bulk=True), [d, b, a, c])
+
+    def test_demotion(self):
+        manager = PeerManager(max_invalid_blocks=3)
+        a, b = object(), object()
+        manager.record_success(a, 10, 0.1)
+        manager.record_success(b, 10, 1.0)
+        manager.record_invalid(a, 2)
+        self.assertFalse(manager.is_demoted(a))
+        manager.record_invalid(a, 1)
+        self.assertTrue(manager.is_demoted(a))
+
+        self.assertEqual(manager.rank([a, b]), [b, a])
+        self.assertEqual(manager.available([a, b]), [b])
+        # demoted peers are still used when there is no other peer
+        self.assertEqual(manager.available([a]), [a])
+
+
+class Concurrency:
+    # Tracks the maximum number of requests served at the same time.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+
+    def __enter__(self):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+
+    def __exit__(self, *args):
+        with self.lock:
+            self.active -= 1
+
+
+class RemotePeer:
+    # A local stand-in for a remote peer, answering range requests after `latency`
+    # seconds, or failing them.
+    def __init__(
+        self,
+        follower: Follower,
+        latency: float,
+        concurrency: Concurrency | None = None,
+        fail: bool = False,
+    ):
+        self.follower = follower
+        self.latency = latency
+        self.concurrency = concurrency or Concurrency()
+        self.fail = fail
+        self.requests = 0
+
+    def __getattr__(self, name):
+        return getattr(self.follower, name)
+
+    def blocks_by_slot(self, from_slot: Slot, to_slot: Slot | None = None):
+        self.requests += 1
+        with self.concurrency:
+            time.sleep(self.latency)
+            if self.fail:
+                raise ConnectionError("peer unavailable")
+            return list(self.follower.blocks_by_slot(from_slot, to_slot))
+
 
 def apply_invalid_block_to_ledger_state(follower: Follower, block: BlockHeader):
     state = follower.ledger_state[block.parent].copy()